@@ -1,144 +1,358 @@
 # app/api/chat_routes.py
-from fastapi import APIRouter, Depends, HTTPException, status 
-from sqlalchemy.orm import Session
-from app.models.chat_models import ChatRequest, ChatResponse
+import json
+import logging
+from typing import AsyncIterator, Awaitable, Callable, List, Optional
+from fastapi import APIRouter, Header, HTTPException, Request, Response, status
+from fastapi.responses import StreamingResponse
+from sqlalchemy.ext.asyncio import AsyncSession
+from app.models.chat_models import BatchEvaluationRequest, ChatRequest, ChatResponse
 # サービス層のモジュールをインポート
 from app.services import thinking_chat_service, answer_chat_service, understanding_evaluation_chat_service, question_chat_service
-# database.py から get_db 依存性注入ヘルパーをインポート
-from app.db.database import get_db
+from app.core.disconnect import ClientDisconnected, cancel_on_disconnect, stream_until_disconnect
+from app.core.logging import bind_log_context
+from app.core.metrics import CHAT_CLIENT_DISCONNECTS, track_request
+from app.db.crud import ConversationNotFound
+from app.services.ai_service import AdmissionRejected, check_llm_capacity
+from app.services.chat_batch import CHAT_BATCH_MAX_ITEMS
+from app.services.chat_pipeline import ChatPipeline, get_pipeline
+from app.services.chat_stream import EVENT_DONE
+from app.services.single_flight import batch_request_key, chat_flights, chat_request_key
+# 重複リクエストの待ち合わせでは処理を複数のリクエストで共有するため、DBセッションは処理側で開く
+from app.db.database import AsyncSessionLocal
 
 
 # APIRouter インスタンスを作成
 # このルーター内の全てのエンドポイントは、main.py で設定された prefix (例: /chat) の下に配置されます。
 router = APIRouter()
 
+logger = logging.getLogger(__name__)
+
+# ストリーミング (SSE) 応答で共通に使うヘッダー
+# X-Accel-Buffering: no はリバースプロキシ (nginx等) にバッファリングさせないための指定
+SSE_HEADERS = {
+    "Cache-Control": "no-cache",
+    "X-Accel-Buffering": "no",
+}
+
+# 応答を返す前にクライアントが切断した場合のステータス (nginx の慣例。クライアントには届かないがログに残る)
+CLIENT_CLOSED_REQUEST = 499
+
+def _client_disconnected(mode: str, stream: bool) -> None:
+    """クライアントの切断で処理を取り消したことを記録する"""
+    CHAT_CLIENT_DISCONNECTS.labels(mode=mode, stream="true" if stream else "false").inc()
+    logger.info("Client disconnected; cancelled %s request", mode)
+
+def _too_busy(e: AdmissionRejected) -> HTTPException:
+    """
+    LLM呼び出しを受け付けられなかった場合のエラー (Retry-After 秒後に再試行してもらう)。
+    混雑なら 429、プロバイダの障害でサーキットブレーカーが開いていれば 503。
+    """
+    logger.warning("Rejected request: LLM is busy (%s)", e.reason)
+    return HTTPException(
+        status_code=e.status_code,
+        detail="AI is busy. Please retry later.",
+        headers={"Retry-After": e.retry_after_header},
+    )
+
+async def _run_once(
+    http_request: Request,
+    mode: str,
+    request: ChatRequest,
+    idempotency_key: Optional[str],
+    process: Callable[[AsyncSession, ChatRequest], Awaitable[ChatResponse]],
+) -> ChatResponse:
+    """
+    サービス層の処理を実行する。同じリクエストが処理中ならその結果を待ち、
+    終わった直後ならその結果を返す（二重送信・再送で LLM 呼び出しと保存を重複させない）。
+    応答の前にクライアントが切断したら処理を取り消し（保存もしない）、ClientDisconnected を送出する。
+    """
+    async def run() -> ChatResponse:
+        async with AsyncSessionLocal() as db:
+            return await process(db, request)
+    try:
+        return await cancel_on_disconnect(
+            http_request, chat_flights.run(chat_request_key(mode, request, idempotency_key), mode, run),
+        )
+    except ClientDisconnected:
+        _client_disconnected(mode, stream=False)
+        raise
+
+def _stream_once(
+    http_request: Request,
+    mode: str,
+    request: ChatRequest,
+    idempotency_key: Optional[str],
+    process: Callable[[ChatRequest], AsyncIterator[str]],
+) -> AsyncIterator[str]:
+    """
+    ストリーミング版の _run_once。最後まで done イベントで終わったストリームだけをリプレイする。
+    クライアントが切断したら、AIのストリームを取り消して終える（ターンは保存しない）。
+    """
+    def completed(events: List[str]) -> bool:
+        return bool(events) and events[-1].startswith(f"event: {EVENT_DONE}\n")
+    events = chat_flights.stream(
+        chat_request_key(mode, request, idempotency_key, stream=True), mode, lambda: process(request), completed,
+    )
+    return stream_until_disconnect(http_request, events, on_disconnect=lambda: _client_disconnected(mode, stream=True))
+
+def _sse_response(event_stream) -> StreamingResponse:
+    """
+    サービス層が返す SSE 文字列のイテレータを StreamingResponse に包む。
+    LLM呼び出しの待ち行列が一杯なら、ストリームを始める前に 429 を返す。
+    """
+    try:
+        check_llm_capacity()
+    except AdmissionRejected as e:
+        raise _too_busy(e)
+    return StreamingResponse(event_stream, media_type="text/event-stream", headers=SSE_HEADERS)
+
+async def _chat(http_request: Request, pipeline: ChatPipeline, request: ChatRequest, idempotency_key: Optional[str]):
+    """全モード共通の通常版エンドポイントの処理（モードの違いは pipeline に閉じている）"""
+    bind_log_context(mode=pipeline.name, conversation_id=request.conversation_id)
+    logger.info("Received request for %s", http_request.url.path)
+    try:
+        # Service Layer の処理を実行し、返された結果をそのまま返す
+        with track_request(pipeline.name):
+            return await _run_once(http_request, pipeline.name, request, idempotency_key, pipeline.run)
+
+    except ClientDisconnected:
+        # 応答を読む相手がいないので、処理を取り消して終える
+        return Response(status_code=CLIENT_CLOSED_REQUEST)
+
+    except AdmissionRejected as e:
+        raise _too_busy(e)
+
+    except ConversationNotFound as e:
+        # 古い・誤った会話IDが送られた（クライアントは新しい会話として送り直せる）
+        logger.warning("Conversation %d not found", e.conversation_id)
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Conversation not found")
+
+    except Exception:
+        # Service Layer などで発生した例外をキャッチし、HTTPエラーとして返す
+        logger.exception("API error in %s", http_request.url.path)
+        # 本番環境では詳細なエラーメッセージをそのまま返さない方が良い場合が多い
+        raise HTTPException(
+            status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
+            detail=f"Internal Server Error processing {pipeline.label} mode request"
+        )
+
+def _chat_stream(http_request: Request, pipeline: ChatPipeline, request: ChatRequest, idempotency_key: Optional[str]) -> StreamingResponse:
+    """全モード共通のストリーミング版エンドポイントの処理"""
+    bind_log_context(mode=pipeline.name, conversation_id=request.conversation_id)
+    logger.info("Received request for %s", http_request.url.path)
+    return _sse_response(_stream_once(http_request, pipeline.name, request, idempotency_key, pipeline.stream))
+
+def _configured_pipeline(mode: str) -> ChatPipeline:
+    pipeline = get_pipeline(mode)
+    if pipeline is None:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail=f"Unknown chat mode: {mode}")
+    return pipeline
+
 @router.post("/thinking",
              response_model=ChatResponse, # 返すレスポンスの形式を指定 (自動で検証・整形)
              status_code=status.HTTP_200_OK, # 成功時のステータスコード
              summary="考え方や調べ方を回答するチャット機能" # 自動生成ドキュメント用
             )
-async def chat_thinking_endpoint(request: ChatRequest, db: Session = Depends(get_db)):
+async def chat_thinking_endpoint(request: ChatRequest, http_request: Request, idempotency_key: Optional[str] = Header(None)):
     """
     **考え方や調べ方モード**のチャットリクエストを受け付けます。
 
     - **question**: ユーザーからの現在の質問
     - **history**: 過去の会話履歴 (ChatMessageオブジェクトのリスト)
     - **conversation_id**: 会話の識別子 (新規会話の場合はNone)
+    - **Idempotency-Key** (ヘッダー, 任意): 再送時に同じ値を送ると、処理中・直前の結果をそのまま返します
 
     AIからの応答として、答えそのものではなく、考え方や調べ方の手順を返します。
     """
-    print(f"API: Received request for /chat/thinking - Conversation ID: {request.conversation_id}, Question: {request.question[:50]}...")
-    try:
-        # Service Layer の関数を呼び出し、実際のビジネスロジックを実行
-        response = await thinking_chat_service.process_thinking_request(db,request)
-
-        # Service Layer から返された結果をそのまま返す
-        return response
-
-    except Exception as e:
-        # Service Layer などで発生した例外をキャッチし、HTTPエラーとして返す
-        print(f"API Error in /chat/thinking: {e}")
-        # 本番環境では詳細なエラーメッセージをそのまま返さない方が良い場合が多い
-        raise HTTPException(
-            status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
-            detail="Internal Server Error processing thinking mode request"
-        )
+    return await _chat(http_request, thinking_chat_service.thinking_pipeline, request, idempotency_key)
 
 @router.post("/answer",
              response_model=ChatResponse,
              status_code=status.HTTP_200_OK,
              summary="答えを返した上で考え方を問うチャット機能"
             )
-async def chat_answer_and_why_endpoint(request: ChatRequest, db: Session = Depends(get_db)):
+async def chat_answer_and_why_endpoint(request: ChatRequest, http_request: Request, idempotency_key: Optional[str] = Header(None)):
     """
     **答え+なぜ？モード**のチャットリクエストを受け付けます。
 
     - **question**: ユーザーからの現在の質問
     - **history**: 過去の会話履歴 (ChatMessageオブジェクトのリスト)
     - **conversation_id**: 会話の識別子 (新規会話の場合はNone)
+    - **Idempotency-Key** (ヘッダー, 任意): 再送時に同じ値を送ると、処理中・直前の結果をそのまま返します
 
     AIからの応答として、まず質問への答えを返し、その後に答えの根拠や理由をユーザーに尋ねる質問を続けます。
     """
-    print(f"API: Received request for /chat/answer - Question: {request.question[:50]}...")
-    try:
-        # Service Layer の関数を呼び出し、実際のビジネスロジックを実行
-        response = await answer_chat_service.process_answer_and_why_request(db, request)
-
-        # Service Layer から返された結果をそのまま返す
-        return response
-
-    except Exception as e:
-        # Service Layer などで発生した例外をキャッチし、HTTPエラーとして返す
-        print(f"API Error in /chat/answer: {e}")
-        raise HTTPException(
-            status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
-            detail="Internal Server Error processing answer and why mode request"
-        )
+    return await _chat(http_request, answer_chat_service.answer_and_why_pipeline, request, idempotency_key)
 
 @router.post("/understanding_evaluation",
              response_model=ChatResponse, # 返すレスポンスの形式を指定 (自動で検証・整形)
              status_code=status.HTTP_200_OK, # 成功時のステータスコード
              summary="理解度を回答するチャット機能" # 自動生成ドキュメント用
             )
-async def chat_understanding_evaluation_endpoint(request: ChatRequest, db: Session = Depends(get_db)):
+async def chat_understanding_evaluation_endpoint(request: ChatRequest, http_request: Request, idempotency_key: Optional[str] = Header(None)):
     """
     **理解度評価モード**のチャットリクエストを受け付けます。
 
     - **question**: ユーザーからの現在の質問
     - **history**: 過去の会話履歴 (ChatMessageオブジェクトのリスト)
     - **conversation_id**: 会話の識別子 (新規会話の場合はNone)
+    - **Idempotency-Key** (ヘッダー, 任意): 再送時に同じ値を送ると、処理中・直前の結果をそのまま返します
 
     AIからの応答として、学習内容の理解度を返します。
     """
-    print(f"API: Received request for /chat/understanding_evaluation - Conversation ID: {request.conversation_id}, Question: {request.question[:50]}...")
-    try:
-        # Service Layer の関数を呼び出し、実際のビジネスロジックを実行
-        response = await understanding_evaluation_chat_service.process_understanding_evaluation_request(db,request)
+    return await _chat(http_request, understanding_evaluation_chat_service.understanding_evaluation_pipeline, request, idempotency_key)
 
-        # Service Layer から返された結果をそのまま返す
-        return response
-
-    except Exception as e:
-        # Service Layer などで発生した例外をキャッチし、HTTPエラーとして返す
-        print(f"API Error in /chat/understanding_evaluation: {e}")
-        # 本番環境では詳細なエラーメッセージをそのまま返さない方が良い場合が多い
-        raise HTTPException(
-            status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
-            detail="Internal Server Error processing understanding evaluation mode request"
-        )
-    
 
 @router.post("/question",
             response_model=ChatResponse, # 返すレスポンスの形式を指定 (自動で検証・整形)
             status_code=status.HTTP_200_OK, # 成功時のステータスコード
             summary="理解度チェックの出題" # 自動生成ドキュメント用
             )
-async def chat_question_endpoint(request: ChatRequest, db: Session = Depends(get_db)):
+async def chat_question_endpoint(request: ChatRequest, http_request: Request, idempotency_key: Optional[str] = Header(None)):
     """
     **理解度確認出題**のリクエストを受け付けます。
 
     - **question**: 対象の問題（学習した内容）
     - **history**: 過去の会話履歴 (ChatMessageオブジェクトのリスト)
     - **conversation_id**: 会話の識別子 (新規会話の場合はNone)
+    - **Idempotency-Key** (ヘッダー, 任意): 再送時に同じ値を送ると、処理中・直前の結果をそのまま返します
 
     AIからの応答として、学習内容の理解度を返します。
     """
-    print(f"API: Received request for /chat/question - Conversation ID: {request.conversation_id}, Question: {request.question[:50]}...")
-    try:
-        # Service Layer の関数を呼び出し、実際のビジネスロジックを実行
-        response = await question_chat_service.process_question_request(db, request)
+    return await _chat(http_request, question_chat_service.question_pipeline, request, idempotency_key)
 
-    # Service Layer から返された結果をそのまま返す
-        return response
+# --- ストリーミング版エンドポイント ---
+# 応答全体の生成を待たず、AIが生成したそばから Server-Sent Events で返す。
+#   event: token → data: {"text": "..."}            応答テキストの断片（複数回）
+#   event: done  → data: {"conversation_id": 123}   ストリーム完了（最後に1回）
+#   event: error → data: {"detail": "...", ...}      途中でエラーが発生した場合
+# ユーザーの質問とAIの応答は、ストリームが完了した時点でDBに保存されます（途中でクライアントが切断した場合は、AIの生成を止めて保存しません）。
 
-    except Exception as e:
-    # Service Layer などで発生した例外をキャッチし、HTTPエラーとして返す
-        print(f"API Error in /chat/question: {e}")
-        # 本番環境では詳細なエラーメッセージをそのまま返さない方が良い場合が多い
+STREAM_DESCRIPTION = """
+通常版と同じリクエストを受け付け、応答を Server-Sent Events (text/event-stream) で順次返します。
+
+- **event: token**: 応答テキストの断片 (`{"text": "..."}`)
+- **event: done**: 完了通知。次回リクエスト用の `conversation_id` を含みます
+- **event: error**: 途中でエラーが発生した場合の通知
+
+混雑でAIを呼び出せない場合は、ストリーム開始前なら 429 / 503 (Retry-After ヘッダー付き)、
+開始後なら `retry_after` を含む error イベントを返します。
+
+`Idempotency-Key` ヘッダー（任意）に同じ値を付けて再送すると、処理中のストリームに途中から加わるか、
+直前に完了したストリームを最初から受け取ります（AIの呼び出しと保存は1回だけ行われます）。
+"""
+
+@router.post("/thinking/stream",
+             summary="考え方や調べ方を回答するチャット機能（ストリーミング）",
+             description=STREAM_DESCRIPTION,
+             response_class=StreamingResponse,
+            )
+async def chat_thinking_stream_endpoint(request: ChatRequest, http_request: Request, idempotency_key: Optional[str] = Header(None)):
+    return _chat_stream(http_request, thinking_chat_service.thinking_pipeline, request, idempotency_key)
+
+@router.post("/answer/stream",
+             summary="答えを返した上で考え方を問うチャット機能（ストリーミング）",
+             description=STREAM_DESCRIPTION,
+             response_class=StreamingResponse,
+            )
+async def chat_answer_and_why_stream_endpoint(request: ChatRequest, http_request: Request, idempotency_key: Optional[str] = Header(None)):
+    return _chat_stream(http_request, answer_chat_service.answer_and_why_pipeline, request, idempotency_key)
+
+@router.post("/understanding_evaluation/stream",
+             summary="理解度を回答するチャット機能（ストリーミング）",
+             description=STREAM_DESCRIPTION,
+             response_class=StreamingResponse,
+            )
+async def chat_understanding_evaluation_stream_endpoint(request: ChatRequest, http_request: Request, idempotency_key: Optional[str] = Header(None)):
+    return _chat_stream(http_request, understanding_evaluation_chat_service.understanding_evaluation_pipeline, request, idempotency_key)
+
+@router.post("/question/stream",
+             summary="理解度チェックの出題（ストリーミング）",
+             description=STREAM_DESCRIPTION,
+             response_class=StreamingResponse,
+            )
+async def chat_question_stream_endpoint(request: ChatRequest, http_request: Request, idempotency_key: Optional[str] = Header(None)):
+    return _chat_stream(http_request, question_chat_service.question_pipeline, request, idempotency_key)
+
+# --- 設定ファイルで追加したモード ---
+# CHAT_MODES_PATH の設定ファイルで定義したモード（組み込みの4モードも指定できる）を、モード名で呼び出す。
+
+@router.post("/modes/{mode}",
+             response_model=ChatResponse,
+             status_code=status.HTTP_200_OK,
+             summary="モード名を指定するチャット機能"
+            )
+async def chat_mode_endpoint(mode: str, request: ChatRequest, http_request: Request, idempotency_key: Optional[str] = Header(None)):
+    """
+    **mode** で指定したモードのチャットリクエストを受け付けます（リクエストとレスポンスは他のモードと同じ）。
+    登録されていないモードの場合は 404 を返します。
+    """
+    return await _chat(http_request, _configured_pipeline(mode), request, idempotency_key)
+
+@router.post("/modes/{mode}/stream",
+             summary="モード名を指定するチャット機能（ストリーミング）",
+             description=STREAM_DESCRIPTION,
+             response_class=StreamingResponse,
+            )
+async def chat_mode_stream_endpoint(mode: str, request: ChatRequest, http_request: Request, idempotency_key: Optional[str] = Header(None)):
+    return _chat_stream(http_request, _configured_pipeline(mode), request, idempotency_key)
+
+# --- 一括評価 ---
+# 先生がクラス全員分の回答をまとめて理解度評価にかける。
+# 生徒ごとの結果は、終わったものから NDJSON (1行1件) で返す。
+
+BATCH_DESCRIPTION = f"""
+複数の生徒の回答 (`items`: learner_id, answer, conversation_id) をまとめて理解度評価します。最大 {CHAT_BATCH_MAX_ITEMS} 件。
+
+AIの呼び出しは同時実行数を制限しながら並行して行い、評価が終わった生徒から順に
+1行1件の JSON (`application/x-ndjson`) で結果を返します。行の順序はリクエストの順序と一致しないため、`index` で対応付けてください。
+
+- 成功: `{{"index": 0, "learner_id": "...", "conversation_id": 123, "response": "..."}}`
+- 失敗: `{{"index": 1, "learner_id": "...", "error": "busy", "retry_after": "5"}}`
+  (`error`: busy / llm_error / persistence_error / conversation_not_found / conversation_mismatch)
+- `conversation_id` の会話がない、または別の生徒の会話の場合は、AIを呼ばずにその生徒だけ失敗として返します。
+
+同じリクエストを再送した場合（`Idempotency-Key` ヘッダーが同じ、またはなければ内容が同じ場合）は、
+処理中・直前に完了した結果を返します。
+"""
+
+@router.post("/understanding_evaluation/batch",
+             summary="理解度評価の一括実行（クラス全員分）",
+             description=BATCH_DESCRIPTION,
+             response_class=StreamingResponse,
+            )
+async def chat_understanding_evaluation_batch_endpoint(
+    request: BatchEvaluationRequest, http_request: Request, idempotency_key: Optional[str] = Header(None),
+):
+    bind_log_context(mode="understanding_evaluation")
+    logger.info("Received request for /chat/understanding_evaluation/batch (%d items)", len(request.items))
+    if not request.items:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="items must not be empty")
+    if len(request.items) > CHAT_BATCH_MAX_ITEMS:
         raise HTTPException(
-            status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
-            detail="Internal Server Error processing question request"
+            status_code=status.HTTP_413_REQUEST_ENTITY_TOO_LARGE,
+            detail=f"Too many items (max {CHAT_BATCH_MAX_ITEMS})",
         )
+    conversation_ids = [item.conversation_id for item in request.items if item.conversation_id is not None]
+    if len(conversation_ids) != len(set(conversation_ids)):
+        # 同じ会話のターンを並行して処理すると、互いの履歴が見えないまま保存されてしまう
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="Duplicate conversation_id in items")
+    # 同じ一括リクエストの再送は、処理中・直前の結果を共有する（失敗した生徒がいた結果はリプレイしない）
+    results = chat_flights.stream(
+        batch_request_key("understanding_evaluation", request, idempotency_key),
+        "understanding_evaluation",
+        lambda: understanding_evaluation_chat_service.understanding_evaluation_pipeline.batch(request.items),
+        lambda lines: all("error" not in json.loads(line) for line in lines),
+    )
+    # クライアントが切断したら、まだ終わっていない生徒の評価を取り消す
+    results = stream_until_disconnect(
+        http_request, results, on_disconnect=lambda: _client_disconnected("understanding_evaluation", stream=True),
+    )
+    return StreamingResponse(
+        results,
+        media_type="application/x-ndjson",
+        headers=SSE_HEADERS,
+    )
 
 # --- 必要に応じて他のチャット関連APIエンドポイントを追加 ---
 # 例: /chat/history (履歴取得), /chat/new (新しい会話開始) など
\ No newline at end of file
@@ -0,0 +1,34 @@
+# app/api/progress_routes.py
+# 生徒ごとの学習の進み具合（保護者・教師向けの画面用）
+import logging
+from fastapi import APIRouter, Depends, HTTPException, status
+from sqlalchemy.ext.asyncio import AsyncSession
+from app.models.progress_models import LearnerProgressResponse
+from app.services import progress_service
+from app.core.logging import bind_log_context
+from app.db.database import get_async_read_db
+
+
+# main.py で /learners というプレフィックスで登録される
+router = APIRouter()
+
+logger = logging.getLogger(__name__)
+
+@router.get("/{learner_id}/progress",
+            response_model=LearnerProgressResponse,
+            status_code=status.HTTP_200_OK,
+            summary="生徒の学習の進み具合（理解度の推移・教科別の集計）",
+           )
+async def learner_progress_endpoint(learner_id: str, db: AsyncSession = Depends(get_async_read_db)):
+    """
+    生徒 (**learner_id**) の理解度評価の集計を返します。
+
+    理解度評価を保存するたびに更新している集計を読むだけなので、評価の回数に関係なく一定の時間で返します。
+    評価は `learner_id` を指定して始めた会話（一括評価を含む）のものだけが集計されます。
+    まだ評価がない生徒は 404 を返します。
+    """
+    bind_log_context(learner_id=learner_id)
+    progress = await progress_service.get_learner_progress(db, learner_id)
+    if progress is None:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="No progress for this learner")
+    return progress
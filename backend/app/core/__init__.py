@@ -0,0 +1,2 @@
+# app/core
+# アプリ全体で使う横断的な仕組み（メトリクスなど）
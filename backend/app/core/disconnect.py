@@ -0,0 +1,74 @@
+# app/core/disconnect.py
+# クライアントの切断の検知
+# 生徒がタブを閉じたり別の画面に移ったりしても、何もしなければ LLM の応答を最後まで待って保存してしまう。
+# 誰も読まない応答のために LLM の枠とワーカーを使い続けないよう、切断されたら処理を取り消す。
+# （リクエスト本文を読み終えた後の receive() は、クライアントが切断したときに http.disconnect を返す）
+import asyncio
+from typing import AsyncIterator, Awaitable, Callable, Optional, TypeVar
+
+from starlette.requests import Request
+
+T = TypeVar("T")
+
+class ClientDisconnected(Exception):
+    """応答を返す前にクライアントが切断した"""
+
+async def wait_for_disconnect(request: Request) -> None:
+    """クライアントが切断するまで待つ（リクエスト本文を読み終えてから呼ぶ）"""
+    while True:
+        message = await request.receive()
+        if message["type"] == "http.disconnect":
+            return
+
+async def cancel_on_disconnect(request: Request, work: Awaitable[T]) -> T:
+    """
+    work の結果を返す。先にクライアントが切断したら work を取り消し（取り消しの完了まで待つ）、
+    ClientDisconnected を送出する。
+    """
+    task = asyncio.ensure_future(work)
+    disconnected = asyncio.ensure_future(wait_for_disconnect(request))
+    try:
+        await asyncio.wait({task, disconnected}, return_when=asyncio.FIRST_COMPLETED)
+    except asyncio.CancelledError:
+        task.cancel()
+        raise
+    finally:
+        disconnected.cancel()
+    if task.done():
+        return task.result()
+    task.cancel()
+    await asyncio.wait({task})
+    raise ClientDisconnected()
+
+async def stream_until_disconnect(
+    request: Request,
+    events: AsyncIterator[str],
+    on_disconnect: Optional[Callable[[], None]] = None,
+) -> AsyncIterator[str]:
+    """
+    events をそのまま返す。クライアントが切断したら、次のイベントを待っている処理を取り消して終える
+    （その場合は on_disconnect を呼ぶ）。
+    サーバーによっては、切断は次の送信に失敗するまで分からない。最初のトークンを待つ間も検知できるようにする。
+    """
+    iterator = events.__aiter__()
+    disconnected = asyncio.ensure_future(wait_for_disconnect(request))
+    next_event: Optional[asyncio.Future] = None
+    try:
+        while True:
+            next_event = asyncio.ensure_future(iterator.__anext__())
+            await asyncio.wait({next_event, disconnected}, return_when=asyncio.FIRST_COMPLETED)
+            if not next_event.done():
+                next_event.cancel()
+                await asyncio.wait({next_event})
+                if on_disconnect is not None:
+                    on_disconnect()
+                return
+            try:
+                event = next_event.result()
+            except StopAsyncIteration:
+                return
+            yield event
+    finally:
+        disconnected.cancel()
+        if next_event is not None and not next_event.done():
+            next_event.cancel()
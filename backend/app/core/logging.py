@@ -0,0 +1,226 @@
+# app/core/logging.py
+# 構造化 (JSON) ログ
+# print() は標準出力への同期書き込みで、負荷が高いとイベントループを待たせてしまう。
+# ここではログレコードをキューに積むだけにして、整形と書き込みは別スレッドのリスナーで行う。
+# 各行にはリクエストごとの相関ID (request_id, conversation_id, mode) を付ける。
+import atexit
+import contextvars
+import copy
+import datetime
+import json
+import logging
+import logging.handlers
+import os
+import queue
+import random
+import sys
+import uuid
+import zlib
+from contextlib import contextmanager
+from typing import Any, Dict, Iterator, Optional
+
+# ログレベル (DEBUG / INFO / WARNING / ERROR)
+LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO").upper()
+# ロガー単位のレベル指定 (例: "app.services.llm=DEBUG,app.db=WARNING")
+LOG_LEVELS = os.getenv("LOG_LEVELS", "")
+# 出力形式: json (1行1 JSON) / text (ローカル開発向けの読みやすい形式)
+LOG_FORMAT = os.getenv("LOG_FORMAT", "json")
+# DEBUG ログを残す割合 (0〜1)。リクエスト単位で判定するので、残ったリクエストの DEBUG ログは揃って残る
+LOG_DEBUG_SAMPLE_RATE = float(os.getenv("LOG_DEBUG_SAMPLE_RATE", "1.0"))
+# 書き込み待ちのログの上限。溢れた分は捨てる（ログのためにリクエストを待たせない）
+LOG_QUEUE_SIZE = int(os.getenv("LOG_QUEUE_SIZE", "10000"))
+
+# 相関IDを受け取る/返すヘッダー
+REQUEST_ID_HEADER = "x-request-id"
+# アプリのロガーの親（各モジュールは logging.getLogger(__name__) で子ロガーを使う）
+APP_LOGGER_NAME = "app"
+
+# 現在のリクエストのログ用コンテキスト (request_id, conversation_id, mode など)
+_log_context: contextvars.ContextVar[Dict[str, Any]] = contextvars.ContextVar("log_context", default={})
+
+# LogRecord が標準で持つ属性（これ以外は extra= で渡された項目として出力する）
+_RESERVED_ATTRS = set(vars(logging.LogRecord("", 0, "", 0, "", None, None))) | {"message", "log_context"}
+
+def get_log_context() -> Dict[str, Any]:
+    return _log_context.get()
+
+def bind_log_context(**fields: Any) -> None:
+    """現在のリクエストのログ用コンテキストに項目を追加する（以降のログに付く）"""
+    _log_context.set({**_log_context.get(), **fields})
+
+@contextmanager
+def log_context(**fields: Any) -> Iterator[None]:
+    """with ブロックの間だけ、ログ用コンテキストに項目を追加する"""
+    token = _log_context.set({**_log_context.get(), **fields})
+    try:
+        yield
+    finally:
+        _log_context.reset(token)
+
+class ContextFilter(logging.Filter):
+    """ログを出した時点のコンテキストをレコードに写す（リスナーのスレッドからは contextvars が見えないため）"""
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        record.log_context = _log_context.get()
+        return True
+
+class DebugSamplingFilter(logging.Filter):
+    """DEBUG ログを LOG_DEBUG_SAMPLE_RATE の割合だけ残す"""
+
+    def __init__(self, rate: float):
+        super().__init__()
+        self.rate = rate
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        if record.levelno > logging.DEBUG or self.rate >= 1:
+            return True
+        request_id = getattr(record, "log_context", {}).get("request_id")
+        if request_id:
+            # 同じリクエストなら毎回同じ判定になるように、request_id のハッシュで決める
+            return zlib.crc32(request_id.encode()) / 0xFFFFFFFF < self.rate
+        return random.random() < self.rate
+
+class JsonFormatter(logging.Formatter):
+    """1レコードを1行の JSON にする"""
+
+    def format(self, record: logging.LogRecord) -> str:
+        payload: Dict[str, Any] = {
+            "time": datetime.datetime.fromtimestamp(record.created, datetime.timezone.utc).isoformat(timespec="milliseconds"),
+            "level": record.levelname,
+            "logger": record.name,
+            "message": record.getMessage(),
+        }
+        payload.update(getattr(record, "log_context", {}))
+        payload.update(_extra_fields(record))
+        if record.exc_text:
+            payload["exc_info"] = record.exc_text
+        return json.dumps(payload, ensure_ascii=False, default=str)
+
+class TextFormatter(logging.Formatter):
+    """ローカル開発向け: 時刻 レベル ロガー メッセージ key=value ..."""
+
+    def format(self, record: logging.LogRecord) -> str:
+        fields = {**getattr(record, "log_context", {}), **_extra_fields(record)}
+        line = f"{self.formatTime(record)} {record.levelname:<7} {record.name}: {record.getMessage()}"
+        if fields:
+            line += " " + " ".join(f"{key}={value}" for key, value in fields.items())
+        if record.exc_text:
+            line += "\n" + record.exc_text
+        return line
+
+def _extra_fields(record: logging.LogRecord) -> Dict[str, Any]:
+    return {key: value for key, value in vars(record).items() if key not in _RESERVED_ATTRS}
+
+class NonBlockingQueueHandler(logging.handlers.QueueHandler):
+    """
+    レコードをキューに積むだけのハンドラー。キューが一杯なら待たずに捨てて数える。
+    メッセージの組み立てと例外の文字列化だけは呼び出し側で行う（引数や例外オブジェクトを別スレッドに渡さない）。
+    """
+
+    def __init__(self, log_queue: "queue.Queue[logging.LogRecord]"):
+        super().__init__(log_queue)
+        self.dropped = 0
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        record = copy.copy(record)
+        record.msg = record.getMessage()
+        record.args = None
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+    def enqueue(self, record: logging.LogRecord) -> None:
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+_listener: Optional[logging.handlers.QueueListener] = None
+_queue_handler: Optional[NonBlockingQueueHandler] = None
+
+def _parse_levels(spec: str) -> Dict[str, str]:
+    levels: Dict[str, str] = {}
+    for item in spec.split(","):
+        name, _, level = item.partition("=")
+        if name.strip() and level.strip():
+            levels[name.strip()] = level.strip().upper()
+    return levels
+
+def setup_logging() -> None:
+    """アプリのロガー (app.*) をキュー経由の構造化ログに設定する（複数回呼んでも一度だけ設定する）"""
+    global _listener, _queue_handler
+    if _listener is not None:
+        return
+
+    output = logging.StreamHandler(sys.stdout)
+    output.setFormatter(JsonFormatter() if LOG_FORMAT == "json" else TextFormatter())
+
+    _queue_handler = NonBlockingQueueHandler(queue.Queue(maxsize=LOG_QUEUE_SIZE))
+    _queue_handler.addFilter(ContextFilter())
+    _queue_handler.addFilter(DebugSamplingFilter(LOG_DEBUG_SAMPLE_RATE))
+
+    app_logger = logging.getLogger(APP_LOGGER_NAME)
+    app_logger.handlers = [_queue_handler]
+    app_logger.setLevel(LOG_LEVEL)
+    app_logger.propagate = False
+    for name, level in _parse_levels(LOG_LEVELS).items():
+        logging.getLogger(name).setLevel(level)
+
+    _listener = logging.handlers.QueueListener(_queue_handler.queue, output, respect_handler_level=True)
+    _listener.start()
+    atexit.register(shutdown_logging)
+
+def _restart_after_fork() -> None:
+    """
+    fork した子プロセス（マルチワーカー起動のワーカー）では、親のリスナースレッドは動いていない。
+    キューを作り直し、同じ出力先に書き出すリスナーを子プロセスで起動し直す。
+    """
+    global _listener
+    if _listener is None or _queue_handler is None:
+        return
+    _queue_handler.queue = queue.Queue(maxsize=LOG_QUEUE_SIZE)
+    _queue_handler.dropped = 0
+    _listener = logging.handlers.QueueListener(_queue_handler.queue, *_listener.handlers, respect_handler_level=True)
+    _listener.start()
+
+os.register_at_fork(after_in_child=_restart_after_fork)
+
+def shutdown_logging() -> None:
+    """キューに残っているログを書き出してからリスナーを止める"""
+    global _listener
+    if _listener is None:
+        return
+    _listener.stop()
+    _listener = None
+    if _queue_handler is not None and _queue_handler.dropped:
+        print(f"Logging: dropped {_queue_handler.dropped} records because the log queue was full", file=sys.stderr)
+
+class RequestContextMiddleware:
+    """
+    リクエストごとに request_id を決めてログ用コンテキストに入れる ASGI ミドルウェア。
+    クライアントが X-Request-ID を送ってきた場合はそれを使い、レスポンスヘッダーでも返す。
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        request_id = None
+        for name, value in scope.get("headers", []):
+            if name == REQUEST_ID_HEADER.encode():
+                request_id = value.decode("latin-1")[:128]
+                break
+        request_id = request_id or uuid.uuid4().hex
+
+        async def send_with_request_id(message):
+            if message["type"] == "http.response.start":
+                message["headers"] = list(message.get("headers", [])) + [(REQUEST_ID_HEADER.encode(), request_id.encode("latin-1"))]
+            await send(message)
+
+        with log_context(request_id=request_id, path=scope.get("path")):
+            await self.app(scope, receive, send_with_request_id)
@@ -0,0 +1,204 @@
+# app/core/metrics.py
+# Prometheus 形式のメトリクス
+# 1ターンの各段階（履歴の読み込み、プロンプト組み立て、LLM呼び出し、保存）の所要時間をモード別に記録し、
+# 遅いターンの原因が DB なのか Gemini なのかを見分けられるようにする。/metrics で公開する。
+import asyncio
+import time
+from contextlib import contextmanager
+from typing import Callable, Dict, Iterator
+
+from prometheus_client import CONTENT_TYPE_LATEST, REGISTRY, Counter, Gauge, Histogram, generate_latest
+from prometheus_client.core import CounterMetricFamily, GaugeMetricFamily
+
+from app.core.disconnect import ClientDisconnected
+
+# DB の処理 (ミリ秒単位) から LLM の呼び出し (数十秒) までをカバーするバケット
+STAGE_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 20, 40, 60)
+
+# 1ターンの段階
+STAGE_CONVERSATION_CREATE = "conversation_create"
+STAGE_HISTORY_LOAD = "history_load"
+STAGE_PROMPT_BUILD = "prompt_build"
+STAGE_LLM_CALL = "llm_call"
+STAGE_PERSISTENCE = "persistence"
+
+CHAT_STAGE_DURATION = Histogram(
+    "chat_stage_duration_seconds",
+    "Duration of each stage of a chat turn",
+    ["mode", "stage"],
+    buckets=STAGE_BUCKETS,
+)
+CHAT_REQUEST_DURATION = Histogram(
+    "chat_request_duration_seconds",
+    "End-to-end duration of a chat request",
+    ["mode", "stream"],
+    buckets=STAGE_BUCKETS,
+)
+CHAT_REQUESTS = Counter(
+    "chat_requests_total",
+    "Chat requests by outcome",
+    ["mode", "stream", "outcome"],
+)
+CHAT_STAGE_ERRORS = Counter(
+    "chat_stage_errors_total",
+    "Errors raised in each stage of a chat turn",
+    ["mode", "stage"],
+)
+CHAT_STAGE_CANCELLED = Counter(
+    "chat_stage_cancelled_total",
+    "Stages of a chat turn interrupted by cancellation (client disconnect), e.g. LLM calls cut short",
+    ["mode", "stage"],
+)
+CHAT_CLIENT_DISCONNECTS = Counter(
+    "chat_client_disconnects_total",
+    "Chat requests whose client disconnected before the response was complete (the work was cancelled)",
+    ["mode", "stream"],
+)
+CHAT_IN_FLIGHT = Gauge(
+    "chat_requests_in_flight",
+    "Chat requests currently being processed",
+    ["mode"],
+)
+LLM_RESPONSE_ISSUES = Counter(
+    "llm_response_issues_total",
+    "LLM responses that produced no usable text (safety blocks, empty candidates, ...)",
+    ["mode", "kind"],
+)
+
+LLM_ADMISSION_WAIT = Histogram(
+    "llm_admission_wait_seconds",
+    "Time LLM calls spent waiting for admission (concurrency cap / rate limits)",
+    buckets=STAGE_BUCKETS,
+)
+LLM_ADMISSION_REJECTED = Counter(
+    "llm_admission_rejected_total",
+    "LLM calls rejected by admission control",
+    ["reason"],
+)
+
+LLM_ATTEMPTS = Counter(
+    "llm_attempts_total",
+    "Individual LLM call attempts (including retries and hedges) by outcome",
+    ["mode", "outcome"],
+)
+LLM_RETRIES = Counter(
+    "llm_retries_total",
+    "LLM call retries after a retryable error or timeout",
+    ["mode"],
+)
+LLM_HEDGES = Counter(
+    "llm_hedges_total",
+    "Hedged LLM requests (fired: duplicate sent, won: duplicate answered first)",
+    ["mode", "result"],
+)
+LLM_DEADLINE_EXCEEDED = Counter(
+    "llm_deadline_exceeded_total",
+    "LLM calls that gave up because the per-mode deadline passed",
+    ["mode"],
+)
+LLM_CIRCUIT_TRANSITIONS = Counter(
+    "llm_circuit_transitions_total",
+    "Circuit breaker state transitions",
+    ["state"],
+)
+
+HISTORY_READS = Counter(
+    "chat_history_reads_total",
+    "Conversation history reads from the database by engine (primary: write engine, replica: read engine)",
+    ["target"],
+)
+
+CHAT_DEDUPLICATED = Counter(
+    "chat_deduplicated_requests_total",
+    "Duplicate chat requests served from another request's in-flight (joined) or just-completed (replayed) result",
+    ["mode", "kind"],
+)
+
+LLM_ROUTES = Counter(
+    "llm_routes_total",
+    "Model routing decisions by matched rule and chosen model",
+    ["mode", "route", "model"],
+)
+
+@contextmanager
+def observe_stage(mode: str, stage: str) -> Iterator[None]:
+    """
+    with ブロックの所要時間を段階別に記録する。例外が出た場合はエラーとして数えて再送出する。
+    取り消された場合（クライアントの切断）は取り消しとして数える。
+    """
+    started = time.perf_counter()
+    try:
+        yield
+    except asyncio.CancelledError:
+        CHAT_STAGE_CANCELLED.labels(mode=mode, stage=stage).inc()
+        raise
+    except Exception:
+        CHAT_STAGE_ERRORS.labels(mode=mode, stage=stage).inc()
+        raise
+    finally:
+        CHAT_STAGE_DURATION.labels(mode=mode, stage=stage).observe(time.perf_counter() - started)
+
+class RequestOutcome:
+    """track_request() が返す、リクエストの成否を表すオブジェクト"""
+
+    def __init__(self):
+        self.outcome = "success"
+
+    def mark_error(self) -> None:
+        """例外を送出せずに処理したエラー（ストリームの error イベントなど）を失敗として記録する"""
+        self.outcome = "error"
+
+    def mark_cancelled(self) -> None:
+        """クライアントの切断で処理を取り消したことを記録する"""
+        self.outcome = "cancelled"
+
+@contextmanager
+def track_request(mode: str, stream: bool = False) -> Iterator[RequestOutcome]:
+    """リクエスト全体の所要時間・処理中の件数・成否を記録する"""
+    stream_label = "true" if stream else "false"
+    CHAT_IN_FLIGHT.labels(mode=mode).inc()
+    started = time.perf_counter()
+    result = RequestOutcome()
+    try:
+        yield result
+    except (asyncio.CancelledError, ClientDisconnected):
+        result.mark_cancelled()
+        raise
+    except BaseException:
+        result.mark_error()
+        raise
+    finally:
+        CHAT_IN_FLIGHT.labels(mode=mode).dec()
+        CHAT_REQUEST_DURATION.labels(mode=mode, stream=stream_label).observe(time.perf_counter() - started)
+        CHAT_REQUESTS.labels(mode=mode, stream=stream_label, outcome=result.outcome).inc()
+
+class StatsCollector:
+    """
+    stats() で集計値を返すオブジェクト（履歴キャッシュ、類似問題プールなど）を
+    スクレイプのたびに読み取ってメトリクスとして公開するコレクター。
+    hits / misses / evictions はカウンター、それ以外はゲージとして扱う。
+    """
+
+    COUNTER_KEYS = {"hits", "misses", "evictions"}
+
+    def __init__(self, prefix: str, stats: Callable[[], Dict[str, int]]):
+        self._prefix = prefix
+        self._stats = stats
+
+    def collect(self):
+        for key, value in self._stats().items():
+            name = f"{self._prefix}_{key}"
+            if key in self.COUNTER_KEYS:
+                yield CounterMetricFamily(name, f"{self._prefix} {key}", value=value)
+            else:
+                yield GaugeMetricFamily(name, f"{self._prefix} {key}", value=value)
+
+def register_stats(prefix: str, stats: Callable[[], Dict[str, int]]) -> None:
+    """stats() を返すオブジェクトを /metrics に公開する"""
+    REGISTRY.register(StatsCollector(prefix, stats))
+
+def render_metrics() -> bytes:
+    """Prometheus のテキスト形式でメトリクスを出力する"""
+    return generate_latest(REGISTRY)
+
+METRICS_CONTENT_TYPE = CONTENT_TYPE_LATEST
@@ -0,0 +1,31 @@
+# app/core/sharding.py
+# 会話IDからワーカーを決める（マルチワーカー起動時の会話アフィニティ）
+# 履歴キャッシュなどのプロセス内の状態を活かすため、同じ会話のリクエストは常に同じワーカーで処理する。
+#
+# キーは conversation_id (整数)、関数は Jump Consistent Hash (Lamping & Veach, 2014)。
+# ワーカー数を N → N+1 に増やしても、移動する会話は約 1/(N+1) で済む。
+# 外部のロードバランサーで振り分ける場合も、この関数と同じ計算をすれば同じワーカーに届く。
+import hashlib
+
+_MASK_64 = 0xFFFFFFFFFFFFFFFF
+
+def jump_consistent_hash(key: int, buckets: int) -> int:
+    """64ビットの key を 0..buckets-1 のいずれかに割り当てる"""
+    if buckets <= 0:
+        raise ValueError("buckets must be positive")
+    key &= _MASK_64
+    bucket, candidate = -1, 0
+    while candidate < buckets:
+        bucket = candidate
+        key = (key * 2862933555777941757 + 1) & _MASK_64
+        candidate = int((bucket + 1) * (float(1 << 31) / float((key >> 33) + 1)))
+    return bucket
+
+def worker_for_conversation(conversation_id: int, workers: int) -> int:
+    """conversation_id を処理するワーカーの番号 (0始まり)"""
+    return jump_consistent_hash(conversation_id, workers)
+
+def worker_for_key(key: str, workers: int) -> int:
+    """文字列のキー (Idempotency-Key など) を処理するワーカーの番号 (0始まり)"""
+    digest = hashlib.sha256(key.encode("utf-8")).digest()
+    return jump_consistent_hash(int.from_bytes(digest[:8], "big"), workers)
@@ -0,0 +1,221 @@
+# app/db/archive.py
+# 終わった会話の圧縮アーカイブ（コールドストレージ）
+# 理解度評価モードの応答は数KBのレポートになるため、messages テーブルと索引が速く大きくなる。
+# 一定期間やりとりのない会話は、メッセージ一覧をまとめて圧縮し archived_conversations の1行に移す。
+# アーカイブ済みの会話も履歴の読み込み (crud.get_conversation_history_async) で透過的に復元される。
+import datetime
+import json
+import logging
+import os
+import zlib
+from dataclasses import asdict, dataclass
+from typing import List, Optional, Sequence
+
+from sqlalchemy import delete, func, or_, select, update
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from .database import async_engine
+from .models import ArchivedConversation, Conversation, EvaluationScore, Message
+
+try:
+    import zstandard
+except ImportError: # zstd は任意。入っていなければ zlib を使う
+    zstandard = None
+
+logger = logging.getLogger(__name__)
+
+# 圧縮方式: "zlib" / "zstd" (zstandard パッケージが必要)
+HISTORY_ARCHIVE_CODEC = os.getenv("HISTORY_ARCHIVE_CODEC", "zlib")
+# 最後のメッセージからこの日数を過ぎた会話をアーカイブする
+HISTORY_ARCHIVE_IDLE_DAYS = float(os.getenv("HISTORY_ARCHIVE_IDLE_DAYS", "30"))
+# アーカイブ済みの会話が再開されたとき、メッセージを messages テーブルに戻すか
+HISTORY_ARCHIVE_REWARM = os.getenv("HISTORY_ARCHIVE_REWARM", "false").lower() == "true"
+
+CODEC_ZLIB = "zlib"
+CODEC_ZSTD = "zstd"
+
+def _compress(data: bytes, codec: str) -> bytes:
+    if codec == CODEC_ZSTD:
+        if zstandard is None:
+            raise RuntimeError("HISTORY_ARCHIVE_CODEC=zstd requires the zstandard package")
+        return zstandard.ZstdCompressor(level=10).compress(data)
+    if codec == CODEC_ZLIB:
+        return zlib.compress(data, 9)
+    raise ValueError(f"Unknown archive codec: {codec}")
+
+def _decompress(data: bytes, codec: str) -> bytes:
+    if codec == CODEC_ZSTD:
+        if zstandard is None:
+            raise RuntimeError("Reading a zstd archive requires the zstandard package")
+        return zstandard.ZstdDecompressor().decompress(data)
+    if codec == CODEC_ZLIB:
+        return zlib.decompress(data)
+    raise ValueError(f"Unknown archive codec: {codec}")
+
+def encode_messages(messages: Sequence[Message], codec: str = HISTORY_ARCHIVE_CODEC) -> bytes:
+    """メッセージ一覧を [seq, role, content, created_at] の JSON 配列にして圧縮する"""
+    rows = [
+        [m.seq, m.role, m.content, m.created_at.isoformat() if m.created_at else None]
+        for m in messages
+    ]
+    return _compress(json.dumps(rows, ensure_ascii=False, separators=(",", ":")).encode("utf-8"), codec)
+
+def decode_messages(conversation_id: int, payload: bytes, codec: str) -> List[Message]:
+    """encode_messages の逆。セッションに追加していない Message を seq 順に返す"""
+    rows = json.loads(_decompress(payload, codec))
+    return [
+        Message(
+            conversation_id=conversation_id,
+            seq=seq,
+            role=role,
+            content=content,
+            created_at=datetime.datetime.fromisoformat(created_at) if created_at else None,
+        )
+        for seq, role, content, created_at in rows
+    ]
+
+def _content_bytes(messages: Sequence[Message]) -> int:
+    return sum(len((m.content or "").encode("utf-8")) for m in messages)
+
+async def load_archived_messages(db: AsyncSession, conversation_id: int) -> List[Message]:
+    """
+    アーカイブ済みのメッセージを復元して返す（アーカイブがなければ空）。
+    HISTORY_ARCHIVE_REWARM が有効なら、メッセージを messages テーブルに戻してアーカイブを削除する。
+    """
+    archived = await db.get(ArchivedConversation, conversation_id)
+    if archived is None:
+        return []
+    messages = decode_messages(conversation_id, archived.payload, archived.codec)
+    logger.info("Rehydrated archived conversation %d (%d messages)", conversation_id, len(messages))
+    # 読み取り用エンジン（レプリカ）のセッションには書き込めないので、書き込み用のセッションでだけ戻す
+    if HISTORY_ARCHIVE_REWARM and db.bind is async_engine:
+        await _restore(db, archived, messages)
+    return messages
+
+async def _restore(db: AsyncSession, archived: ArchivedConversation, messages: List[Message]) -> None:
+    try:
+        # 返す Message とは別のオブジェクトとして追加する（呼び出し元がセッションの状態に左右されないように）
+        db.add_all([
+            Message(conversation_id=m.conversation_id, seq=m.seq, role=m.role, content=m.content, created_at=m.created_at)
+            for m in messages
+        ])
+        await db.flush()
+        await _link_evaluations(db, archived.conversation_id)
+        await db.delete(archived)
+        conversation = await db.get(Conversation, archived.conversation_id)
+        if conversation is not None:
+            conversation.archived_at = None
+        await db.commit()
+    except Exception:
+        await db.rollback()
+        # 戻せなくても履歴は返せるので、読み込み自体は失敗させない
+        logger.exception("Failed to re-warm archived conversation %d", archived.conversation_id)
+
+async def _link_evaluations(db: AsyncSession, conversation_id: int) -> None:
+    """戻したメッセージ（新しい id）に、会話内の位置 (message_seq) で点数を結び付け直す"""
+    message_id = (
+        select(Message.id)
+        .where(Message.conversation_id == EvaluationScore.conversation_id, Message.seq == EvaluationScore.message_seq)
+        .scalar_subquery()
+    )
+    await db.execute(
+        update(EvaluationScore)
+        .where(EvaluationScore.conversation_id == conversation_id)
+        .values(message_id=message_id)
+        .execution_options(synchronize_session=False)
+    )
+
+@dataclass
+class ArchiveReport:
+    conversations: int = 0    # アーカイブした会話数
+    rows_moved: int = 0       # messages テーブルから移したメッセージ数
+    original_bytes: int = 0   # 移したメッセージ本文のバイト数（圧縮前）
+    compressed_bytes: int = 0 # 移した会話の圧縮後のバイト数
+
+    @property
+    def bytes_saved(self) -> int:
+        return self.original_bytes - self.compressed_bytes
+
+    def as_dict(self) -> dict:
+        return {**asdict(self), "bytes_saved": self.bytes_saved}
+
+async def archive_idle_conversations(
+    db: AsyncSession,
+    idle_days: float = HISTORY_ARCHIVE_IDLE_DAYS,
+    batch_size: int = 100,
+    limit: Optional[int] = None,
+    codec: str = HISTORY_ARCHIVE_CODEC,
+) -> ArchiveReport:
+    """
+    最後のメッセージから idle_days 日を過ぎた会話をアーカイブする。
+    batch_size 件の会話ごとに1トランザクションでコミットするので、途中で止めても続きから再実行できる。
+    一度アーカイブした会話に後からメッセージが増えた場合は、既存のアーカイブとまとめて圧縮し直す。
+    """
+    cutoff = datetime.datetime.now(datetime.timezone.utc) - datetime.timedelta(days=idle_days)
+    report = ArchiveReport()
+    while limit is None or report.conversations < limit:
+        size = batch_size if limit is None else min(batch_size, limit - report.conversations)
+        result = await db.execute(
+            select(Conversation.id)
+            .where(
+                Conversation.last_message_at < cutoff,
+                Conversation.message_count > 0,
+                or_(Conversation.archived_at.is_(None), Conversation.archived_at < Conversation.last_message_at),
+            )
+            .order_by(Conversation.last_message_at)
+            .limit(size)
+        )
+        conversation_ids = list(result.scalars().all())
+        if not conversation_ids:
+            break
+        try:
+            for conversation_id in conversation_ids:
+                await _archive_conversation(db, conversation_id, codec, report)
+            await db.commit()
+        except Exception:
+            await db.rollback()
+            raise
+        logger.info("Archived %d conversations so far (%d rows, %d bytes saved)",
+                    report.conversations, report.rows_moved, report.bytes_saved)
+    return report
+
+async def _archive_conversation(db: AsyncSession, conversation_id: int, codec: str, report: ArchiveReport) -> None:
+    result = await db.execute(
+        select(Message).where(Message.conversation_id == conversation_id).order_by(Message.seq)
+    )
+    live = list(result.scalars().all())
+    archived = await db.get(ArchivedConversation, conversation_id)
+    earlier = decode_messages(conversation_id, archived.payload, archived.codec) if archived else []
+    messages = earlier + live
+
+    payload = encode_messages(messages, codec)
+    if archived is None:
+        archived = ArchivedConversation(conversation_id=conversation_id)
+        db.add(archived)
+        previous_compressed = 0
+    else:
+        previous_compressed = archived.compressed_bytes
+    archived.codec = codec
+    archived.payload = payload
+    archived.message_count = len(messages)
+    archived.original_bytes = _content_bytes(messages)
+    archived.compressed_bytes = len(payload)
+    archived.archived_at = func.now()
+
+    # 点数は message_seq で位置を持っているので、消すメッセージへの参照だけ外す
+    # （SQLite は外部キーの ON DELETE SET NULL を既定で効かせないため、DB任せにしない。戻すときに _link_evaluations で付け直す）
+    await db.execute(
+        update(EvaluationScore)
+        .where(EvaluationScore.conversation_id == conversation_id, EvaluationScore.message_id.is_not(None))
+        .values(message_id=None)
+        .execution_options(synchronize_session=False)
+    )
+    await db.execute(delete(Message).where(Message.conversation_id == conversation_id))
+    conversation = await db.get(Conversation, conversation_id)
+    conversation.archived_at = func.now()
+
+    report.conversations += 1
+    report.rows_moved += len(live)
+    report.original_bytes += _content_bytes(live)
+    # 圧縮し直した場合は、増えた分だけを数える
+    report.compressed_bytes += len(payload) - previous_compressed
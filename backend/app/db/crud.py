@@ -1,8 +1,20 @@
 # app/db/crud.py
-from sqlalchemy.orm import Session
-from .models import Conversation, Message # 定義したモデルをインポート
+from sqlalchemy import func, select, update
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.orm import Session, selectinload
+from .models import Conversation, ConversationSummary, EvaluationScore, LearnerProgress, LearnerSubjectProgress, Message # 定義したモデルをインポート
+from .archive import load_archived_messages
+from .progress import record_evaluations_async
+from .read_routing import write_stamps
 from app.models.chat_models import ChatMessage # アプリケーション層のモデルも必要に応じて使用
-from typing import List, Optional
+from typing import Dict, List, NamedTuple, Optional, Sequence, Tuple
+
+class ConversationNotFound(LookupError):
+    """指定した会話IDの会話が存在しない（クライアントが古い・誤った会話IDを送った）"""
+
+    def __init__(self, conversation_id: int):
+        super().__init__(f"Conversation {conversation_id} not found")
+        self.conversation_id = conversation_id
 
 # 会話を作成
 def create_conversation(db: Session) -> Conversation:
@@ -13,18 +25,47 @@ def create_conversation(db: Session) -> Conversation:
     db.refresh(db_conversation) # DBの状態を反映
     return db_conversation
 
+# --- メッセージの通し番号 (seq) ---
+# 会話の message_count を加算した結果を seq の採番に使う。
+# UPDATE は会話の行をロックするので、同じ会話に同時に書き込んでも seq は重複しない。
+# 更新した行がなければ（会話が存在しなければ）ConversationNotFound を送出する。
+
+def _reserve_seq_statement(conversation_id: int, count: int):
+    return (
+        update(Conversation)
+        .where(Conversation.id == conversation_id)
+        .values(message_count=Conversation.message_count + count, last_message_at=func.now())
+        .returning(Conversation.message_count)
+    )
+
+def _reserve_seq(db: Session, conversation_id: int, count: int) -> int:
+    """会話に count 件のメッセージを追加するための seq を確保し、先頭の seq を返す"""
+    message_count = db.execute(_reserve_seq_statement(conversation_id, count)).scalar_one_or_none()
+    if message_count is None:
+        raise ConversationNotFound(conversation_id)
+    return message_count - count + 1
+
+async def _reserve_seq_async(db: AsyncSession, conversation_id: int, count: int) -> int:
+    """会話に count 件のメッセージを追加するための seq を確保し、先頭の seq を返す（非同期版）"""
+    message_count = (await db.execute(_reserve_seq_statement(conversation_id, count))).scalar_one_or_none()
+    if message_count is None:
+        raise ConversationNotFound(conversation_id)
+    return message_count - count + 1
+
 # メッセージを作成し、会話に追加
 def create_message(db: Session, conversation_id: int, role: str, content: str) -> Message:
     """指定した会話に新しいメッセージを追加する"""
-    db_message = Message(conversation_id=conversation_id, role=role, content=content)
+    seq = _reserve_seq(db, conversation_id, 1)
+    db_message = Message(conversation_id=conversation_id, seq=seq, role=role, content=content)
     db.add(db_message)
     db.commit()
+    write_stamps.mark(conversation_id)
     db.refresh(db_message)
     return db_message
 
 # 会話履歴を取得
 def get_conversation_history(db: Session, conversation_id: int) -> List[Message]:
-    """指定した会話IDのメッセージ履歴を作成日時順に取得する"""
+    """指定した会話IDのメッセージ履歴を会話内の順序 (seq) で取得する"""
     # Conversation モデルを使ってリレーションシップからメッセージを取得することも可能
     # conversation = db.query(Conversation).filter(Conversation.id == conversation_id).first()
     # if conversation:
@@ -32,7 +73,7 @@ def get_conversation_history(db: Session, conversation_id: int) -> List[Message]
     #     return sorted(conversation.messages, key=lambda msg: msg.created_at)
 
     # シンプルにMessageテーブルから取得
-    messages = db.query(Message).filter(Message.conversation_id == conversation_id).order_by(Message.created_at).all()
+    messages = db.query(Message).filter(Message.conversation_id == conversation_id).order_by(Message.seq).all()
     return messages
 
 # Message モデルのリストを ChatMessage モデルのリストに変換するヘルパー
@@ -40,6 +81,267 @@ def messages_to_chat_messages(messages: List[Message]) -> List[ChatMessage]:
     """DBのMessageオブジェクトのリストを、アプリケーションのChatMessageオブジェクトのリストに変換する"""
     return [ChatMessage(role=msg.role, content=msg.content) for msg in messages]
 
+# --- 非同期版 (APIのリクエスト処理用) ---
+# 処理内容は上の同期版と同じ。AsyncSession を受け取り、DBアクセスを await する。
+
+async def create_conversation_async(db: AsyncSession, learner_id: Optional[str] = None) -> Conversation:
+    """新しい会話を作成し、DBに保存する（非同期版）"""
+    db_conversation = Conversation(learner_id=learner_id)
+    db.add(db_conversation)
+    await db.commit()
+    await db.refresh(db_conversation)
+    write_stamps.mark(db_conversation.id)
+    return db_conversation
+
+async def create_message_async(db: AsyncSession, conversation_id: int, role: str, content: str) -> Message:
+    """指定した会話に新しいメッセージを追加する（非同期版）"""
+    seq = await _reserve_seq_async(db, conversation_id, 1)
+    db_message = Message(conversation_id=conversation_id, seq=seq, role=role, content=content)
+    db.add(db_message)
+    await db.commit()
+    write_stamps.mark(conversation_id)
+    await db.refresh(db_message)
+    return db_message
+
+async def get_conversation_history_async(
+    db: AsyncSession,
+    conversation_id: int,
+    limit: Optional[int] = None,
+) -> List[Message]:
+    """
+    指定した会話IDのメッセージ履歴を会話内の順序 (seq) で取得する（非同期版）。
+    limit を指定すると直近 limit 件だけを返す。
+    どちらも (conversation_id, seq) の索引の範囲走査で済み、並べ替えは発生しない。
+    圧縮アーカイブに移したメッセージも透過的に復元して含める。
+    """
+    if limit is None:
+        result = await db.execute(
+            select(Message)
+            .where(Message.conversation_id == conversation_id)
+            .order_by(Message.seq)
+        )
+        messages = list(result.scalars().all())
+    else:
+        # 索引を後ろから limit 件だけ読み、古い順に並べ直す
+        result = await db.execute(
+            select(Message)
+            .where(Message.conversation_id == conversation_id)
+            .order_by(Message.seq.desc())
+            .limit(limit)
+        )
+        messages = list(reversed(result.scalars().all()))
+
+    # seq は 1 から欠番なく振られるので、先頭が 1 でなければそれより前はアーカイブにある
+    # （アーカイブされていない会話では追加のクエリは発生しない）
+    if (limit is None or len(messages) < limit) and (not messages or messages[0].seq > 1):
+        first_live_seq = messages[0].seq if messages else None
+        archived = [
+            m for m in await load_archived_messages(db, conversation_id)
+            if first_live_seq is None or m.seq < first_live_seq
+        ]
+        if limit is not None:
+            archived = archived[-(limit - len(messages)):]
+        messages = archived + messages
+    return messages
+
+# --- ターン単位の保存 (Unit of Work) ---
+# 1ターン = (会話の作成) + ユーザーの質問 + AIの応答。
+# 上の create_* を順に呼ぶと commit/refresh が最大3回発生するため、
+# ターン全体を1トランザクション・1コミットで書き込む。
+# コミットした会話は write_stamps に記録し、直後の履歴読み込みを書き込み用のセッションで行わせる (read_routing.py)。
+
+class TurnRecord(NamedTuple):
+    """既存の会話への1ターン分の書き込み"""
+    conversation_id: int
+    user_content: str # ユーザーの質問
+    assistant_content: str # AIの応答
+    evaluation: Optional[EvaluationScore] = None # AIの応答から取り出した理解度評価の点数（あれば）
+
+def _turn_messages(
+    conversation_id: int,
+    seq: int,
+    user_content: str,
+    assistant_content: str,
+    evaluation: Optional[EvaluationScore] = None,
+) -> List[Message]:
+    """1ターン分のメッセージ (seq, seq + 1) を作る。evaluation は AI の応答に結び付ける"""
+    assistant_message = Message(conversation_id=conversation_id, seq=seq + 1, role="assistant", content=assistant_content)
+    if evaluation is not None:
+        evaluation.conversation_id = conversation_id
+        evaluation.message_seq = seq + 1
+        evaluation.message = assistant_message
+    return [
+        Message(conversation_id=conversation_id, seq=seq, role="user", content=user_content),
+        assistant_message,
+    ]
+
+async def save_turn_async(
+    db: AsyncSession,
+    conversation_id: Optional[int],
+    user_content: str,
+    assistant_content: str,
+    evaluation: Optional[EvaluationScore] = None,
+    learner_id: Optional[str] = None,
+) -> int:
+    """
+    1ターン分の会話を1トランザクションで保存し、会話IDを返す。
+    conversation_id が None の場合は会話も同じトランザクション内で作成する（learner_id はその会話の生徒）。
+    evaluation (理解度評価の点数) を渡すと、AIの応答に結び付けて同じトランザクションで保存し、
+    生徒の進み具合の集計 (progress.py) にも反映する。
+    """
+    try:
+        if conversation_id is None:
+            # 新しい会話は seq が 1, 2 と決まっているので、集計値も作成時に入れておく
+            db_conversation = Conversation(learner_id=learner_id, message_count=2, last_message_at=func.now())
+            db.add(db_conversation)
+            await db.flush() # INSERT して ID を採番（コミットはまだしない）
+            conversation_id = db_conversation.id
+            seq = 1
+        else:
+            seq = await _reserve_seq_async(db, conversation_id, 2)
+        db.add_all(_turn_messages(conversation_id, seq, user_content, assistant_content, evaluation))
+        if evaluation is not None:
+            await record_evaluations_async(db, [evaluation])
+        await db.commit()
+    except Exception:
+        await db.rollback()
+        raise
+    write_stamps.mark(conversation_id)
+    return conversation_id
+
+async def save_turns_async(db: AsyncSession, turns: Sequence[TurnRecord]) -> None:
+    """複数ターン（複数の会話にまたがってよい）を1トランザクションでまとめて保存する"""
+    try:
+        conversation_ids = await _add_turns(db, turns)
+        await record_evaluations_async(db, [turn.evaluation for turn in turns if turn.evaluation is not None])
+        await db.commit()
+    except Exception:
+        await db.rollback()
+        raise
+    for conversation_id in conversation_ids:
+        write_stamps.mark(conversation_id)
+
+class LearnerTurnRecord(NamedTuple):
+    """生徒ごとの1ターン分の書き込み（一括評価など）"""
+    conversation_id: Optional[int] # 新しい会話なら None
+    learner_id: Optional[str] # 生徒の識別子
+    user_content: str
+    assistant_content: str
+    evaluation: Optional[EvaluationScore] = None
+
+async def save_learner_turns_async(db: AsyncSession, turns: Sequence[LearnerTurnRecord]) -> List[int]:
+    """
+    生徒ごとのターンを1トランザクションでまとめて保存し、各ターンの会話IDを turns と同じ順で返す。
+    conversation_id が None のターンは、生徒の識別子を付けた会話を同じトランザクション内で作成する。
+    """
+    try:
+        new_conversations = {
+            index: Conversation(learner_id=turn.learner_id, message_count=2, last_message_at=func.now())
+            for index, turn in enumerate(turns)
+            if turn.conversation_id is None
+        }
+        db.add_all(new_conversations.values())
+        await db.flush() # まとめて INSERT して ID を採番
+        conversation_ids = [
+            new_conversations[index].id if index in new_conversations else turn.conversation_id
+            for index, turn in enumerate(turns)
+        ]
+        existing: List[TurnRecord] = []
+        for index, turn in enumerate(turns):
+            if index in new_conversations:
+                db.add_all(_turn_messages(conversation_ids[index], 1, turn.user_content, turn.assistant_content, turn.evaluation))
+            else:
+                existing.append(TurnRecord(turn.conversation_id, turn.user_content, turn.assistant_content, turn.evaluation))
+        await _add_turns(db, existing)
+        await record_evaluations_async(db, [turn.evaluation for turn in turns if turn.evaluation is not None])
+        await db.commit()
+    except Exception:
+        await db.rollback()
+        raise
+    for conversation_id in set(conversation_ids):
+        write_stamps.mark(conversation_id)
+    return conversation_ids
+
+async def conversation_exists_async(db: AsyncSession, conversation_id: int) -> bool:
+    result = await db.execute(select(Conversation.id).where(Conversation.id == conversation_id))
+    return result.scalar_one_or_none() is not None
+
+async def get_conversation_learners_async(db: AsyncSession, conversation_ids: Sequence[int]) -> Dict[int, Optional[str]]:
+    """存在する会話について 会話ID → 生徒の識別子 を返す（存在しない会話IDは含まれない）"""
+    if not conversation_ids:
+        return {}
+    result = await db.execute(
+        select(Conversation.id, Conversation.learner_id).where(Conversation.id.in_(set(conversation_ids)))
+    )
+    return dict(result.all())
+
+async def _add_turns(db: AsyncSession, turns: Sequence[TurnRecord]) -> List[int]:
+    """既存の会話へのターンをセッションに追加し（コミットはしない）、対象の会話IDを返す"""
+    # seq の確保は会話ごとに1回の UPDATE にまとめる
+    message_counts: Dict[int, int] = {}
+    for turn in turns:
+        message_counts[turn.conversation_id] = message_counts.get(turn.conversation_id, 0) + 2
+    next_seqs = {
+        conversation_id: await _reserve_seq_async(db, conversation_id, count)
+        for conversation_id, count in message_counts.items()
+    }
+    for turn in turns:
+        seq = next_seqs[turn.conversation_id]
+        next_seqs[turn.conversation_id] = seq + 2
+        db.add_all(_turn_messages(turn.conversation_id, seq, turn.user_content, turn.assistant_content, turn.evaluation))
+    return list(next_seqs)
+
+# --- 理解度評価の点数 ---
+
+async def get_recent_evaluation_scores_async(db: AsyncSession, conversation_id: int, limit: int) -> List[EvaluationScore]:
+    """会話の直近 limit 件の評価を古い順に返す（教科別の点数も読み込む）"""
+    result = await db.execute(
+        select(EvaluationScore)
+        .where(EvaluationScore.conversation_id == conversation_id)
+        .order_by(EvaluationScore.id.desc())
+        .limit(limit)
+        .options(selectinload(EvaluationScore.subjects))
+    )
+    return list(reversed(result.scalars().all()))
+
+# --- 学習の進み具合の集計 ---
+
+async def get_learner_progress_async(
+    db: AsyncSession, learner_id: str
+) -> Tuple[Optional[LearnerProgress], List[LearnerSubjectProgress]]:
+    """生徒の集計行と教科別の集計行を返す（どちらも主キーでの読み込み）"""
+    progress = await db.get(LearnerProgress, learner_id)
+    if progress is None:
+        return None, []
+    result = await db.execute(
+        select(LearnerSubjectProgress)
+        .where(LearnerSubjectProgress.learner_id == learner_id)
+        .order_by(LearnerSubjectProgress.subject)
+    )
+    return progress, list(result.scalars().all())
+
+# --- 会話要約 ---
+
+async def get_conversation_summary_async(db: AsyncSession, conversation_id: int) -> Optional[ConversationSummary]:
+    """会話の要約を取得する（まだ要約されていなければ None）"""
+    return await db.get(ConversationSummary, conversation_id)
+
+async def save_conversation_summary_async(
+    db: AsyncSession,
+    conversation_id: int,
+    summary: str,
+    summarized_message_count: int,
+) -> ConversationSummary:
+    """会話の要約を作成または更新する"""
+    db_summary = await db.get(ConversationSummary, conversation_id)
+    if db_summary is None:
+        db_summary = ConversationSummary(conversation_id=conversation_id)
+        db.add(db_summary)
+    db_summary.summary = summary
+    db_summary.summarized_message_count = summarized_message_count
+    await db.commit()
+    return db_summary
+
 # 他にも、特定の会話を取得する関数や、会話を削除する関数などをここに追加できます
 # def get_conversation(db: Session, conversation_id: int) -> Optional[Conversation]:
 #     return db.query(Conversation).filter(Conversation.id == conversation_id).first()
@@ -1,5 +1,7 @@
 # app/db/database.py
 from sqlalchemy import create_engine
+from sqlalchemy.engine import make_url
+from sqlalchemy.ext.asyncio import AsyncSession, async_sessionmaker, create_async_engine
 from sqlalchemy.orm import sessionmaker, declarative_base
 import os # 環境変数を読むため
 
@@ -32,6 +34,95 @@ engine = create_engine(
 # autocommit=False, autoflush=False で、明示的にコミットするまで変更を保留
 SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
 
+# --- 非同期エンジン (APIのリクエスト処理用) ---
+# 同期 Session のままだと、DBアクセス中はイベントループ全体が止まってしまうため、
+# async def のエンドポイントからは非同期セッションを使う。
+# ドライバ: SQLite → aiosqlite, PostgreSQL → asyncpg
+ASYNC_DRIVERS = {
+    "sqlite": "sqlite+aiosqlite",
+    "postgresql": "postgresql+asyncpg",
+    "postgres": "postgresql+asyncpg",
+}
+
+def to_async_database_url(url: str) -> str:
+    """同期用のDB URLを、対応する非同期ドライバのURLに変換する"""
+    parsed = make_url(url)
+    backend = parsed.get_backend_name()
+    if backend not in ASYNC_DRIVERS:
+        raise ValueError(f"Unsupported database for async engine: {backend}")
+    return parsed.set(drivername=ASYNC_DRIVERS[backend]).render_as_string(hide_password=False)
+
+# ASYNC_DATABASE_URL が指定されていればそれを優先し、なければ DATABASE_URL から組み立てる
+SQLALCHEMY_ASYNC_DATABASE_URL = os.getenv(
+    "ASYNC_DATABASE_URL", to_async_database_url(SQLALCHEMY_DATABASE_URL)
+)
+
+# --- 読み取り用エンジン (履歴の読み込み用) ---
+# DATABASE_READ_URL を指定すると、会話履歴の読み込みをそちら（レプリカなど）に振り分ける。
+# 未指定なら書き込み用と同じエンジンを使う。
+# ローカルでは SQLite のファイルを2つ（本体とそのコピー）指定すれば試せる。
+SQLALCHEMY_READ_DATABASE_URL = os.getenv("DATABASE_READ_URL")
+SQLALCHEMY_ASYNC_READ_DATABASE_URL = os.getenv(
+    "ASYNC_DATABASE_READ_URL",
+    to_async_database_url(SQLALCHEMY_READ_DATABASE_URL) if SQLALCHEMY_READ_DATABASE_URL else None,
+)
+
+def pool_options(prefix: str) -> dict:
+    """
+    接続プールの設定を環境変数 {prefix}_POOL_SIZE などから読む（読み取り用・書き込み用で別々に設定できる）。
+    指定のない項目は SQLAlchemy の既定値のまま。
+    """
+    options = {}
+    for option, env_suffix, cast in (
+        ("pool_size", "POOL_SIZE", int),
+        ("max_overflow", "MAX_OVERFLOW", int),
+        ("pool_timeout", "POOL_TIMEOUT_SECONDS", float),
+        ("pool_recycle", "POOL_RECYCLE_SECONDS", int),
+    ):
+        value = os.getenv(f"{prefix}_{env_suffix}")
+        if value is not None:
+            options[option] = cast(value)
+    pre_ping = os.getenv(f"{prefix}_POOL_PRE_PING")
+    if pre_ping is not None:
+        options["pool_pre_ping"] = pre_ping.lower() == "true"
+    return options
+
+async_engine = create_async_engine(
+    SQLALCHEMY_ASYNC_DATABASE_URL,
+    echo=False, # デバッグ時はTrueに
+    **pool_options("DB_WRITE"),
+)
+
+async_read_engine = (
+    create_async_engine(
+        SQLALCHEMY_ASYNC_READ_DATABASE_URL,
+        echo=False, # デバッグ時はTrueに
+        **pool_options("DB_READ"),
+    )
+    if SQLALCHEMY_ASYNC_READ_DATABASE_URL
+    else async_engine
+)
+
+# 読み取り用のエンジンが書き込み用と別か（False なら読み込みもすべて書き込み用で行う）
+READ_ENGINE_SEPARATE = async_read_engine is not async_engine
+
+# 非同期セッションのファクトリ
+# expire_on_commit=False: コミット後に属性へアクセスしても再読み込み (暗黙のI/O) が走らないようにする
+AsyncSessionLocal = async_sessionmaker(
+    bind=async_engine,
+    class_=AsyncSession,
+    autoflush=False,
+    expire_on_commit=False,
+)
+
+# 読み取り用の非同期セッションのファクトリ（書き込みには使わない）
+AsyncReadSessionLocal = async_sessionmaker(
+    bind=async_read_engine,
+    class_=AsyncSession,
+    autoflush=False,
+    expire_on_commit=False,
+)
+
 # ORMモデルのベースクラス
 # これを継承してテーブルクラスを定義します
 Base = declarative_base()
@@ -46,4 +137,19 @@ def get_db():
     try:
         yield db # セッションを呼び出し元に渡す
     finally:
-        db.close() # リクエスト処理後にセッションをクローズ
\ No newline at end of file
+        db.close() # リクエスト処理後にセッションをクローズ
+
+# FastAPIのDependsで使用する非同期DBセッション取得の依存性注入ヘルパー
+async def get_async_db():
+    """
+    リクエストごとに非同期データベースセッションを作成し、処理後にクローズする。
+    async def のエンドポイントからはこちらを使用する。
+    """
+    async with AsyncSessionLocal() as db:
+        yield db
+
+# 読み取り専用のエンドポイント（集計の参照など）で使う非同期DBセッション取得の依存性注入ヘルパー
+# 読み取り用エンジンがあればそちらを使う（直前の書き込みがまだ反映されていないことがある）
+async def get_async_read_db():
+    async with AsyncReadSessionLocal() as db:
+        yield db
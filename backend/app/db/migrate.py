@@ -0,0 +1,37 @@
+# app/db/migrate.py
+# DBスキーマを Alembic のマイグレーションで最新にする (create_tables.py から使う)
+import logging
+from pathlib import Path
+
+from alembic import command
+from alembic.config import Config
+from sqlalchemy import inspect
+
+from .database import engine
+
+logger = logging.getLogger(__name__)
+
+# backend/alembic.ini
+ALEMBIC_INI_PATH = Path(__file__).resolve().parents[2] / "alembic.ini"
+
+# create_all で作っていた頃のスキーマ (conversations / messages) に当たるリビジョン
+BASELINE_REVISION = "0001"
+
+def alembic_config() -> Config:
+    config = Config(str(ALEMBIC_INI_PATH))
+    # 実行ディレクトリによらず migrations/ を見つけられるようにする
+    config.set_main_option("script_location", str(ALEMBIC_INI_PATH.parent / "migrations"))
+    return config
+
+def upgrade_database(revision: str = "head") -> None:
+    """
+    DBスキーマを revision まで更新する。
+    create_all で作られたDB（テーブルはあるがマイグレーションの記録がない）は、
+    最初のリビジョンを適用済みとして記録してから続きを適用する。
+    """
+    config = alembic_config()
+    table_names = set(inspect(engine).get_table_names())
+    if "conversations" in table_names and "alembic_version" not in table_names:
+        logger.info("Existing tables without migration history; stamping revision %s", BASELINE_REVISION)
+        command.stamp(config, BASELINE_REVISION)
+    command.upgrade(config, revision)
@@ -1,5 +1,5 @@
 # app/db/models.py
-from sqlalchemy import Column, Integer, String, ForeignKey, DateTime, Text
+from sqlalchemy import Column, Integer, String, ForeignKey, DateTime, Text, Index, LargeBinary, JSON, Float
 from sqlalchemy.orm import relationship
 from sqlalchemy.sql import func # 現在時刻取得用
 from .database import Base # database.py で定義したBaseをインポート
@@ -10,21 +10,141 @@ class Conversation(Base):
 
     id = Column(Integer, primary_key=True, index=True) # 会話ID (主キー)
     created_at = Column(DateTime(timezone=True), server_default=func.now()) # 作成日時
+    learner_id = Column(String, nullable=True, index=True) # 生徒の識別子 (一括評価などで指定された場合のみ)
+    # 非正規化した集計値。メッセージを保存するトランザクションで一緒に更新する
+    # message_count は次に採番する seq の元にもなる（最後のメッセージの seq = message_count）
+    message_count = Column(Integer, nullable=False, default=0, server_default="0") # メッセージ数
+    last_message_at = Column(DateTime(timezone=True), nullable=True) # 最後のメッセージの保存日時
+    archived_at = Column(DateTime(timezone=True), nullable=True) # メッセージを圧縮アーカイブに移した日時
 
     # この会話に属するメッセージとのリレーションシップを定義
     # 'lazy="joined"' で会話取得時にメッセージも一緒に取得（オプション）
     # 'cascade="all, delete-orphan"' で会話削除時にメッセージも削除
     messages = relationship("Message", back_populates="conversation", cascade="all, delete-orphan")
+    # 古いターンを畳み込んだ要約（長い会話のみ作成される）
+    summary = relationship("ConversationSummary", back_populates="conversation", uselist=False, cascade="all, delete-orphan")
+    # 圧縮アーカイブに移したメッセージ（長くやりとりのない会話のみ作成される）
+    archive = relationship("ArchivedConversation", back_populates="conversation", uselist=False, cascade="all, delete-orphan")
 
 # メッセージテーブル
 class Message(Base):
     __tablename__ = "messages" # テーブル名
 
     id = Column(Integer, primary_key=True, index=True) # メッセージID (主キー)
-    conversation_id = Column(Integer, ForeignKey("conversations.id"), index=True) # 会話ID (外部キー)
-    role = Column(String, index=True) # 役割 (user, assistant/model など)
+    conversation_id = Column(Integer, ForeignKey("conversations.id"), nullable=False) # 会話ID (外部キー)
+    seq = Column(Integer, nullable=False) # 会話内の通し番号 (1始まり)。履歴の順序はこれで決める
+    role = Column(String) # 役割 (user, assistant/model など)
     content = Column(Text) # メッセージ本文 (長いテキスト用)
     created_at = Column(DateTime(timezone=True), server_default=func.now()) # 作成日時
 
     # 属している会話とのリレーションシップを定義
-    conversation = relationship("Conversation", back_populates="messages")
\ No newline at end of file
+    conversation = relationship("Conversation", back_populates="messages")
+    # 理解度評価の応答から取り出した点数（評価の応答のみ）
+    evaluation = relationship("EvaluationScore", back_populates="message", uselist=False, passive_deletes=True)
+
+    # 履歴の取得 (WHERE conversation_id = ? ORDER BY seq) と直近N件の取得を、この索引の範囲走査で済ませる。
+    # conversation_id 単独の索引はこの索引の先頭列で代用できるので作らない
+    __table_args__ = (
+        Index("ix_messages_conversation_id_seq", "conversation_id", "seq", unique=True),
+    )
+
+# 会話要約テーブル
+# 長い会話では古いターンをここに要約として畳み込み、AIには「要約 + 直近のターン」だけを渡す
+class ConversationSummary(Base):
+    __tablename__ = "conversation_summaries" # テーブル名
+
+    conversation_id = Column(Integer, ForeignKey("conversations.id"), primary_key=True) # 会話ID (主キー兼外部キー)
+    summary = Column(Text, nullable=False) # 要約本文
+    summarized_message_count = Column(Integer, nullable=False, default=0) # 会話の先頭から何件のメッセージを要約済みか
+    updated_at = Column(DateTime(timezone=True), server_default=func.now(), onupdate=func.now()) # 更新日時
+
+    conversation = relationship("Conversation", back_populates="summary")
+
+# 会話アーカイブテーブル
+# やりとりのなくなった会話のメッセージを、まとめて圧縮した1行として保存する (app/db/archive.py)
+# アーカイブ後に会話が再開された場合、新しいメッセージは messages テーブルに続きの seq で保存される
+class ArchivedConversation(Base):
+    __tablename__ = "archived_conversations" # テーブル名
+
+    conversation_id = Column(Integer, ForeignKey("conversations.id"), primary_key=True) # 会話ID (主キー兼外部キー)
+    codec = Column(String, nullable=False) # 圧縮方式 (zlib / zstd)
+    payload = Column(LargeBinary, nullable=False) # 圧縮したメッセージ一覧
+    message_count = Column(Integer, nullable=False) # アーカイブしたメッセージ数
+    original_bytes = Column(Integer, nullable=False) # メッセージ本文の圧縮前のバイト数
+    compressed_bytes = Column(Integer, nullable=False) # payload のバイト数
+    archived_at = Column(DateTime(timezone=True), server_default=func.now()) # アーカイブした日時
+
+    conversation = relationship("Conversation", back_populates="archive")
+
+# 理解度評価の点数テーブル
+# 理解度評価モードの応答に含まれる構造化データ (JSON) を取り出して保存する (app/services/evaluation_scores.py)
+# 「前回比」などを、過去の会話全体を読み直さずに点数の履歴だけから求められるようにする
+class EvaluationScore(Base):
+    __tablename__ = "evaluation_scores" # テーブル名
+
+    id = Column(Integer, primary_key=True) # 評価ID (主キー)
+    conversation_id = Column(Integer, ForeignKey("conversations.id"), nullable=False) # 会話ID
+    # 評価を含むAIの応答。メッセージがアーカイブに移ると NULL になり、戻すと seq で付け直す (app/db/archive.py)
+    message_id = Column(Integer, ForeignKey("messages.id", ondelete="SET NULL"), nullable=True, unique=True)
+    message_seq = Column(Integer, nullable=False) # AIの応答の seq
+    understanding = Column(Integer, nullable=True) # 理解度 (0-100%)
+    basic_understanding = Column(Integer, nullable=True) # 基礎的な理解度 (40点満点)
+    expression = Column(Integer, nullable=True) # 説明・表現力 (20点満点)
+    application = Column(Integer, nullable=True) # 応用力・創造性 (20点満点)
+    attitude = Column(Integer, nullable=True) # 学習意欲・態度 (20点満点)
+    stumbling_points = Column(JSON, nullable=True) # つまずきの種類のリスト (概念理解の不足 など)
+    created_at = Column(DateTime(timezone=True), server_default=func.now()) # 作成日時
+
+    message = relationship("Message", back_populates="evaluation")
+    subjects = relationship("EvaluationSubjectScore", back_populates="evaluation", cascade="all, delete-orphan")
+
+    # 会話の直近の評価を新しい順に読む
+    __table_args__ = (
+        Index("ix_evaluation_scores_conversation_id_id", "conversation_id", "id"),
+    )
+
+# 理解度評価の教科別の点数テーブル
+class EvaluationSubjectScore(Base):
+    __tablename__ = "evaluation_subject_scores" # テーブル名
+
+    id = Column(Integer, primary_key=True) # ID (主キー)
+    evaluation_id = Column(Integer, ForeignKey("evaluation_scores.id", ondelete="CASCADE"), nullable=False, index=True) # 評価ID
+    subject = Column(String, nullable=False, index=True) # 教科 (算数、国語 など)
+    score = Column(Integer, nullable=True) # 教科別評価 (0-100%)
+
+    evaluation = relationship("EvaluationScore", back_populates="subjects")
+
+# 生徒ごとの学習の進み具合の集計テーブル
+# 理解度評価の点数を保存するトランザクションで、差分だけ更新する (app/db/progress.py)
+# 保護者・教師向けの画面は、生徒1人につきこの1行（と教科別の行）を読むだけで済む
+class LearnerProgress(Base):
+    __tablename__ = "learner_progress" # テーブル名
+
+    learner_id = Column(String, primary_key=True) # 生徒の識別子 (主キー)
+    evaluation_count = Column(Integer, nullable=False, default=0) # 評価の回数
+    understanding_count = Column(Integer, nullable=False, default=0) # 理解度のあった評価の回数
+    understanding_total = Column(Integer, nullable=False, default=0) # 理解度の合計（通算の平均用）
+    rolling_understanding = Column(Float, nullable=True) # 直近の評価の理解度の平均
+    best_understanding = Column(Integer, nullable=True) # 理解度の最高値
+    last_understanding = Column(Integer, nullable=True) # 最後の評価の理解度
+    improvement_streak = Column(Integer, nullable=False, default=0) # 理解度が前回以上だった連続回数
+    recent_scores = Column(JSON, nullable=False, default=list) # 直近の評価の点数（古い順）
+    stumbling_counts = Column(JSON, nullable=False, default=dict) # つまずきの種類ごとの回数
+    first_evaluated_at = Column(DateTime(timezone=True), nullable=True) # 最初の評価の日時
+    last_evaluated_at = Column(DateTime(timezone=True), nullable=True) # 最後の評価の日時
+    last_evaluation_id = Column(Integer, nullable=True) # 最後に集計した評価ID
+
+# 生徒・教科ごとの学習の進み具合の集計テーブル
+class LearnerSubjectProgress(Base):
+    __tablename__ = "learner_subject_progress" # テーブル名
+
+    learner_id = Column(String, primary_key=True) # 生徒の識別子
+    subject = Column(String, primary_key=True) # 教科
+    evaluation_count = Column(Integer, nullable=False, default=0) # 点数のあった評価の回数
+    score_total = Column(Integer, nullable=False, default=0) # 点数の合計（通算の平均用）
+    rolling_score = Column(Float, nullable=True) # 直近の点数の平均
+    best_score = Column(Integer, nullable=True) # 点数の最高値
+    last_score = Column(Integer, nullable=True) # 最後の点数
+    improvement_streak = Column(Integer, nullable=False, default=0) # 点数が前回以上だった連続回数
+    recent_scores = Column(JSON, nullable=False, default=list) # 直近の点数（古い順）
+    last_evaluated_at = Column(DateTime(timezone=True), nullable=True) # 最後の評価の日時
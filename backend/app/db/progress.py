@@ -0,0 +1,273 @@
+# app/db/progress.py
+# 生徒ごと・教科ごとの学習の進み具合の集計 (learner_progress / learner_subject_progress)
+# 理解度評価の点数を保存するトランザクションで、その評価の分だけ集計を更新する（差分更新）。
+# 集計を評価の履歴から作り直す場合は python -m app.jobs.rebuild_progress を実行する。
+import datetime
+import logging
+import os
+from dataclasses import asdict, dataclass
+from typing import AsyncIterator, Dict, Iterable, List, Optional, Sequence, Tuple
+
+from sqlalchemy import delete, select, tuple_
+from sqlalchemy.dialects.postgresql import insert as postgresql_insert
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.orm import selectinload
+
+from .models import Conversation, EvaluationScore, LearnerProgress, LearnerSubjectProgress
+
+logger = logging.getLogger(__name__)
+
+# 直近の平均 (rolling_*) と recent_scores に含める評価の数
+PROGRESS_RECENT_SCORES = int(os.getenv("PROGRESS_RECENT_SCORES", "10"))
+
+# 集計行が無ければ作る INSERT ... ON CONFLICT DO NOTHING（同じ生徒の初回の評価が同時に保存されても失敗しないように）
+_INSERTS = {"postgresql": postgresql_insert, "sqlite": sqlite_insert}
+
+def new_learner_progress(learner_id: str) -> LearnerProgress:
+    return LearnerProgress(
+        learner_id=learner_id,
+        evaluation_count=0,
+        understanding_count=0,
+        understanding_total=0,
+        improvement_streak=0,
+        recent_scores=[],
+        stumbling_counts={},
+    )
+
+def new_subject_progress(learner_id: str, subject: str) -> LearnerSubjectProgress:
+    return LearnerSubjectProgress(
+        learner_id=learner_id,
+        subject=subject,
+        evaluation_count=0,
+        score_total=0,
+        improvement_streak=0,
+        recent_scores=[],
+    )
+
+def _next_streak(previous: Optional[int], current: int, streak: int) -> int:
+    """前回以上なら連続回数を伸ばし、下がったら 0 に戻す（初回は 0）"""
+    if previous is None:
+        return 0
+    return streak + 1 if current >= previous else 0
+
+def _average(values: Iterable[Optional[int]]) -> Optional[float]:
+    present = [value for value in values if value is not None]
+    return round(sum(present) / len(present), 2) if present else None
+
+def apply_evaluation(progress: LearnerProgress, evaluation: EvaluationScore, evaluated_at: datetime.datetime) -> None:
+    """1件の評価を生徒の集計に反映する（JSON 列は変更を検知させるため作り直して代入する）"""
+    progress.evaluation_count += 1
+    recent = list(progress.recent_scores or []) + [{
+        "evaluation_id": evaluation.id,
+        "evaluated_at": evaluated_at.isoformat(),
+        "understanding": evaluation.understanding,
+        "basic_understanding": evaluation.basic_understanding,
+        "expression": evaluation.expression,
+        "application": evaluation.application,
+        "attitude": evaluation.attitude,
+    }]
+    progress.recent_scores = recent[-PROGRESS_RECENT_SCORES:]
+
+    if evaluation.understanding is not None:
+        progress.improvement_streak = _next_streak(progress.last_understanding, evaluation.understanding, progress.improvement_streak)
+        progress.understanding_count += 1
+        progress.understanding_total += evaluation.understanding
+        progress.best_understanding = max(progress.best_understanding or 0, evaluation.understanding)
+        progress.last_understanding = evaluation.understanding
+        progress.rolling_understanding = _average(entry["understanding"] for entry in progress.recent_scores)
+
+    if evaluation.stumbling_points:
+        counts = dict(progress.stumbling_counts or {})
+        for point in evaluation.stumbling_points:
+            counts[point] = counts.get(point, 0) + 1
+        progress.stumbling_counts = counts
+
+    progress.first_evaluated_at = progress.first_evaluated_at or evaluated_at
+    progress.last_evaluated_at = evaluated_at
+    progress.last_evaluation_id = evaluation.id
+
+def apply_subject_score(progress: LearnerSubjectProgress, score: int, evaluated_at: datetime.datetime) -> None:
+    """1件の教科別の点数を生徒・教科の集計に反映する"""
+    progress.improvement_streak = _next_streak(progress.last_score, score, progress.improvement_streak)
+    progress.evaluation_count += 1
+    progress.score_total += score
+    progress.best_score = max(progress.best_score or 0, score)
+    progress.last_score = score
+    progress.recent_scores = (list(progress.recent_scores or []) + [score])[-PROGRESS_RECENT_SCORES:]
+    progress.rolling_score = _average(progress.recent_scores)
+    progress.last_evaluated_at = evaluated_at
+
+async def _insert_missing(db: AsyncSession, table, rows: List[dict]) -> None:
+    insert = _INSERTS[db.bind.dialect.name]
+    await db.execute(insert(table).values(rows).on_conflict_do_nothing())
+
+async def record_evaluations_async(db: AsyncSession, evaluations: Sequence[EvaluationScore]) -> None:
+    """
+    これから保存する評価を、会話の生徒の集計に反映する（呼び出し側のトランザクションで行い、コミットはしない）。
+    生徒の分からない会話 (learner_id なし) の評価は集計しない。
+    集計行は生徒ID順に行ロックを取ってから更新するので、同じ生徒の評価が並行して保存されても数え漏れない。
+    """
+    if not evaluations:
+        return
+    await db.flush() # 評価IDと新しい会話のIDを確定させる
+    result = await db.execute(
+        select(Conversation.id, Conversation.learner_id)
+        .where(Conversation.id.in_({e.conversation_id for e in evaluations}), Conversation.learner_id.isnot(None))
+    )
+    learner_ids: Dict[int, str] = dict(result.all())
+    targets: List[Tuple[str, EvaluationScore]] = sorted(
+        ((learner_ids[e.conversation_id], e) for e in evaluations if e.conversation_id in learner_ids),
+        key=lambda target: target[1].id,
+    )
+    if not targets:
+        return
+
+    learners = sorted({learner_id for learner_id, _ in targets})
+    await _insert_missing(db, LearnerProgress.__table__, [{"learner_id": learner_id} for learner_id in learners])
+    result = await db.execute(
+        select(LearnerProgress)
+        .where(LearnerProgress.learner_id.in_(learners))
+        .order_by(LearnerProgress.learner_id)
+        .with_for_update()
+    )
+    progress = {row.learner_id: row for row in result.scalars()}
+
+    subject_keys = sorted({(learner_id, s.subject) for learner_id, e in targets for s in e.subjects if s.score is not None})
+    subject_progress: Dict[Tuple[str, str], LearnerSubjectProgress] = {}
+    if subject_keys:
+        await _insert_missing(
+            db, LearnerSubjectProgress.__table__,
+            [{"learner_id": learner_id, "subject": subject} for learner_id, subject in subject_keys],
+        )
+        result = await db.execute(
+            select(LearnerSubjectProgress)
+            .where(tuple_(LearnerSubjectProgress.learner_id, LearnerSubjectProgress.subject).in_(subject_keys))
+            .order_by(LearnerSubjectProgress.learner_id, LearnerSubjectProgress.subject)
+            .with_for_update()
+        )
+        subject_progress = {(row.learner_id, row.subject): row for row in result.scalars()}
+
+    # created_at はDB側の既定値でまだ読めないので、保存時刻として現在時刻を使う
+    evaluated_at = datetime.datetime.now(datetime.timezone.utc)
+    for learner_id, evaluation in targets:
+        apply_evaluation(progress[learner_id], evaluation, evaluated_at)
+        for subject_score in evaluation.subjects:
+            if subject_score.score is not None:
+                apply_subject_score(subject_progress[(learner_id, subject_score.subject)], subject_score.score, evaluated_at)
+
+# --- 集計の作り直し（バックフィル） ---
+
+@dataclass
+class RebuildReport:
+    learners: int = 0 # 集計を作り直した生徒数
+    evaluations: int = 0 # 集計した評価の数
+    removed: int = 0 # 評価がなくなっていたため削除した生徒の集計行
+
+    def as_dict(self) -> dict:
+        return asdict(self)
+
+# 生徒1人分の作り直した集計（生徒の集計行と教科別の集計行）
+_LearnerRows = Tuple[LearnerProgress, Dict[str, LearnerSubjectProgress]]
+
+async def _replace_rows(db: AsyncSession, rows: List[_LearnerRows]) -> None:
+    """生徒ごとの集計行を作り直した内容で置き換える（1トランザクション）"""
+    learner_ids = [progress.learner_id for progress, _ in rows]
+    try:
+        await db.execute(delete(LearnerSubjectProgress).where(LearnerSubjectProgress.learner_id.in_(learner_ids)))
+        await db.execute(delete(LearnerProgress).where(LearnerProgress.learner_id.in_(learner_ids)))
+        for progress, subjects in rows:
+            db.add(progress)
+            db.add_all(subjects.values())
+        await db.commit()
+    except Exception:
+        await db.rollback()
+        raise
+    db.expunge_all()
+
+async def _read_evaluations(
+    db: AsyncSession,
+    learner_ids: List[str],
+    fetch_size: int,
+) -> AsyncIterator[Tuple[str, EvaluationScore]]:
+    """
+    生徒たちの評価を生徒ID・評価ID順に返す。(生徒ID, 評価ID) のキーセットで fetch_size 件ずつ読み、
+    各ページは読み終えてから返す（カーソルを開いたまま書き込むと、SQLite ではロックで失敗するため）。
+    """
+    after: Optional[Tuple[str, int]] = None
+    while True:
+        query = (
+            select(Conversation.learner_id, EvaluationScore)
+            .join(Conversation, Conversation.id == EvaluationScore.conversation_id)
+            .where(Conversation.learner_id.in_(learner_ids))
+            .order_by(Conversation.learner_id, EvaluationScore.id)
+            .options(selectinload(EvaluationScore.subjects))
+            .limit(fetch_size)
+        )
+        if after is not None:
+            query = query.where(tuple_(Conversation.learner_id, EvaluationScore.id) > after)
+        rows = (await db.execute(query)).all()
+        for row in rows:
+            yield row[0], row[1]
+        if len(rows) < fetch_size:
+            return
+        after = (rows[-1][0], rows[-1][1].id)
+
+async def _rebuild_rows(db: AsyncSession, learner_ids: List[str], fetch_size: int, report: RebuildReport) -> List[_LearnerRows]:
+    """生徒たちの集計行を評価の履歴から作る（まだ保存しない）"""
+    rows: Dict[str, _LearnerRows] = {learner_id: (new_learner_progress(learner_id), {}) for learner_id in learner_ids}
+    async for learner_id, evaluation in _read_evaluations(db, learner_ids, fetch_size):
+        progress, subjects = rows[learner_id]
+        evaluated_at = evaluation.created_at or datetime.datetime.now(datetime.timezone.utc)
+        apply_evaluation(progress, evaluation, evaluated_at)
+        for subject_score in evaluation.subjects:
+            if subject_score.score is None:
+                continue
+            if subject_score.subject not in subjects:
+                subjects[subject_score.subject] = new_subject_progress(learner_id, subject_score.subject)
+            apply_subject_score(subjects[subject_score.subject], subject_score.score, evaluated_at)
+        report.evaluations += 1
+    return list(rows.values())
+
+async def rebuild_learner_progress(db: AsyncSession, batch_size: int = 500, fetch_size: int = 1000) -> RebuildReport:
+    """
+    evaluation_scores から生徒ごと・教科ごとの集計を作り直す。
+    評価のある生徒を生徒ID順に batch_size 人ずつ取り出し、その生徒たちの評価を fetch_size 件ずつ読み終えてから、
+    集計行を置き換える（読み取りと書き込みは同じ接続で行い、カーソルを開いたまま書き込まない）。
+    読み取りは書き込み用のDBから行う（レプリカの遅れで評価を取りこぼさないように）。
+    評価の保存と並行して実行すると、実行中に保存された評価が集計から漏れることがある（その場合は再実行する）。
+    """
+    report = RebuildReport()
+    seen = set()
+    last_learner_id: Optional[str] = None
+    while True:
+        query = (
+            select(Conversation.learner_id)
+            .join(EvaluationScore, EvaluationScore.conversation_id == Conversation.id)
+            .where(Conversation.learner_id.isnot(None))
+            .group_by(Conversation.learner_id)
+            .order_by(Conversation.learner_id)
+            .limit(batch_size)
+        )
+        if last_learner_id is not None:
+            query = query.where(Conversation.learner_id > last_learner_id)
+        learner_ids = list((await db.execute(query)).scalars())
+        if not learner_ids:
+            break
+        rows = await _rebuild_rows(db, learner_ids, fetch_size, report)
+        await _replace_rows(db, rows)
+        seen.update(learner_ids)
+        report.learners += len(learner_ids)
+        logger.info("Rebuilt progress for %d learners", report.learners)
+        last_learner_id = learner_ids[-1]
+
+    # 評価が残っていない生徒の集計行（会話の削除などで）を消す
+    result = await db.execute(select(LearnerProgress.learner_id))
+    stale = [learner_id for learner_id in result.scalars() if learner_id not in seen]
+    for start in range(0, len(stale), batch_size):
+        chunk = stale[start:start + batch_size]
+        await db.execute(delete(LearnerSubjectProgress).where(LearnerSubjectProgress.learner_id.in_(chunk)))
+        await db.execute(delete(LearnerProgress).where(LearnerProgress.learner_id.in_(chunk)))
+        await db.commit()
+    report.removed = len(stale)
+    return report
@@ -0,0 +1,69 @@
+# app/db/read_routing.py
+# 会話履歴の読み込みを読み取り用エンジン（レプリカ）に振り分ける
+# レプリカは書き込みから少し遅れて追いつくため、直前に書き込んだ会話を読むとターンが欠けることがある。
+# 会話ごとに最後に書き込んだ時刻を記録し、その直後の一定時間は書き込み用のセッションで読む (read-your-writes)。
+import logging
+import os
+import time
+from collections import OrderedDict
+from contextlib import asynccontextmanager
+from typing import AsyncIterator, Dict
+
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from app.core.metrics import HISTORY_READS
+from .database import READ_ENGINE_SEPARATE, AsyncReadSessionLocal
+
+logger = logging.getLogger(__name__)
+
+# 書き込み後、この秒数は同じ会話の読み込みを書き込み用のセッションで行う（レプリカの遅延より長くする）
+DB_READ_YOUR_WRITES_SECONDS = float(os.getenv("DB_READ_YOUR_WRITES_SECONDS", "5"))
+
+READ_TARGET_PRIMARY = "primary"
+READ_TARGET_REPLICA = "replica"
+
+class WriteStamps:
+    """会話ごとの最後の書き込み時刻を、window 秒の間だけ覚えておく"""
+
+    def __init__(self, window_seconds: float):
+        self._window = window_seconds
+        # 会話ID → 書き込み時刻 (古い順)
+        self._stamps: "OrderedDict[int, float]" = OrderedDict()
+
+    def mark(self, conversation_id: int) -> None:
+        """会話への書き込みがコミットされたことを記録する"""
+        now = time.monotonic()
+        self._stamps[conversation_id] = now
+        self._stamps.move_to_end(conversation_id)
+        self._expire(now)
+
+    def recently_written(self, conversation_id: int) -> bool:
+        stamp = self._stamps.get(conversation_id)
+        return stamp is not None and time.monotonic() - stamp < self._window
+
+    def _expire(self, now: float) -> None:
+        while self._stamps:
+            conversation_id, stamp = next(iter(self._stamps.items()))
+            if now - stamp < self._window:
+                break
+            del self._stamps[conversation_id]
+
+    def stats(self) -> Dict[str, int]:
+        return {"tracked_conversations": len(self._stamps)}
+
+write_stamps = WriteStamps(DB_READ_YOUR_WRITES_SECONDS)
+
+@asynccontextmanager
+async def history_read_session(db: AsyncSession, conversation_id: int) -> AsyncIterator[AsyncSession]:
+    """
+    会話履歴を読むセッションを返す。
+    読み取り用エンジンが別にあり、かつその会話に最近書き込んでいなければ読み取り用のセッションを開く。
+    それ以外は渡されたリクエストのセッション db（書き込み用）をそのまま使う。
+    """
+    if not READ_ENGINE_SEPARATE or write_stamps.recently_written(conversation_id):
+        HISTORY_READS.labels(target=READ_TARGET_PRIMARY).inc()
+        yield db
+        return
+    HISTORY_READS.labels(target=READ_TARGET_REPLICA).inc()
+    async with AsyncReadSessionLocal() as read_db:
+        yield read_db
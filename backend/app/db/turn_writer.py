@@ -0,0 +1,129 @@
+# app/db/turn_writer.py
+# ライトビハインド (write-behind) 方式のターン保存
+# 多数のリクエストから届いたターンをキューに溜め、バックグラウンドでまとめて1コミットで書き込む。
+import asyncio
+import logging
+import os
+from collections import defaultdict
+from typing import Callable, Dict, List, Optional
+
+from app.db import crud
+from app.db.crud import TurnRecord
+from app.db.database import AsyncSessionLocal
+from app.models.chat_models import ChatMessage
+
+logger = logging.getLogger(__name__)
+
+# 保存方式: "transaction" (リクエストごとに1トランザクション) / "write_behind" (まとめて書き込み)
+TURN_PERSISTENCE_MODE = os.getenv("TURN_PERSISTENCE_MODE", "transaction")
+# キューの上限。満杯のときは submit() が空きを待つ（＝リクエスト側に背圧がかかる）
+TURN_WRITER_QUEUE_SIZE = int(os.getenv("TURN_WRITER_QUEUE_SIZE", "1000"))
+# 1回のコミットでまとめて書き込む最大ターン数
+TURN_WRITER_BATCH_SIZE = int(os.getenv("TURN_WRITER_BATCH_SIZE", "50"))
+# 最初の1件が届いてから、後続のターンを待ち合わせる最大時間（ミリ秒）
+TURN_WRITER_FLUSH_INTERVAL_MS = int(os.getenv("TURN_WRITER_FLUSH_INTERVAL_MS", "20"))
+
+class TurnWriter:
+    """
+    ターンをキューで受け取り、バッチ単位でグループコミットするバックグラウンドライター。
+
+    キューに入ってからコミットされるまでのターンは pending_messages() で参照できるため、
+    同じ会話の次のターンで履歴が欠けることはない。
+    """
+
+    def __init__(self, queue_size: int, batch_size: int, flush_interval_ms: int):
+        self._queue_size = queue_size
+        self._batch_size = batch_size
+        self._flush_interval = flush_interval_ms / 1000
+        self._queue: Optional[asyncio.Queue] = None
+        self._task: Optional[asyncio.Task] = None
+        # 未コミットのターン (会話ID → ターンのリスト)
+        self._pending: Dict[int, List[TurnRecord]] = defaultdict(list)
+        # 書き込みに失敗した会話IDを通知するコールバック（履歴キャッシュの破棄など）
+        self._failure_listeners: List[Callable[[int], None]] = []
+
+    @property
+    def running(self) -> bool:
+        return self._task is not None and not self._task.done()
+
+    async def start(self) -> None:
+        """バックグラウンドの書き込みタスクを開始する（アプリ起動時に呼ぶ）"""
+        if self.running:
+            return
+        self._queue = asyncio.Queue(maxsize=self._queue_size)
+        self._task = asyncio.create_task(self._run(), name="turn-writer")
+        logger.info("TurnWriter started (queue=%d, batch=%d)", self._queue_size, self._batch_size)
+
+    async def stop(self) -> None:
+        """キューに残ったターンを全て書き込んでから停止する（アプリ終了時に呼ぶ）"""
+        if not self.running:
+            return
+        await self._queue.join() # 残りのターンが全てコミットされるまで待つ
+        self._task.cancel()
+        try:
+            await self._task
+        except asyncio.CancelledError:
+            pass
+        self._task = None
+        logger.info("TurnWriter stopped (all pending turns flushed)")
+
+    def add_failure_listener(self, listener: Callable[[int], None]) -> None:
+        """書き込みに失敗したターンの会話IDを受け取るコールバックを登録する"""
+        self._failure_listeners.append(listener)
+
+    async def submit(self, turn: TurnRecord) -> None:
+        """ターンを書き込みキューに追加する。キューが満杯なら空くまで待つ"""
+        # 待っている間に取り消されても（クライアントの切断）、キューに入らなかったターンが履歴に残らないよう、
+        # キューに入れてから未コミットのターンとして登録する（その間に他の処理は割り込まない）
+        await self._queue.put(turn)
+        self._pending[turn.conversation_id].append(turn)
+
+    def pending_messages(self, conversation_id: int) -> List[ChatMessage]:
+        """まだコミットされていないターンを ChatMessage のリストとして返す"""
+        messages: List[ChatMessage] = []
+        for turn in self._pending.get(conversation_id, []):
+            messages.append(ChatMessage(role="user", content=turn.user_content))
+            messages.append(ChatMessage(role="assistant", content=turn.assistant_content))
+        return messages
+
+    async def _run(self) -> None:
+        while True:
+            # 最初の1件が届くまで待ち、その後 flush_interval の間に届いた分をまとめる
+            batch: List[TurnRecord] = [await self._queue.get()]
+            loop = asyncio.get_running_loop()
+            deadline = loop.time() + self._flush_interval
+            while len(batch) < self._batch_size:
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(await asyncio.wait_for(self._queue.get(), timeout))
+                except asyncio.TimeoutError:
+                    break
+            await self._write_batch(batch)
+
+    async def _write_batch(self, batch: List[TurnRecord]) -> None:
+        try:
+            async with AsyncSessionLocal() as db:
+                await crud.save_turns_async(db, batch)
+        except Exception as e:
+            # 書き込みに失敗したターンは失われるため、内容が追えるようにログに残す
+            lost = [turn.conversation_id for turn in batch]
+            logger.error("TurnWriter failed to write %d turns (conversation IDs: %s): %s", len(batch), lost, e)
+            for conversation_id in set(lost):
+                for listener in self._failure_listeners:
+                    listener(conversation_id)
+        finally:
+            for turn in batch:
+                pending = self._pending.get(turn.conversation_id)
+                if pending:
+                    pending.remove(turn)
+                    if not pending:
+                        del self._pending[turn.conversation_id]
+                self._queue.task_done()
+
+turn_writer = TurnWriter(
+    queue_size=TURN_WRITER_QUEUE_SIZE,
+    batch_size=TURN_WRITER_BATCH_SIZE,
+    flush_interval_ms=TURN_WRITER_FLUSH_INTERVAL_MS,
+)
@@ -0,0 +1,53 @@
+# app/jobs/archive_conversations.py
+# やりとりのなくなった会話を圧縮アーカイブに移すジョブ（cron などで定期実行する）
+#
+# 実行例 (backend ディレクトリで):
+#   # 最後のメッセージから30日 (HISTORY_ARCHIVE_IDLE_DAYS) を過ぎた会話をアーカイブ
+#   python -m app.jobs.archive_conversations
+#   # 7日で区切り、今回は最大1000会話まで
+#   python -m app.jobs.archive_conversations --idle-days 7 --limit 1000
+#
+# 移したメッセージ数と削減できたバイト数をログに出力する（LOG_FORMAT=json なら各値がフィールドになる）。
+import argparse
+import asyncio
+import logging
+from typing import List, Optional
+
+from app.core.logging import setup_logging, shutdown_logging
+from app.db.archive import HISTORY_ARCHIVE_CODEC, HISTORY_ARCHIVE_IDLE_DAYS, ArchiveReport, archive_idle_conversations
+from app.db.database import AsyncSessionLocal, async_engine
+
+logger = logging.getLogger(__name__)
+
+def parse_args(argv: Optional[List[str]]) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description="やりとりのなくなった会話を圧縮アーカイブに移す")
+    parser.add_argument("--idle-days", type=float, default=HISTORY_ARCHIVE_IDLE_DAYS,
+                        help="最後のメッセージからこの日数を過ぎた会話を対象にする")
+    parser.add_argument("--batch-size", type=int, default=100, help="1トランザクションで移す会話数")
+    parser.add_argument("--limit", type=int, default=None, help="今回アーカイブする会話数の上限")
+    parser.add_argument("--codec", choices=["zlib", "zstd"], default=HISTORY_ARCHIVE_CODEC, help="圧縮方式")
+    return parser.parse_args(argv)
+
+async def run(args: argparse.Namespace) -> ArchiveReport:
+    try:
+        async with AsyncSessionLocal() as db:
+            return await archive_idle_conversations(
+                db,
+                idle_days=args.idle_days,
+                batch_size=args.batch_size,
+                limit=args.limit,
+                codec=args.codec,
+            )
+    finally:
+        await async_engine.dispose()
+
+def main(argv: Optional[List[str]] = None) -> None:
+    setup_logging()
+    args = parse_args(argv)
+    report = asyncio.run(run(args))
+    logger.info("Archive job finished: %d conversations, %d rows moved, %d bytes saved",
+                report.conversations, report.rows_moved, report.bytes_saved, extra=report.as_dict())
+    shutdown_logging()
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,305 @@
+# app/jobs/generate_reports.py
+# 保護者・教師向けレポートの一括生成ジョブ
+# 対話の中でしか作られない「保護者・教師向けレポート」を、期間や会話IDを指定してまとめて作成する。
+#
+#   - 会話履歴はサーバーサイドカーソルで少しずつ読み込む（一度に全件をメモリに載せない）
+#   - AIの呼び出しは asyncio で並行させ、プロンプトの整形とレポートの解析はプロセスプールで行う
+#   - 結果は1会話1行の JSONL に逐次追記し、どこまで終わったかをチェックポイントファイルに記録する。
+#     中断しても同じコマンドを再実行すれば続きから再開する
+#   - 作成に失敗した会話（混雑で呼べなかった場合など）は <output>.failed に記録し、再実行したときに作り直す
+#
+# 実行例 (backend ディレクトリで):
+#   python -m app.jobs.generate_reports --since 2026-09-01 --until 2026-10-01 --output reports.jsonl
+#   python -m app.jobs.generate_reports --conversation-ids 12,15,40 --output reports.jsonl
+import argparse
+import asyncio
+import datetime
+import json
+import logging
+import os
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from dataclasses import dataclass, field
+from typing import Any, AsyncIterator, Deque, Dict, Iterator, List, Optional, Set, Tuple
+
+from sqlalchemy import select
+
+from app.core.logging import setup_logging, shutdown_logging
+from app.db.archive import decode_messages
+from app.db.database import AsyncReadSessionLocal, async_engine, async_read_engine
+from app.db.models import ArchivedConversation, Conversation, Message
+from app.jobs.report_format import build_report_prompt, parse_report
+from app.services import ai_service
+from app.services.ai_service import AdmissionRejected, generate_chat_response
+
+logger = logging.getLogger(__name__)
+
+REPORT_MODE = "parent_teacher_report"
+
+REPORT_SYSTEM_INSTRUCTION = (
+    """
+    あなたは小学生～中学生の学習を支援する教育アシスタントAI「ラーニー」の会話記録を分析する専門家です。
+    渡された生徒とラーニーの会話を読み、保護者・教師向けのレポートを作成してください。
+    学習者向けのフィードバックは不要です。推測で数値を作らず、会話から読み取れる範囲で評価してください。
+
+    【レスポンスフォーマット】
+    ===保護者・教師向けレポート===
+    【評価サマリー】
+    ・総合評価：○○%
+    ・教科別評価：
+    - 教科A：○○%
+
+    【詳細分析】
+    ・強み：
+    ・課題：
+    ・躓きポイント：
+    ・推奨される支援：
+
+    【長期的傾向】
+    ・特筆すべき変化：
+    ・今後の注目ポイント：
+
+    【提案される対策】
+    1. 短期的な取り組み
+    2. 中長期的な取り組み
+    """
+)
+
+ai_service.register_mode_prompt(REPORT_MODE, REPORT_SYSTEM_INSTRUCTION)
+
+# 混雑で断られた場合に待って再試行する回数
+ADMISSION_RETRIES = 5
+
+@dataclass
+class ConversationHistory:
+    conversation_id: int
+    learner_id: Optional[str]
+    archived: bool
+    # (seq, role, content)
+    messages: List[Tuple[int, str, str]] = field(default_factory=list)
+
+async def stream_histories(
+    since: Optional[datetime.datetime],
+    until: Optional[datetime.datetime],
+    conversation_ids: Optional[List[int]],
+    after_id: int,
+    fetch_size: int,
+) -> AsyncIterator[ConversationHistory]:
+    """
+    対象の会話の履歴を会話ID順に1会話ずつ返す。
+    メッセージはサーバーサイドカーソルで fetch_size 件ずつ読み込むので、メモリに載るのは1会話分だけ。
+    """
+    query = (
+        select(Conversation.id, Conversation.learner_id, Conversation.archived_at, Message.seq, Message.role, Message.content)
+        .outerjoin(Message, Message.conversation_id == Conversation.id)
+        .where(Conversation.id > after_id, Conversation.message_count > 0)
+        .order_by(Conversation.id, Message.seq)
+        .execution_options(yield_per=fetch_size)
+    )
+    if since is not None:
+        query = query.where(Conversation.last_message_at >= since)
+    if until is not None:
+        query = query.where(Conversation.last_message_at < until)
+    if conversation_ids:
+        query = query.where(Conversation.id.in_(conversation_ids))
+
+    async with AsyncReadSessionLocal() as db:
+        result = await db.stream(query)
+        current: Optional[ConversationHistory] = None
+        async for row in result:
+            if current is None or row.id != current.conversation_id:
+                if current is not None:
+                    yield await _with_archived_messages(current)
+                current = ConversationHistory(row.id, row.learner_id, row.archived_at is not None)
+            if row.seq is not None:
+                current.messages.append((row.seq, row.role, row.content))
+        if current is not None:
+            yield await _with_archived_messages(current)
+
+async def _with_archived_messages(history: ConversationHistory) -> ConversationHistory:
+    """アーカイブ済みの会話は、圧縮アーカイブのメッセージを先頭に補う（メッセージは messages テーブルに戻さない）"""
+    if not history.archived:
+        return history
+    first_live_seq = history.messages[0][0] if history.messages else None
+    async with AsyncReadSessionLocal() as db:
+        archived = await db.get(ArchivedConversation, history.conversation_id)
+    if archived is not None:
+        earlier = [
+            (m.seq, m.role, m.content)
+            for m in decode_messages(history.conversation_id, archived.payload, archived.codec)
+            if first_live_seq is None or m.seq < first_live_seq
+        ]
+        history.messages = earlier + history.messages
+    return history
+
+def _read_conversation_ids(path: str) -> Iterator[Tuple[int, bool]]:
+    """JSONL の各行の (会話ID, 失敗の記録か) を返す"""
+    if not os.path.exists(path):
+        return
+    with open(path, encoding="utf-8") as f:
+        for line in f:
+            try:
+                record = json.loads(line)
+                yield record["conversation_id"], "error" in record
+            except (ValueError, KeyError, TypeError):
+                continue # 中断で途中まで書かれた行
+
+class Checkpoint:
+    """
+    どこまで処理したかを記録する。
+    watermark: この会話ID以下は全て出力済みか、失敗として <output>.failed に記録済み
+    （並行処理のため、それより大きいIDも一部は出力済みのことがある）
+    retry_ids: 失敗として記録され、まだ出力できていない会話（再実行時に作り直す）
+    """
+
+    def __init__(self, output_path: str):
+        self.path = output_path + ".checkpoint"
+        self.failed_path = output_path + ".failed"
+        self.watermark = 0
+        if os.path.exists(self.path):
+            with open(self.path, encoding="utf-8") as f:
+                self.watermark = json.load(f)["watermark"]
+        self.retry_ids: Set[int] = {conversation_id for conversation_id, _ in _read_conversation_ids(self.failed_path)}
+        # watermark より後で出力済みの会話（中断時に処理中だった分の前後。並行数程度の件数に収まる）
+        self.done_after: Set[int] = set()
+        for conversation_id, failed in _read_conversation_ids(output_path):
+            if failed:
+                continue # 以前の版が出力に書いた失敗の記録
+            self.retry_ids.discard(conversation_id)
+            if conversation_id > self.watermark:
+                self.done_after.add(conversation_id)
+        self._pending: Deque[int] = deque()
+        self._completed: Set[int] = set()
+
+    def dispatched(self, conversation_id: int) -> None:
+        self._pending.append(conversation_id)
+
+    def completed(self, conversation_id: int) -> None:
+        """会話の出力（または失敗の記録）を書き終えたことを記録し、watermark が進めばファイルに保存する"""
+        if conversation_id in self.retry_ids:
+            return # 作り直しは watermark に関係しない
+        self._completed.add(conversation_id)
+        advanced = False
+        while self._pending and self._pending[0] in self._completed:
+            self.watermark = self._pending.popleft()
+            self._completed.discard(self.watermark)
+            advanced = True
+        if advanced:
+            tmp_path = self.path + ".tmp"
+            with open(tmp_path, "w", encoding="utf-8") as f:
+                json.dump({"watermark": self.watermark}, f)
+            os.replace(tmp_path, self.path)
+
+@dataclass
+class JobStats:
+    generated: int = 0
+    failed: int = 0
+    skipped: int = 0
+
+async def generate_report(history: ConversationHistory, pool: ProcessPoolExecutor) -> Dict[str, Any]:
+    loop = asyncio.get_running_loop()
+    record: Dict[str, Any] = {
+        "conversation_id": history.conversation_id,
+        "learner_id": history.learner_id,
+        "message_count": len(history.messages),
+    }
+    try:
+        prompt = await loop.run_in_executor(pool, build_report_prompt, [(role, content) for _, role, content in history.messages])
+        for attempt in range(ADMISSION_RETRIES + 1):
+            try:
+                text = await generate_chat_response(prompt, [], mode=REPORT_MODE)
+                break
+            except AdmissionRejected as e:
+                if attempt == ADMISSION_RETRIES:
+                    raise
+                await asyncio.sleep(e.retry_after)
+        record["report"] = text
+        record["sections"] = await loop.run_in_executor(pool, parse_report, text)
+        record["generated_at"] = datetime.datetime.now(datetime.timezone.utc).isoformat()
+    except Exception as e:
+        logger.exception("Failed to generate report for conversation %d", history.conversation_id)
+        record["error"] = type(e).__name__
+    return record
+
+async def run(args: argparse.Namespace) -> JobStats:
+    checkpoint = Checkpoint(args.output)
+    stats = JobStats()
+    queue: asyncio.Queue = asyncio.Queue(maxsize=args.concurrency * 2)
+
+    async def produce() -> None:
+        try:
+            if checkpoint.retry_ids:
+                # 前回までに失敗した会話を先に作り直す
+                logger.info("Retrying %d failed reports", len(checkpoint.retry_ids))
+                async for history in stream_histories(None, None, sorted(checkpoint.retry_ids), 0, args.fetch_size):
+                    await queue.put(history)
+            async for history in stream_histories(args.since, args.until, args.conversation_ids, checkpoint.watermark, args.fetch_size):
+                if history.conversation_id in checkpoint.retry_ids:
+                    continue # 作り直しの対象として処理済み
+                if history.conversation_id in checkpoint.done_after:
+                    stats.skipped += 1
+                    continue
+                checkpoint.dispatched(history.conversation_id)
+                await queue.put(history)
+        finally:
+            for _ in range(args.concurrency):
+                await queue.put(None)
+
+    async def consume(output, failed_output, pool: ProcessPoolExecutor) -> None:
+        while True:
+            history = await queue.get()
+            if history is None:
+                return
+            record = await generate_report(history, pool)
+            # 失敗は出力に含めず別のファイルに記録し、再実行したときに作り直す
+            destination = failed_output if "error" in record else output
+            destination.write(json.dumps(record, ensure_ascii=False) + "\n")
+            destination.flush()
+            checkpoint.completed(history.conversation_id)
+            if "error" in record:
+                stats.failed += 1
+            else:
+                stats.generated += 1
+            if (stats.generated + stats.failed) % 100 == 0:
+                logger.info("Reports: %d generated, %d failed", stats.generated, stats.failed)
+
+    try:
+        with ProcessPoolExecutor(max_workers=args.processes) as pool, \
+                open(args.output, "a", encoding="utf-8") as output, \
+                open(checkpoint.failed_path, "a", encoding="utf-8") as failed_output:
+            await asyncio.gather(produce(), *[consume(output, failed_output, pool) for _ in range(args.concurrency)])
+    finally:
+        await async_engine.dispose()
+        if async_read_engine is not async_engine:
+            await async_read_engine.dispose()
+    return stats
+
+def _parse_datetime(value: str) -> datetime.datetime:
+    parsed = datetime.datetime.fromisoformat(value)
+    return parsed if parsed.tzinfo else parsed.replace(tzinfo=datetime.timezone.utc)
+
+def parse_args(argv: Optional[List[str]]) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description="保護者・教師向けレポートを一括で作成し JSONL に書き出す")
+    parser.add_argument("--since", type=_parse_datetime, help="最後のメッセージがこの日時以降の会話 (例: 2026-09-01)")
+    parser.add_argument("--until", type=_parse_datetime, help="最後のメッセージがこの日時より前の会話")
+    parser.add_argument("--conversation-ids", type=lambda s: [int(v) for v in s.split(",")], help="対象の会話ID（カンマ区切り）")
+    parser.add_argument("--output", required=True, help="結果を追記する JSONL ファイル（再実行すると続きから再開する）")
+    parser.add_argument("--concurrency", type=int, default=8, help="同時に実行するAI呼び出しの数")
+    parser.add_argument("--processes", type=int, default=min(4, os.cpu_count() or 1), help="整形・解析に使うプロセス数")
+    parser.add_argument("--fetch-size", type=int, default=500, help="カーソルから一度に読み込むメッセージ数")
+    args = parser.parse_args(argv)
+    if args.since is None and args.until is None and not args.conversation_ids:
+        parser.error("specify --since/--until or --conversation-ids")
+    return args
+
+def main(argv: Optional[List[str]] = None) -> None:
+    setup_logging()
+    args = parse_args(argv)
+    ai_service.init_models()
+    stats = asyncio.run(run(args))
+    logger.info("Report job finished: %d generated, %d failed, %d skipped (already done)",
+                stats.generated, stats.failed, stats.skipped)
+    shutdown_logging()
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,44 @@
+# app/jobs/rebuild_progress.py
+# 生徒ごと・教科ごとの学習の進み具合の集計を、保存済みの理解度評価から作り直すジョブ
+# 集計は評価の保存時に差分更新されるので、通常は実行不要。
+# 集計テーブルを追加する前の評価を取り込む（バックフィル）ときや、集計の計算方法を変えたときに実行する。
+#
+# 実行例 (backend ディレクトリで):
+#   python -m app.jobs.rebuild_progress
+#   python -m app.jobs.rebuild_progress --batch-size 200
+#
+# 作り直した生徒数と評価数をログに出力する（LOG_FORMAT=json なら各値がフィールドになる）。
+import argparse
+import asyncio
+import logging
+from typing import List, Optional
+
+from app.core.logging import setup_logging, shutdown_logging
+from app.db.database import AsyncSessionLocal, async_engine
+from app.db.progress import RebuildReport, rebuild_learner_progress
+
+logger = logging.getLogger(__name__)
+
+def parse_args(argv: Optional[List[str]]) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description="理解度評価から生徒ごと・教科ごとの集計を作り直す")
+    parser.add_argument("--batch-size", type=int, default=500, help="1トランザクションで置き換える生徒数")
+    parser.add_argument("--fetch-size", type=int, default=1000, help="一度に読み込む評価の数")
+    return parser.parse_args(argv)
+
+async def run(args: argparse.Namespace) -> RebuildReport:
+    try:
+        async with AsyncSessionLocal() as db:
+            return await rebuild_learner_progress(db, batch_size=args.batch_size, fetch_size=args.fetch_size)
+    finally:
+        await async_engine.dispose()
+
+def main(argv: Optional[List[str]] = None) -> None:
+    setup_logging()
+    args = parse_args(argv)
+    report = asyncio.run(run(args))
+    logger.info("Progress rebuild finished: %d learners, %d evaluations, %d stale rows removed",
+                report.learners, report.evaluations, report.removed, extra=report.as_dict())
+    shutdown_logging()
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,57 @@
+# app/jobs/report_format.py
+# 一括レポート生成 (generate_reports.py) の CPU 側の処理
+# プロセスプールのワーカーで実行するため、アプリの他のモジュールには依存させない（引数・戻り値は pickle できる型のみ）。
+import re
+from typing import Dict, List, Tuple
+
+# プロンプトに入れる会話の上限（長い会話は古い方を省く）
+MAX_TRANSCRIPT_CHARS = 12000
+# 1件のメッセージの上限（長い評価レポートは先頭だけ使う）
+MAX_MESSAGE_CHARS = 1500
+
+_ROLE_LABELS = {"user": "生徒", "assistant": "ラーニー", "model": "ラーニー"}
+
+# レポートの見出し 【評価サマリー】 など
+_SECTION_HEADING = re.compile(r"^\s*【(?P<title>[^】]+)】\s*(?P<rest>.*)$")
+_BULLET = re.compile(r"^\s*(?:[・\-\*]|\d+\.)\s*")
+
+def build_report_prompt(messages: List[Tuple[str, str]]) -> str:
+    """(role, content) の一覧から、レポート作成を依頼するプロンプトを作る"""
+    lines = []
+    for role, content in messages:
+        text = content.strip()
+        if len(text) > MAX_MESSAGE_CHARS:
+            text = text[:MAX_MESSAGE_CHARS] + "…"
+        lines.append(f"{_ROLE_LABELS.get(role, role)}: {text}")
+
+    # 新しいやりとりを優先して上限まで詰める
+    kept: List[str] = []
+    total = 0
+    for line in reversed(lines):
+        if total + len(line) > MAX_TRANSCRIPT_CHARS and kept:
+            break
+        kept.append(line)
+        total += len(line)
+    omitted = len(lines) - len(kept)
+    transcript = "\n".join(reversed(kept))
+    if omitted:
+        transcript = f"（最初の {omitted} 件のメッセージは省略）\n" + transcript
+    return f"以下の会話について、保護者・教師向けレポートを作成してください。\n\n===会話===\n{transcript}\n===ここまで==="
+
+def parse_report(text: str) -> Dict[str, List[str]]:
+    """
+    レポート本文を見出し（【評価サマリー】など）ごとの行のリストに分ける。
+    見出しより前の行は "概要" に入れる。箇条書きの記号は取り除く。
+    """
+    sections: Dict[str, List[str]] = {}
+    current = "概要"
+    for raw_line in text.splitlines():
+        heading = _SECTION_HEADING.match(raw_line)
+        if heading:
+            current = heading.group("title").strip()
+            sections.setdefault(current, [])
+            raw_line = heading.group("rest")
+        line = _BULLET.sub("", raw_line).strip()
+        if line and not line.startswith("==="):
+            sections.setdefault(current, []).append(line)
+    return sections
@@ -1,23 +1,50 @@
 # app/main.py
+import logging
 from fastapi import FastAPI
-from fastapi.responses import RedirectResponse
-from app.api import chat_routes # APIルーターをインポート
+from fastapi.responses import RedirectResponse, Response
+from app.api import chat_routes, progress_routes # APIルーターをインポート
 # 他に必要な初期化処理があればインポート (DB接続など)
 
-# (オプション) アプリケーション起動/終了時の処理を定義
-# from contextlib import asynccontextmanager
-#
-# @asynccontextmanager
-# async def lifespan(app: FastAPI):
-#     # アプリケーション起動時に実行される処理
-#     print("Backend startup...")
-#     # 例: データベース接続プールの初期化
-#     # await database.connect()
-#     yield
-#     # アプリケーション終了時に実行される処理
-#     print("Backend shutdown...")
-#     # 例: データベース接続プールのクローズ
-#     # await database.disconnect()
+# アプリケーション起動/終了時の処理を定義
+import asyncio
+from contextlib import asynccontextmanager
+from app.db.read_routing import write_stamps
+from app.db.turn_writer import TURN_PERSISTENCE_MODE, turn_writer
+from app.services import ai_service
+from app.core.logging import RequestContextMiddleware, setup_logging, shutdown_logging
+from app.core.metrics import METRICS_CONTENT_TYPE, register_stats, render_metrics
+from app.services.chat_pipeline import load_configured_modes
+from app.services.history_cache import history_cache
+from app.services.question_pool import question_pool
+from app.services.single_flight import chat_flights
+from app.services.llm.admission import llm_admission
+from app.services.llm.resilience import llm_circuit_breaker
+
+# ログはキュー経由で別スレッドから書き出す（LOG_LEVEL / LOG_FORMAT などで設定）
+setup_logging()
+logger = logging.getLogger(__name__)
+
+# 設定ファイル (CHAT_MODES_PATH) で追加したモードを登録する（組み込みの4モードは chat_routes の import で登録済み）
+# モデルの準備 (init_models) より前に済ませておく
+load_configured_modes()
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # アプリケーション起動時に実行される処理
+    logger.info("Backend startup...")
+    # 各モードのモデル（とプロンプトのコンテキストキャッシュ）を一度だけ作成
+    # キャッシュ作成はAPI呼び出しを伴うため、イベントループを止めないよう別スレッドで実行
+    await asyncio.to_thread(ai_service.init_models)
+    if TURN_PERSISTENCE_MODE == "write_behind":
+        # ターンをまとめて書き込むバックグラウンドライターを開始
+        await turn_writer.start()
+    yield
+    # アプリケーション終了時に実行される処理
+    logger.info("Backend shutdown...")
+    # キューに残っているターンを書き込んでから停止
+    await turn_writer.stop()
+    # 書き出し待ちのログを出し切る
+    shutdown_logging()
 
 # FastAPI アプリケーションインスタンスを作成
 # タイトルなどを設定すると、自動生成されるドキュメントが見やすくなります (/docs)
@@ -25,13 +52,15 @@ app = FastAPI(
     title="My Chatbot Backend",
     version="0.1.0",
     description="Backend API for the AI Chatbot",
-    # lifespan=lifespan # 起動/終了時処理を使う場合
+    lifespan=lifespan # 起動/終了時処理
 )
 
 # APIルーターをアプリケーションに含める
 # chat_routes.router を /chat というプレフィックスで登録します
 # これにより、chat_routes.py で定義した /thinking は /chat/thinking でアクセス可能になります
 app.include_router(chat_routes.router, prefix="/chat", tags=["Chat"]) # tagsはドキュメント用
+# 生徒ごとの学習の進み具合 (/learners/{learner_id}/progress)
+app.include_router(progress_routes.router, prefix="/learners", tags=["Progress"])
 
 # ルートパス "/" へのアクセスがあった場合の処理 (オプション)
 # よくAPIドキュメントへのリダイレクトに使われます
@@ -39,6 +68,18 @@ app.include_router(chat_routes.router, prefix="/chat", tags=["Chat"]) # tagsは
 def read_root():
     return RedirectResponse(url="/docs") # /docs (Swagger UI) へリダイレクト
 
+# Prometheus 形式のメトリクス（各段階の所要時間、キャッシュ・プールの統計など）
+register_stats("history_cache", history_cache.stats)
+register_stats("question_pool", question_pool.stats)
+register_stats("llm_admission", llm_admission.stats)
+register_stats("llm_circuit", llm_circuit_breaker.stats)
+register_stats("db_write_stamps", write_stamps.stats)
+register_stats("chat_single_flight", chat_flights.stats)
+
+@app.get("/metrics", include_in_schema=False)
+def metrics():
+    return Response(render_metrics(), media_type=METRICS_CONTENT_TYPE)
+
 # --- その他、アプリケーション全体の設定やミドルウェアなどをここに追加 ---
 # 例: CORS設定
 from fastapi.middleware.cors import CORSMiddleware
@@ -48,7 +89,10 @@ app.add_middleware(
     allow_credentials=True,
     allow_methods=["*"],
     allow_headers=["*"],
+    expose_headers=["X-Request-ID"],
 )
+# リクエストごとの相関ID (X-Request-ID) をログに付ける
+app.add_middleware(RequestContextMiddleware)
 # ------------------------------------------------------------------
 
 # 注意: この main.py ファイル自体を直接実行することは通常ありません
@@ -13,9 +13,33 @@ class ChatRequest(BaseModel):
     history: List[ChatMessage] = []
     # 会話IDを追加 - 新しい会話の場合は None を渡すことを想定
     conversation_id: Optional[int] = None
+    # 生徒の識別子 - 新しい会話を始めるときに指定すると会話に記録され、理解度評価が生徒ごとに集計される
+    learner_id: Optional[str] = None
 
 # チャットレスポンスのモデル
 class ChatResponse(BaseModel):
     response: str
     # 会話IDを追加 - 次回のリクエストで使えるように返す
-    conversation_id: int
\ No newline at end of file
+    conversation_id: int
+
+# --- 一括評価 (理解度評価をクラス全員分まとめて実行) ---
+
+# 一括評価の1件分（1人の生徒の回答）
+class BatchEvaluationItem(BaseModel):
+    learner_id: str # 生徒の識別子
+    answer: str # 生徒の回答
+    # 続きの会話なら会話ID。None なら新しい会話を作成する
+    conversation_id: Optional[int] = None
+
+# 一括評価のリクエスト
+class BatchEvaluationRequest(BaseModel):
+    items: List[BatchEvaluationItem]
+
+# 一括評価の1件分の結果（終わったものから1行ずつ返す）
+class BatchEvaluationResult(BaseModel):
+    index: int # リクエストの items での位置
+    learner_id: str
+    conversation_id: Optional[int] = None
+    response: Optional[str] = None # 評価の本文（成功した場合）
+    error: Optional[str] = None # 失敗した場合の種類 (busy / llm_error / persistence_error / conversation_not_found / conversation_mismatch)
+    retry_after: Optional[str] = None # error が busy の場合、再試行までの秒数
@@ -0,0 +1,43 @@
+# app/models/progress_models.py
+# 生徒の学習の進み具合 (GET /learners/{learner_id}/progress) のレスポンス
+import datetime
+from typing import Dict, List, Optional
+
+from pydantic import BaseModel
+
+# 1回の評価の点数（直近の推移の表示用）
+class RecentScore(BaseModel):
+    evaluation_id: Optional[int] = None
+    evaluated_at: Optional[datetime.datetime] = None
+    understanding: Optional[int] = None # 理解度 (%)
+    basic_understanding: Optional[int] = None # 基礎的な理解度 (40点満点)
+    expression: Optional[int] = None # 説明・表現力 (20点満点)
+    application: Optional[int] = None # 応用力・創造性 (20点満点)
+    attitude: Optional[int] = None # 学習意欲・態度 (20点満点)
+
+# 教科ごとの集計
+class SubjectProgress(BaseModel):
+    subject: str
+    evaluation_count: int
+    average_score: Optional[float] = None # 通算の平均
+    rolling_score: Optional[float] = None # 直近の平均
+    best_score: Optional[int] = None
+    last_score: Optional[int] = None
+    improvement_streak: int # 点数が前回以上だった連続回数
+    recent_scores: List[int] = [] # 直近の点数（古い順）
+    last_evaluated_at: Optional[datetime.datetime] = None
+
+# 生徒ごとの集計
+class LearnerProgressResponse(BaseModel):
+    learner_id: str
+    evaluation_count: int
+    average_understanding: Optional[float] = None # 理解度の通算の平均
+    rolling_understanding: Optional[float] = None # 理解度の直近の平均
+    best_understanding: Optional[int] = None
+    last_understanding: Optional[int] = None
+    improvement_streak: int # 理解度が前回以上だった連続回数
+    recent_scores: List[RecentScore] = [] # 直近の評価（古い順）
+    stumbling_counts: Dict[str, int] = {} # つまずきの種類ごとの回数
+    first_evaluated_at: Optional[datetime.datetime] = None
+    last_evaluated_at: Optional[datetime.datetime] = None
+    subjects: List[SubjectProgress] = []
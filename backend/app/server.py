@@ -0,0 +1,228 @@
+# app/server.py
+# マルチワーカー起動（1台のマシンで複数コアを使う）
+#
+# uvicorn --workers で起動すると、リクエストがどのワーカーに届くかは決まらないため、
+# 履歴キャッシュ・類似問題プール・モデルなどのプロセス内の状態がワーカーごとに冷えたままになる。
+# この起動方法では
+#   1. アプリの import とモデルの準備 (init_models) を親プロセスで一度だけ行い、
+#   2. fork したワーカーを Unix ドメインソケットで待ち受けさせ、
+#   3. 親プロセスの軽量なディスパッチャーが、リクエストの conversation_id から
+#      ワーカーを決めて転送する（同じ会話は常に同じワーカーに届く。app/core/sharding.py）。
+#
+# 実行例 (backend ディレクトリで):
+#   python -m app.server --workers 4 --port 8000
+#   # 比較用: 会話を考慮せず順番に振り分ける
+#   python -m app.server --workers 4 --dispatch round_robin
+#
+# 特定のワーカーに送りたい場合（ワーカーごとの /metrics の取得など）は X-Worker ヘッダーに番号を指定する。
+# 新しい会話 (conversation_id なし) は順番に振り分けるので、2ターン目だけは別のワーカーに移ることがある。
+import os
+
+# 親プロセスで作った gRPC のチャネル（コンテキストキャッシュの作成など）を fork 後も使えるようにする。
+# grpc を import する前に設定する必要がある
+os.environ.setdefault("GRPC_ENABLE_FORK_SUPPORT", "1")
+os.environ.setdefault("GRPC_POLL_STRATEGY", "poll")
+
+import argparse
+import asyncio
+import itertools
+import json
+import logging
+import multiprocessing
+import shutil
+import signal
+import tempfile
+from contextlib import asynccontextmanager
+from typing import List, Optional
+
+import httpx
+import uvicorn
+from starlette.applications import Starlette
+from starlette.background import BackgroundTask
+from starlette.requests import Request
+from starlette.responses import Response, StreamingResponse
+from starlette.routing import Route
+
+from app.core.disconnect import ClientDisconnected, cancel_on_disconnect
+from app.core.sharding import worker_for_conversation, worker_for_key
+
+logger = logging.getLogger(__name__)
+
+WEB_HOST = os.getenv("WEB_HOST", "127.0.0.1")
+WEB_PORT = int(os.getenv("WEB_PORT", "8000"))
+# ワーカー数。1 ならディスパッチャーを挟まず、そのまま uvicorn で起動する
+WEB_WORKERS = int(os.getenv("WEB_WORKERS", "1"))
+# 振り分け方: affinity (conversation_id で固定) / round_robin (順番)
+WEB_DISPATCH = os.getenv("WEB_DISPATCH", "affinity")
+# ワーカーの起動を待つ時間の上限
+WEB_WORKER_STARTUP_TIMEOUT_SECONDS = float(os.getenv("WEB_WORKER_STARTUP_TIMEOUT_SECONDS", "30"))
+
+DISPATCH_AFFINITY = "affinity"
+DISPATCH_ROUND_ROBIN = "round_robin"
+
+WORKER_HEADER = "x-worker"
+# 重複リクエストの判定キー (app/services/single_flight.py)
+IDEMPOTENCY_KEY_HEADER = "idempotency-key"
+
+# 転送しないヘッダー (hop-by-hop)
+_HOP_BY_HOP_HEADERS = {
+    "connection", "keep-alive", "proxy-authenticate", "proxy-authorization",
+    "te", "trailer", "transfer-encoding", "upgrade",
+}
+
+def _forward_headers(headers) -> List[tuple]:
+    return [(name, value) for name, value in headers.items() if name.lower() not in _HOP_BY_HOP_HEADERS]
+
+class Dispatcher:
+    """リクエストをワーカーに転送する ASGI アプリ（親プロセスで動く）"""
+
+    def __init__(self, socket_paths: List[str], dispatch: str, workers: List[multiprocessing.Process]):
+        self._socket_paths = socket_paths
+        self._dispatch = dispatch
+        self._workers = workers
+        self._round_robin = itertools.count()
+        self._clients: List[httpx.AsyncClient] = []
+        self.app = Starlette(
+            routes=[Route("/{path:path}", self._proxy, methods=["GET", "HEAD", "POST", "PUT", "PATCH", "DELETE", "OPTIONS"])],
+            lifespan=self._lifespan,
+        )
+
+    @asynccontextmanager
+    async def _lifespan(self, app):
+        await self._wait_for_workers()
+        self._clients = [
+            httpx.AsyncClient(transport=httpx.AsyncHTTPTransport(uds=path), base_url="http://worker", timeout=None)
+            for path in self._socket_paths
+        ]
+        monitor = asyncio.create_task(self._monitor_workers())
+        logger.info("Dispatcher ready (%d workers, dispatch=%s)", len(self._socket_paths), self._dispatch)
+        try:
+            yield
+        finally:
+            monitor.cancel()
+            for client in self._clients:
+                await client.aclose()
+
+    async def _wait_for_workers(self) -> None:
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + WEB_WORKER_STARTUP_TIMEOUT_SECONDS
+        while not all(os.path.exists(path) for path in self._socket_paths):
+            if loop.time() > deadline:
+                raise RuntimeError("Workers did not start in time")
+            if not all(worker.is_alive() for worker in self._workers):
+                raise RuntimeError("A worker exited during startup")
+            await asyncio.sleep(0.1)
+
+    async def _monitor_workers(self) -> None:
+        """ワーカーが落ちたら、その会話を別のワーカーに移すのではなく全体を止める（プロセス管理ツールに再起動させる）"""
+        while True:
+            await asyncio.sleep(1)
+            for index, worker in enumerate(self._workers):
+                if not worker.is_alive():
+                    logger.error("Worker %d exited (code=%s); shutting down", index, worker.exitcode)
+                    os.kill(os.getpid(), signal.SIGTERM)
+                    return
+
+    def choose_worker(self, headers, body: bytes) -> int:
+        explicit = headers.get(WORKER_HEADER)
+        if explicit is not None and explicit.isdigit() and int(explicit) < len(self._clients):
+            return int(explicit)
+        if self._dispatch == DISPATCH_AFFINITY and body and headers.get("content-type", "").startswith("application/json"):
+            try:
+                conversation_id = json.loads(body).get("conversation_id")
+            except (ValueError, AttributeError):
+                conversation_id = None
+            if isinstance(conversation_id, int):
+                return worker_for_conversation(conversation_id, len(self._clients))
+        if self._dispatch == DISPATCH_AFFINITY and headers.get(IDEMPOTENCY_KEY_HEADER):
+            # 新しい会話の再送も、重複の待ち合わせ (single_flight.py) ができるよう同じワーカーに送る
+            return worker_for_key(headers[IDEMPOTENCY_KEY_HEADER], len(self._clients))
+        return next(self._round_robin) % len(self._clients)
+
+    async def _proxy(self, request: Request) -> Response:
+        body = await request.body()
+        index = self.choose_worker(request.headers, body)
+        client = self._clients[index]
+        upstream_request = client.build_request(
+            request.method,
+            request.url.path,
+            params=request.query_params,
+            headers=_forward_headers(request.headers),
+            content=body,
+        )
+        try:
+            # 応答ヘッダーを待つ間（通常のエンドポイントでは LLM の応答まで）にクライアントが切断したら、
+            # ワーカーへの接続を閉じて、ワーカー側でも切断として処理を取り消させる
+            upstream = await cancel_on_disconnect(request, client.send(upstream_request, stream=True))
+        except ClientDisconnected:
+            return Response(status_code=499)
+        except httpx.TransportError as e:
+            logger.error("Failed to reach worker %d: %s", index, e)
+            return Response("Bad Gateway", status_code=502)
+        headers = dict(_forward_headers(upstream.headers))
+        headers[WORKER_HEADER] = str(index)
+        # SSE もそのまま流す（ワーカーから届いた分から順に返す。途中で切断されたら upstream を閉じる）
+        return StreamingResponse(
+            upstream.aiter_raw(),
+            status_code=upstream.status_code,
+            headers=headers,
+            background=BackgroundTask(upstream.aclose),
+        )
+
+def preload() -> None:
+    """fork 前に親プロセスで一度だけ行う起動処理（各ワーカーの lifespan では準備済みとして扱われる）"""
+    from app.main import app  # noqa: F401  全モジュールの import とプロンプト・ルール表の読み込み
+    from app.services import ai_service
+
+    ai_service.init_models()
+
+def _run_worker(index: int, socket_path: str) -> None:
+    from app.db.database import async_engine, async_read_engine
+    from app.main import app
+
+    # 親から引き継いだ接続プールは使わない（fork 前に接続はしていないが念のため）
+    async_engine.sync_engine.dispose(close=False)
+    async_read_engine.sync_engine.dispose(close=False)
+    logger.info("Worker %d listening on %s", index, socket_path)
+    uvicorn.Server(uvicorn.Config(app, uds=socket_path)).run()
+
+def run(host: str, port: int, workers: int, dispatch: str) -> None:
+    if workers <= 1:
+        uvicorn.run("app.main:app", host=host, port=port)
+        return
+
+    preload()
+    socket_dir = tempfile.mkdtemp(prefix="chat-workers-")
+    socket_paths = [os.path.join(socket_dir, f"worker-{index}.sock") for index in range(workers)]
+    context = multiprocessing.get_context("fork")
+    processes = [
+        context.Process(target=_run_worker, args=(index, path), name=f"chat-worker-{index}", daemon=False)
+        for index, path in enumerate(socket_paths)
+    ]
+    for process in processes:
+        process.start()
+    try:
+        dispatcher = Dispatcher(socket_paths, dispatch, processes)
+        uvicorn.run(dispatcher.app, host=host, port=port)
+    finally:
+        for process in processes:
+            if process.is_alive():
+                process.terminate()
+        for process in processes:
+            process.join(timeout=30)
+        shutil.rmtree(socket_dir, ignore_errors=True)
+
+def parse_args(argv: Optional[List[str]] = None) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description="会話アフィニティ付きのマルチワーカー起動")
+    parser.add_argument("--host", default=WEB_HOST)
+    parser.add_argument("--port", type=int, default=WEB_PORT)
+    parser.add_argument("--workers", type=int, default=WEB_WORKERS)
+    parser.add_argument("--dispatch", choices=[DISPATCH_AFFINITY, DISPATCH_ROUND_ROBIN], default=WEB_DISPATCH)
+    return parser.parse_args(argv)
+
+def main(argv: Optional[List[str]] = None) -> None:
+    args = parse_args(argv)
+    run(args.host, args.port, args.workers, args.dispatch)
+
+if __name__ == "__main__":
+    main()
@@ -1,115 +1,230 @@
 # app/services/ai_service.py
-import os
 import asyncio
-import google.generativeai as genai
-import google.generativeai.types as genai_types
-# List と Optional は必要。Dict, Any を typing からインポート
-from typing import List, Optional, Dict, Any
+import logging
+import os
+from dataclasses import dataclass
+# List と Optional は必要。Dict を typing からインポート
+from typing import List, Optional, Dict, AsyncIterator
 # ChatMessage モデルをインポート
 from app.models.chat_models import ChatMessage
+from app.core.metrics import LLM_RESPONSE_ISSUES
+from app.services.llm.base import (
+    BLOCKED_BY_SAFETY_TEXT,
+    BLOCKED_UNKNOWN_TEXT,
+    EMPTY_RESPONSE_TEXT,
+    NO_CANDIDATE_PARTS_TEXT,
+    NON_TEXT_RESPONSE_TEXT,
+    LLMBackend,
+    LLMError,
+)
+from app.services.llm.admission import LLM_EXPECTED_OUTPUT_TOKENS, AdmissionRejected, llm_admission
+from app.services.llm.resilience import llm_circuit_breaker, llm_resilience
+from app.services.llm.routing import model_router
+from app.services.llm.tokens import estimate_tokens
 
 # .env ファイルから環境変数を読み込む (ローカル開発用)
 from dotenv import load_dotenv
 load_dotenv()
 
-# 環境変数からGemini APIキーを取得
-API_KEY = os.getenv("GEMINI_API_KEY")
-
-# APIキーが設定されているか確認
-if not API_KEY:
-    raise ValueError("GEMINI_API_KEY environment variable not set.")
-
-# Gemini API を設定
-genai.configure(api_key=API_KEY)
-
-# 使用するモデルを指定
-MODEL_NAME = "gemini-2.0-flash"
-
-# ChatMessage の role ('user', 'assistant') を Gemini API が期待する 'user', 'model' にマッピング
-ROLE_MAPPING = {
-    "user": "user",
-    "assistant": "model", # Gemini API は 'model' ロールを使用します
+# 使用するLLMバックエンド: gemini (Gemini API) / fake (ネットワークを使わない疑似バックエンド)
+LLM_BACKEND = os.getenv("LLM_BACKEND", "gemini")
+
+logger = logging.getLogger(__name__)
+
+# --- モードごとのシステム指示 ---
+# 各モードの大きなシステム指示は、会話履歴の先頭に user メッセージとして毎回付けるのではなく、
+# バックエンドにモードごとの固定指示として渡す（Gemini では system_instruction になる）。
+
+@dataclass(frozen=True)
+class CompiledPrompt:
+    """登録時に一度だけ作る、モードのシステム指示（リクエストごとに作り直さない）"""
+    mode: str
+    system_instruction: str
+    tokens: int # 見積もりトークン数（流量制御で毎回数え直さないように）
+
+# モード名 → システム指示（チャットのモードは chat_pipeline.register_mode で登録される）
+_mode_prompts: Dict[str, CompiledPrompt] = {}
+# 使用中のバックエンド（初回利用時に作成）
+_backend: Optional[LLMBackend] = None
+
+def _create_backend(name: str) -> LLMBackend:
+    """設定名に対応するバックエンドを作成する（使わないバックエンドの依存ライブラリは読み込まない）"""
+    if name == "gemini":
+        from app.services.llm.gemini_backend import GeminiBackend
+        return GeminiBackend()
+    if name == "fake":
+        from app.services.llm.fake_backend import FakeBackend
+        return FakeBackend()
+    raise ValueError(f"Unknown LLM_BACKEND: {name}")
+
+def get_backend() -> LLMBackend:
+    """使用中のバックエンドを返す"""
+    global _backend
+    if _backend is None:
+        _backend = _create_backend(LLM_BACKEND)
+        logger.info("Using LLM backend '%s'", _backend.name)
+    return _backend
+
+def set_backend(backend: LLMBackend) -> None:
+    """バックエンドを差し替える（ベンチマークやテストで疑似バックエンドを直接渡す場合など）"""
+    global _backend
+    _backend = backend
+
+def register_mode_prompt(mode: str, system_instruction: str) -> CompiledPrompt:
+    """モードのシステム指示を登録する。モデルは init_models() または初回利用時に作成される"""
+    prompt = CompiledPrompt(mode=mode, system_instruction=system_instruction, tokens=estimate_tokens(system_instruction))
+    _mode_prompts[mode] = prompt
+    return prompt
+
+def init_models() -> None:
+    """登録済みの全モードについてバックエンドの準備をする（アプリ起動時に一度だけ呼ぶ）"""
+    get_backend().prepare({mode: prompt.system_instruction for mode, prompt in _mode_prompts.items()})
+
+# バックエンドが「応答なし」の代わりに返す文言 → メトリクスの種類
+_RESPONSE_ISSUE_KINDS = {
+    BLOCKED_BY_SAFETY_TEXT: "safety_block",
+    BLOCKED_UNKNOWN_TEXT: "other_block",
+    EMPTY_RESPONSE_TEXT: "empty",
+    NO_CANDIDATE_PARTS_TEXT: "empty_candidate",
+    NON_TEXT_RESPONSE_TEXT: "non_text",
 }
 
+def _record_response_issue(mode: Optional[str], text: str) -> None:
+    """セーフティブロックや空の候補など、使える応答が得られなかった場合に数える"""
+    kind = _RESPONSE_ISSUE_KINDS.get(text)
+    if kind:
+        LLM_RESPONSE_ISSUES.labels(mode=mode or "none", kind=kind).inc()
+
+def _estimate_call_tokens(current_message_content: str, history: List[ChatMessage], mode: Optional[str]) -> int:
+    """1回の呼び出しで消費するトークン数の見積もり（入力 + 見込みの出力）"""
+    tokens = estimate_tokens(current_message_content) + LLM_EXPECTED_OUTPUT_TOKENS
+    tokens += sum(estimate_tokens(message.content) for message in history)
+    prompt = _mode_prompts.get(mode) if mode else None
+    return tokens + (prompt.tokens if prompt else 0)
+
+def check_llm_capacity() -> None:
+    """LLM呼び出しの待ち行列が一杯、またはサーキットブレーカーが開いていれば AdmissionRejected を送出する（ストリーミング開始前の確認用）"""
+    llm_circuit_breaker.check()
+    llm_admission.check_capacity()
+
+def _system_instruction(mode: Optional[str]) -> Optional[str]:
+    if mode is None:
+        return None
+    if mode not in _mode_prompts:
+        raise ValueError(f"Unknown chat mode: {mode}")
+    return _mode_prompts[mode].system_instruction
+
 async def generate_chat_response(
     current_message_content: str,
-    history: List[ChatMessage]
+    history: List[ChatMessage],
+    mode: Optional[str] = None,
 ) -> str:
     """
-    Gemini API を使用してチャット応答を生成する。
-    システム指示は history リストの最初のメッセージとして含めることを想定。
-    履歴は辞書形式に変換して渡す。
+    設定されたLLMバックエンドを使用してチャット応答を生成する。
+    システム指示は mode に対応する固定指示としてバックエンドに渡される。
 
     Args:
         current_message_content: ユーザーからの現在のメッセージ本文。
         history: 過去の会話履歴 (ChatMessage オブジェクトのリスト)。
-                 システム指示を含める場合は、リストの最初の要素として
-                 ChatMessage(role='user', content='指示内容') を含める。
+        mode: register_mode_prompt() で登録したモード名。None の場合はシステム指示なし。
 
     Returns:
         AIからの応答本文。
 
     Raises:
-        Exception: API呼び出し中にエラーが発生した場合。
+        LLMError: API呼び出し中にエラーが発生した場合。
+        AdmissionRejected: 混雑のため呼び出しを受け付けなかった場合（LLMError のサブクラス）。
+        LLMTimeoutError: モードの期限までに応答が得られなかった場合（LLMError のサブクラス）。
     """
-    print("--- Calling Gemini AI Service ---")
-    print(f"Current Message: {current_message_content[:50]}...")
-    print(f"History Length: {len(history)}")
-    print("-----------------------------")
+    if logger.isEnabledFor(logging.DEBUG):
+        logger.debug("Calling AI service", extra={
+            "message_preview": current_message_content[:50],
+            "history_length": len(history),
+        })
+
+    system_instruction = _system_instruction(mode)
+    backend = get_backend()
+    tokens = _estimate_call_tokens(current_message_content, history, mode)
+    # モード・長さ・質問の種類からモデルを選ぶ（再試行・ヘッジでは fallback のモデルを使う）
+    route = model_router.route(mode, current_message_content, history)
+    attempts = 0
+
+    async def attempt() -> str:
+        nonlocal attempts
+        model, timeout = route.model_for_attempt(attempts), route.timeout_for_attempt(attempts)
+        attempts += 1
+        # 混雑時は同時実行数・レート制限の空きを待つ（待ちきれなければ AdmissionRejected）
+        async with llm_admission.admit(tokens):
+            return await asyncio.wait_for(
+                backend.generate(current_message_content, history, mode, system_instruction, model),
+                timeout=timeout,
+            )
 
     try:
-        # 渡された history リストを Gemini API が受け付ける辞書形式のリストに変換
-        gemini_history: List[Dict[str, Any]] = []
-        for message in history:
-            role = ROLE_MAPPING.get(message.role)
-            if role:
-                 gemini_history.append({
-                     "role": role,
-                     "parts": [{"text": message.content}] # テキストは parts リストの中の辞書に入れる形式
-                 })
-            else:
-                 print(f"Warning: Unknown role in history: {message.role}. Skipping.")
-
-
-        # Gemini モデルインスタンスを取得
-        model = genai.GenerativeModel(MODEL_NAME)
-
-        # チャットセッションを開始
-        # 辞書形式のリストを history として渡します。
-        chat_session = model.start_chat(history=gemini_history)
-
-        # 現在のユーザーメッセージを送信し、応答を待つ
-        # send_message_async は非同期なので await します
-        response = await chat_session.send_message_async(current_message_content)
-
-        # 応答からテキスト部分を抽出して返す
-        if response.text:
-             return response.text
-        elif response.candidates:
-             # text 属性がない場合でも候補があればそれを返すなど、柔軟に対応
-             print(f"Warning: Response.text is empty, checking candidates.")
-             if response.candidates[0].content.parts:
-                 # 応答候補の最初のパートのテキストを返す
-                 if isinstance(response.candidates[0].content.parts[0], genai_types.TextPart):
-                     return response.candidates[0].content.parts[0].text
-                 else:
-                      # テキストパートでない場合（画像など）の考慮
-                      print(f"Warning: First candidate part is not text: {type(response.candidates[0].content.parts[0])}")
-                      return "AIからの応答がテキスト形式ではありませんでした。"
-             else:
-                 return "AIから有効な応答が得られませんでした（候補パートなし）。"
-        else:
-             print(f"Warning: AI response is empty or blocked. Response: {response}")
-             if response.prompt_feedback and response.prompt_feedback.block_reason:
-                  block_reason = response.prompt_feedback.block_reason
-                  print(f"Response was blocked due to: {block_reason}")
-                  if block_reason == genai_types.BlockedReason.SAFETY:
-                      return "不適切な内容のため応答を生成できませんでした。"
-                  else:
-                      return "AIによる応答生成に問題が発生しました（理由不明）。"
-             return "AIからの応答が得られませんでした。"
+        # モードの期限内で、一時的なエラーは再試行する（遅い場合はヘッジも送る）
+        text = await llm_resilience.call(
+            mode, attempt, backend.is_retryable,
+            allow_hedge=lambda: not llm_admission.has_waiters(),
+        )
+    except LLMError:
+        raise
+    except Exception as e:
+        logger.error("AI API call failed: %s", e)
+        raise LLMError(f"AIサービスとの通信中にエラーが発生しました: {e}") from e # API層でキャッチされるように例外を再Raise
+    _record_response_issue(mode, text)
+    return text
 
 
+async def generate_chat_response_stream(
+    current_message_content: str,
+    history: List[ChatMessage],
+    mode: Optional[str] = None,
+) -> AsyncIterator[str]:
+    """
+    設定されたLLMバックエンドのストリーミングを使用して、応答をチャンク単位で順次返す。
+    history と mode の扱いは generate_chat_response と同じ。
+
+    Yields:
+        AIからの応答本文の断片（届いた順）。
+
+    Raises:
+        LLMError: API呼び出し中、またはストリーム受信中にエラーが発生した場合。
+        AdmissionRejected: 混雑のため呼び出しを受け付けなかった場合（LLMError のサブクラス）。
+    """
+    if logger.isEnabledFor(logging.DEBUG):
+        logger.debug("Calling AI service (stream)", extra={
+            "message_preview": current_message_content[:50],
+            "history_length": len(history),
+        })
+
+    system_instruction = _system_instruction(mode)
+    backend = get_backend()
+    tokens = _estimate_call_tokens(current_message_content, history, mode)
+    route = model_router.route(mode, current_message_content, history)
+    attempts = 0
+
+    async def open_stream() -> AsyncIterator[str]:
+        nonlocal attempts
+        model, timeout = route.model_for_attempt(attempts), route.timeout_for_attempt(attempts)
+        attempts += 1
+        # 枠はストリームを最後まで読み終えるまで確保しておく
+        async with llm_admission.admit(tokens):
+            chunks = backend.stream(current_message_content, history, mode, system_instruction, model)
+            if timeout is not None:
+                # 最初の断片が timeout 秒以内に届かなければ、再試行で fallback のモデルに切り替える
+                try:
+                    yield await asyncio.wait_for(chunks.__anext__(), timeout=timeout)
+                except StopAsyncIteration:
+                    return
+            async for text in chunks:
+                yield text
+
+    try:
+        async for text in llm_resilience.stream(mode, open_stream, backend.is_retryable):
+            _record_response_issue(mode, text)
+            yield text
+    except LLMError:
+        raise
     except Exception as e:
-        print(f"An error occurred during AI API call: {e}")
-        raise Exception(f"AIサービスとの通信中にエラーが発生しました: {e}") # API層でキャッチされるように例外を再Raise
\ No newline at end of file
+        logger.error("AI API stream failed: %s", e)
+        raise LLMError(f"AIサービスとの通信中にエラーが発生しました: {e}") from e
@@ -0,0 +1,184 @@
+# app/services/chat_batch.py
+# 複数の生徒のターンをまとめて処理する（理解度評価の一括実行など）
+# 1件ずつ HTTP リクエストと LLM 呼び出しを順に行うと、クラス40人分で40回分の時間がかかる。
+# ここでは同時実行数を制限しながら LLM 呼び出しを並行させ、終わったものから
+# まとめてDBに保存し（グループコミット）、1件ずつ NDJSON の1行として返す。
+import asyncio
+import json
+import logging
+import os
+from typing import AsyncIterator, Dict, List, Optional, Tuple
+
+from app.core.logging import log_context
+from app.core.metrics import track_request
+from app.db import crud
+from app.db.database import AsyncSessionLocal
+from app.models.chat_models import BatchEvaluationItem, BatchEvaluationResult
+from app.services.ai_service import AdmissionRejected
+from app.services.chat_turn import HistoryLoader, ResponsePostProcessor, generate_turn_response, persist_learner_turns
+
+logger = logging.getLogger(__name__)
+
+# 1回の一括リクエストで同時に実行する LLM 呼び出しの上限
+# （アドミッションコントロールの待ち行列を1つの一括リクエストで埋めてしまわないように）
+CHAT_BATCH_CONCURRENCY = int(os.getenv("CHAT_BATCH_CONCURRENCY", "8"))
+# 1回の一括リクエストで受け付ける件数の上限
+CHAT_BATCH_MAX_ITEMS = int(os.getenv("CHAT_BATCH_MAX_ITEMS", "100"))
+
+ERROR_BUSY = "busy"
+ERROR_LLM = "llm_error"
+ERROR_PERSISTENCE = "persistence_error"
+ERROR_CONVERSATION_NOT_FOUND = "conversation_not_found" # conversation_id の会話がない
+ERROR_CONVERSATION_MISMATCH = "conversation_mismatch"   # conversation_id の会話が別の生徒のもの
+
+# (items での位置, AIの応答 or None, 失敗した場合の結果)
+_Completion = Tuple[int, Optional[str], Optional[BatchEvaluationResult]]
+
+def format_ndjson(result: BatchEvaluationResult) -> str:
+    return json.dumps(result.model_dump(exclude_none=True), ensure_ascii=False) + "\n"
+
+async def stream_batch_turns(
+    mode: str,
+    items: List[BatchEvaluationItem],
+    load_history: HistoryLoader,
+    post_processor: ResponsePostProcessor,
+) -> AsyncIterator[str]:
+    """
+    items の各生徒について1ターンずつ処理し、終わったものから結果を NDJSON で返す。
+    一部の生徒が失敗しても、その生徒の結果に error を入れて残りは続ける。
+    クライアントが切断した場合は、まだ終わっていない呼び出しを取り消す。
+    応答は post_processor で後処理し、取り出した点数（理解度評価）は応答と一緒に保存する。
+    """
+    logger.info("Processing batch of %d items in %s mode", len(items), mode)
+    semaphore = asyncio.Semaphore(CHAT_BATCH_CONCURRENCY)
+    completed: asyncio.Queue = asyncio.Queue()
+
+    async def run_item(index: int, item: BatchEvaluationItem) -> None:
+        async with semaphore:
+            await completed.put(await _generate_item(mode, index, item, load_history))
+
+    with track_request(f"{mode}_batch", stream=True):
+        # 続きの会話が使えない生徒は、AIを呼ぶ前に失敗として返す（保存のまとまりを巻き添えで失敗させない）
+        invalid = await _check_conversations(items)
+        for result in invalid.values():
+            yield format_ndjson(result)
+        tasks = [
+            asyncio.create_task(run_item(index, item))
+            for index, item in enumerate(items)
+            if index not in invalid
+        ]
+        try:
+            remaining = len(tasks)
+            while remaining:
+                # 1件目を待ち、その間に終わった分もまとめて1トランザクションで保存する
+                group: List[_Completion] = [await completed.get()]
+                while not completed.empty():
+                    group.append(completed.get_nowait())
+                remaining -= len(group)
+                for result in await _persist_group(mode, items, group, post_processor):
+                    yield format_ndjson(result)
+        finally:
+            for task in tasks:
+                task.cancel()
+
+async def _check_conversations(items: List[BatchEvaluationItem]) -> Dict[int, BatchEvaluationResult]:
+    """
+    conversation_id を指定した生徒について、会話が存在し、その生徒の会話であることを確かめる。
+    使えない生徒の items での位置 → 失敗の結果 を返す。生徒の分からない会話 (learner_id なし) は使ってよい。
+    """
+    conversation_ids = [item.conversation_id for item in items if item.conversation_id is not None]
+    if not conversation_ids:
+        return {}
+    async with AsyncSessionLocal() as db:
+        learners = await crud.get_conversation_learners_async(db, conversation_ids)
+    invalid: Dict[int, BatchEvaluationResult] = {}
+    for index, item in enumerate(items):
+        if item.conversation_id is None:
+            continue
+        if item.conversation_id not in learners:
+            error = ERROR_CONVERSATION_NOT_FOUND
+        elif learners[item.conversation_id] not in (None, item.learner_id):
+            error = ERROR_CONVERSATION_MISMATCH
+        else:
+            continue
+        logger.warning("Batch item %d skipped: %s", index, error)
+        invalid[index] = BatchEvaluationResult(
+            index=index, learner_id=item.learner_id, conversation_id=item.conversation_id, error=error,
+        )
+    return invalid
+
+async def _generate_item(mode: str, index: int, item: BatchEvaluationItem, load_history: HistoryLoader) -> _Completion:
+    def failed(error: str, retry_after: Optional[str] = None) -> _Completion:
+        return index, None, BatchEvaluationResult(
+            index=index,
+            learner_id=item.learner_id,
+            conversation_id=item.conversation_id,
+            error=error,
+            retry_after=retry_after,
+        )
+
+    with log_context(learner_id=item.learner_id, conversation_id=item.conversation_id):
+        try:
+            # LLM を待つ間はDB接続を持たないよう、履歴の読み込みだけセッションを開く
+            async with AsyncSessionLocal() as db:
+                history = await load_history(db, item.conversation_id)
+            return index, await generate_turn_response(item.answer, history, mode), None
+        except AdmissionRejected as e:
+            logger.warning("Batch item %d rejected: LLM is busy (%s)", index, e.reason)
+            return failed(ERROR_BUSY, e.retry_after_header)
+        except Exception:
+            logger.exception("Batch item %d failed", index)
+            return failed(ERROR_LLM)
+
+async def _persist_group(
+    mode: str,
+    items: List[BatchEvaluationItem],
+    group: List[_Completion],
+    post_processor: ResponsePostProcessor,
+) -> List[BatchEvaluationResult]:
+    results = [failure for _, _, failure in group if failure is not None]
+    succeeded = [(index, response) for index, response, failure in group if failure is None]
+    if not succeeded:
+        return results
+
+    turns = []
+    for position, (index, response) in enumerate(succeeded):
+        response, evaluation = post_processor.split(response)
+        succeeded[position] = (index, response)
+        turns.append(crud.LearnerTurnRecord(items[index].conversation_id, items[index].learner_id, items[index].answer, response, evaluation))
+    try:
+        async with AsyncSessionLocal() as db:
+            conversation_ids: List[Optional[int]] = list(await persist_learner_turns(db, turns, mode))
+    except Exception:
+        if len(turns) == 1:
+            logger.exception("Failed to persist batch item %d", succeeded[0][0])
+            conversation_ids = [None]
+        else:
+            # まとめての保存に失敗したら1件ずつ保存し直し、失敗の原因になった生徒だけを失敗にする
+            logger.warning("Failed to persist %d batch items together; retrying one by one", len(turns), exc_info=True)
+            conversation_ids = [await _persist_one(mode, index, turn) for (index, _), turn in zip(succeeded, turns)]
+    return results + [
+        BatchEvaluationResult(
+            index=index,
+            learner_id=items[index].learner_id,
+            conversation_id=conversation_id,
+            response=response,
+        )
+        if conversation_id is not None else
+        BatchEvaluationResult(
+            index=index,
+            learner_id=items[index].learner_id,
+            conversation_id=items[index].conversation_id,
+            error=ERROR_PERSISTENCE,
+        )
+        for (index, response), conversation_id in zip(succeeded, conversation_ids)
+    ]
+
+async def _persist_one(mode: str, index: int, turn: crud.LearnerTurnRecord) -> Optional[int]:
+    """1件だけ保存し、会話IDを返す（失敗した場合は None）"""
+    try:
+        async with AsyncSessionLocal() as db:
+            return (await persist_learner_turns(db, [turn], mode))[0]
+    except Exception:
+        logger.exception("Failed to persist batch item %d", index)
+        return None
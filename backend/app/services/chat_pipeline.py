@@ -0,0 +1,242 @@
+# app/services/chat_pipeline.py
+# チャットのモードの登録と、1ターン分の処理の流れ（パイプライン）
+# モードごとに違うのは、システム指示・モデル・AIに渡す履歴・応答の後処理だけなので、これを ChatMode で宣言し、
+# 「履歴の読み込み → 作成済みの応答 or AI呼び出し → 後処理 → 保存」の流れは全モードで共通にする。
+# キャッシュ・メトリクス・保存方式などの改善は各段階 (chat_turn など) に入れれば、全モードに効く。
+# 設定ファイル (CHAT_MODES_PATH, JSON) に書けば、コードを変えずにモードを追加できる（/chat/modes/{mode} で呼び出す）。
+import json
+import logging
+import os
+import re
+from dataclasses import dataclass, fields
+from typing import Any, AsyncIterator, Awaitable, Callable, Dict, List, Optional
+
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from app.models.chat_models import BatchEvaluationItem, ChatMessage, ChatRequest, ChatResponse
+from app.services.ai_service import CompiledPrompt, register_mode_prompt
+from app.services.chat_batch import stream_batch_turns
+from app.services.chat_stream import stream_chat_turn
+from app.services.chat_turn import (
+    PreparedResponse,
+    ResponsePostProcessor,
+    generate_turn_response,
+    load_full_history,
+    load_history,
+    persist_turn,
+)
+from app.services.evaluation_scores import EvaluationPostProcessor, compact_history_with_scores
+from app.services.history_window import DEFAULT_HISTORY_TOKEN_BUDGETS
+from app.services.llm.resilience import DEFAULT_LLM_TIMEOUTS
+from app.services.llm.routing import model_router
+from app.services.question_pool import question_pool
+
+logger = logging.getLogger(__name__)
+
+# 追加のモードを定義する設定ファイル (JSON) のパス。未指定なら組み込みの4モードだけ
+CHAT_MODES_PATH = os.getenv("CHAT_MODES_PATH")
+
+# --- 各段階の実装（ChatMode からは名前で指定する） ---
+
+# AIに渡す履歴
+HISTORY_WINDOW = "window"                       # 履歴キャッシュ + トークン予算による切り詰め
+HISTORY_EVALUATION_SCORES = "evaluation_scores" # 上に加え、点数の履歴がある会話は「点数の要約 + 直近のメッセージ」にする
+HISTORY_NONE = "none"                           # 履歴を渡さない（1問1答のモード）
+
+async def _windowed_history(db: AsyncSession, conversation_id: Optional[int], mode: str) -> List[ChatMessage]:
+    return await load_history(db, conversation_id, mode)
+
+async def _history_with_scores(db: AsyncSession, conversation_id: Optional[int], mode: str) -> List[ChatMessage]:
+    history = await load_history(db, conversation_id, mode)
+    return await compact_history_with_scores(db, conversation_id, history)
+
+async def _no_history(db: AsyncSession, conversation_id: Optional[int], mode: str) -> List[ChatMessage]:
+    return []
+
+HISTORY_POLICIES: Dict[str, Callable[[AsyncSession, Optional[int], str], Awaitable[List[ChatMessage]]]] = {
+    HISTORY_WINDOW: _windowed_history,
+    HISTORY_EVALUATION_SCORES: _history_with_scores,
+    HISTORY_NONE: _no_history,
+}
+
+# AIを呼ぶ前に試す、作成済みの応答
+PREPARED_QUESTION_POOL = "question_pool"
+
+async def _serve_pooled_question(db: AsyncSession, conversation_id: Optional[int], source_problem: str) -> Optional[str]:
+    """類似問題プールから、この会話でまだ出題していない問題を取り出す（なければ None）"""
+    # AIに渡す履歴は古いターンが要約に置き換わっていることがあるので、全履歴から出題済みの問題を集める
+    history = await load_full_history(db, conversation_id) if conversation_id is not None else []
+    already_asked = {message.content for message in history if message.role == "assistant"}
+    return question_pool.serve(source_problem, exclude=already_asked)
+
+PREPARED_RESPONSES: Dict[str, PreparedResponse] = {
+    PREPARED_QUESTION_POOL: _serve_pooled_question,
+}
+
+# 応答の後処理
+POST_NONE = "none"
+POST_EVALUATION_SCORES = "evaluation_scores" # 点数ブロックを取り出して保存する
+
+POST_PROCESSORS: Dict[str, ResponsePostProcessor] = {
+    POST_NONE: ResponsePostProcessor(),
+    POST_EVALUATION_SCORES: EvaluationPostProcessor(),
+}
+
+# モード名はメトリクスのラベルと環境変数名 (HISTORY_TOKEN_BUDGET_<MODE> など) にも使う
+_MODE_NAME = re.compile(r"^[a-z][a-z0-9_]*$")
+
+@dataclass(frozen=True)
+class ChatMode:
+    """モードの宣言（設定ファイルの1件と同じ項目）"""
+    name: str
+    system_instruction: str
+    label: Optional[str] = None                # ログ・エラーメッセージでの呼び名（省略時は name）
+    history: str = HISTORY_WINDOW              # HISTORY_POLICIES のキー
+    prepared_response: Optional[str] = None    # PREPARED_RESPONSES のキー
+    post_processing: str = POST_NONE           # POST_PROCESSORS のキー
+    model: Optional[str] = None                # 指定するとルール表より優先してこのモデルを使う
+    fallback_model: Optional[str] = None       # model のエラー・タイムアウト時に使うモデル
+    history_token_budget: Optional[int] = None # 履歴のトークン予算（省略時は既定の 4000）
+    timeout_seconds: Optional[float] = None    # 再試行を含めたAI呼び出しの期限（省略時は LLM_TIMEOUT_SECONDS）
+
+    @classmethod
+    def from_config(cls, entry: Dict[str, Any], base_dir: str) -> "ChatMode":
+        """
+        設定ファイルの1件からモードを作る。
+        長いシステム指示は system_instruction_file（設定ファイルからの相対パス）に分けて書ける。
+        """
+        entry = dict(entry)
+        instruction_file = entry.pop("system_instruction_file", None)
+        if instruction_file:
+            with open(os.path.join(base_dir, instruction_file), encoding="utf-8") as f:
+                entry["system_instruction"] = f.read()
+        unknown = set(entry) - {field.name for field in fields(cls)}
+        if unknown:
+            raise ValueError(f"Unknown chat mode settings: {sorted(unknown)}")
+        return cls(**entry)
+
+    def validate(self) -> None:
+        if not _MODE_NAME.match(self.name):
+            raise ValueError(f"Invalid chat mode name: {self.name!r}")
+        if not self.system_instruction.strip():
+            raise ValueError(f"Chat mode {self.name} has no system instruction")
+        if self.history not in HISTORY_POLICIES:
+            raise ValueError(f"Unknown history policy for chat mode {self.name}: {self.history}")
+        if self.prepared_response is not None and self.prepared_response not in PREPARED_RESPONSES:
+            raise ValueError(f"Unknown prepared response for chat mode {self.name}: {self.prepared_response}")
+        if self.post_processing not in POST_PROCESSORS:
+            raise ValueError(f"Unknown post processing for chat mode {self.name}: {self.post_processing}")
+
+class ChatPipeline:
+    """
+    1つのモードの1ターン分の処理。登録時に一度だけ組み立てる
+    （システム指示のトークン数の見積もりや、各段階の実装の解決をリクエストごとに行わない）。
+
+    - run: 通常のエンドポイント（応答全体を返す）
+    - stream: ストリーミング (SSE) のエンドポイント
+    - batch: 複数の生徒の一括処理 (NDJSON)
+    """
+
+    def __init__(self, mode: ChatMode):
+        self.mode = mode
+        self.name = mode.name
+        self.label = mode.label or mode.name
+        self.prompt: CompiledPrompt = register_mode_prompt(mode.name, mode.system_instruction)
+        self._history_policy = HISTORY_POLICIES[mode.history]
+        self._prepared_response = PREPARED_RESPONSES[mode.prepared_response] if mode.prepared_response else None
+        self._post_processor = POST_PROCESSORS[mode.post_processing]
+
+    async def load_history(self, db: AsyncSession, conversation_id: Optional[int]) -> List[ChatMessage]:
+        """AIに渡す会話履歴（新しい会話なら空）"""
+        return await self._history_policy(db, conversation_id, self.name)
+
+    async def run(self, db: AsyncSession, request: ChatRequest) -> ChatResponse:
+        """チャットリクエストを処理し、AIの応答と会話IDを返す"""
+        logger.debug("Processing %s mode request", self.label)
+
+        try:
+            conversation_id = request.conversation_id
+            question = request.question
+
+            # 1. 会話履歴を取得（新しい会話の会話エントリは、ステップ3でメッセージと同じトランザクションで作成する）
+            history = await self.load_history(db, conversation_id)
+
+            # 2. 作成済みの応答があればそれを使い、なければAIサービスを呼び出す
+            # システム指示は mode に対応するモデルの system_instruction として渡される
+            evaluation = None
+            response_text = await self._prepared_response(db, conversation_id, question) if self._prepared_response else None
+            if response_text is None:
+                response_text = await generate_turn_response(question, history, self.name)
+                response_text, evaluation = self._post_processor.split(response_text)
+
+            # 3. ユーザーの質問とAIの応答をDBに保存
+            conversation_id = await persist_turn(
+                db, conversation_id, question, response_text, self.name, evaluation, request.learner_id,
+            )
+            return ChatResponse(response=response_text, conversation_id=conversation_id)
+
+        except Exception as e:
+            logger.error("Service error in %s mode: %s", self.label, e)
+            raise # API層でキャッチさせるため再Raise
+
+    def stream(self, request: ChatRequest) -> AsyncIterator[str]:
+        """
+        チャットリクエストをストリーミング (SSE) で処理する。
+        DBセッションはストリーム側で開くため、引数には取らない。
+        """
+        return stream_chat_turn(
+            mode=self.name,
+            mode_label=self.label,
+            conversation_id=request.conversation_id,
+            question=request.question,
+            load_history=self.load_history,
+            post_processor=self._post_processor,
+            ready_response=self._prepared_response,
+            learner_id=request.learner_id,
+        )
+
+    def batch(self, items: List[BatchEvaluationItem]) -> AsyncIterator[str]:
+        """
+        複数の生徒の回答をまとめて処理し、終わった生徒から結果を NDJSON で返す。
+        DBセッションは生徒ごと・保存のまとまりごとに開くため、引数には取らない。
+        """
+        return stream_batch_turns(self.name, items, self.load_history, self._post_processor)
+
+# モード名 → 組み立て済みのパイプライン
+_pipelines: Dict[str, ChatPipeline] = {}
+
+def register_mode(mode: ChatMode) -> ChatPipeline:
+    """モードを登録する（import 時・設定ファイルの読み込み時。init_models() より前に行う）"""
+    mode.validate()
+    if mode.name in _pipelines:
+        raise ValueError(f"Chat mode already registered: {mode.name}")
+    if mode.history_token_budget is not None:
+        DEFAULT_HISTORY_TOKEN_BUDGETS[mode.name] = mode.history_token_budget
+    if mode.timeout_seconds is not None:
+        DEFAULT_LLM_TIMEOUTS[mode.name] = mode.timeout_seconds
+    if mode.model is not None or mode.fallback_model is not None:
+        model_router.pin_mode(mode.name, mode.model, mode.fallback_model)
+    pipeline = ChatPipeline(mode)
+    _pipelines[mode.name] = pipeline
+    return pipeline
+
+def get_pipeline(name: str) -> Optional[ChatPipeline]:
+    """登録済みのモードのパイプライン（なければ None）"""
+    return _pipelines.get(name)
+
+def registered_modes() -> List[ChatMode]:
+    return [pipeline.mode for pipeline in _pipelines.values()]
+
+def load_configured_modes(path: Optional[str] = CHAT_MODES_PATH) -> List[ChatPipeline]:
+    """
+    設定ファイル (JSON のモードの配列) のモードを登録する。
+    項目は ChatMode と同じ。組み込みのモードと同じ名前は使えない。
+    """
+    if not path:
+        return []
+    with open(path, encoding="utf-8") as f:
+        entries = json.load(f)
+    base_dir = os.path.dirname(os.path.abspath(path))
+    pipelines = [register_mode(ChatMode.from_config(entry, base_dir)) for entry in entries]
+    logger.info("Loaded %d chat modes from %s", len(pipelines), path)
+    return pipelines
@@ -0,0 +1,116 @@
+# app/services/chat_stream.py
+# 全モード共通：AIの応答を Server-Sent Events (SSE) 形式で順次返すための処理
+import json
+import logging
+from typing import AsyncIterator, List, Optional
+
+from app.db.database import AsyncSessionLocal
+from app.models.chat_models import ChatMessage
+from app.core.metrics import track_request
+from app.db.crud import ConversationNotFound
+from app.services.ai_service import AdmissionRejected
+from app.services.chat_turn import HistoryLoader, PreparedResponse, ResponsePostProcessor, persist_turn, stream_turn_response
+
+logger = logging.getLogger(__name__)
+
+# SSE のイベント名
+EVENT_TOKEN = "token"   # 応答テキストの断片
+EVENT_DONE = "done"     # ストリーム終了（conversation_id を含む）
+EVENT_ERROR = "error"   # 途中でエラーが発生した場合
+
+def format_sse(event: str, data: dict) -> str:
+    """1件分のイベントを SSE のテキスト形式に整形する"""
+    payload = json.dumps(data, ensure_ascii=False)
+    return f"event: {event}\ndata: {payload}\n\n"
+
+async def stream_chat_turn(
+    mode: str,
+    mode_label: str,
+    conversation_id: Optional[int],
+    question: str,
+    load_history: HistoryLoader,
+    post_processor: ResponsePostProcessor,
+    ready_response: Optional[PreparedResponse] = None,
+    learner_id: Optional[str] = None,
+) -> AsyncIterator[str]:
+    """
+    1ターン分のチャットをストリーミングで処理する（各段階の処理はモードの ChatPipeline から渡される）。
+
+    StreamingResponse はリクエスト用のDBセッション (get_async_db) が閉じた後も続くため、
+    ここでは独自にセッションを開いて履歴取得・保存を行う。
+    ユーザーの質問とAIの応答は、ストリームが最後まで完了した時点で保存する。
+
+    ready_response が作成済みの応答（類似問題プールなど）を返した場合は、
+    AIを呼ばずにそれを1回の token イベントで返す。
+    post_processor のフィルターで、クライアントに送らない部分（理解度評価の点数ブロックなど）を取り除き、
+    取り出した点数は応答と一緒に保存する。
+    learner_id は新しい会話を作成する場合に、その会話の生徒として記録する。
+
+    Yields:
+        SSE 形式の文字列 (token イベント → 最後に done イベント)
+    """
+    logger.debug("Processing %s mode stream request", mode_label)
+
+    with track_request(mode, stream=True) as request_outcome:
+        async with AsyncSessionLocal() as db:
+            try:
+                # 1. 会話の特定（新しい会話はステップ4で作成する）
+                if conversation_id is not None:
+                    logger.debug("Using existing conversation")
+
+                # 2. 会話履歴を取得（システム指示は mode のモデルに設定済み）
+                history_for_ai: List[ChatMessage] = await load_history(db, conversation_id)
+
+                # 3. AIサービスをストリーミングで呼び出し、届いたチャンクを後処理して返す
+                chunks: List[str] = []
+                response_filter = post_processor.stream_filter()
+                prepared = await ready_response(db, conversation_id, question) if ready_response else None
+                if prepared is not None:
+                    chunks.append(prepared)
+                    yield format_sse(EVENT_TOKEN, {"text": prepared})
+                else:
+                    async for text in stream_turn_response(question, history_for_ai, mode):
+                        text = response_filter.feed(text)
+                        if not text:
+                            continue
+                        chunks.append(text)
+                        yield format_sse(EVENT_TOKEN, {"text": text})
+                    text = response_filter.finish()
+                    if text:
+                        chunks.append(text)
+                        yield format_sse(EVENT_TOKEN, {"text": text})
+
+                # 4. ストリーム完了後にユーザーの質問とAIの応答をDBに保存
+                ai_response_text = response_filter.stored_text(chunks)
+                conversation_id = await persist_turn(
+                    db, conversation_id, question, ai_response_text, mode, response_filter.evaluation, learner_id,
+                )
+
+                # 5. 最後に conversation_id を通知
+                yield format_sse(EVENT_DONE, {"conversation_id": conversation_id})
+
+            except AdmissionRejected as e:
+                # 混雑でAIを呼べなかった。クライアントには retry_after 秒後の再試行を促す
+                request_outcome.mark_error()
+                yield format_sse(EVENT_ERROR, {
+                    "detail": "AI is busy. Please retry later.",
+                    "retry_after": e.retry_after_header,
+                    "conversation_id": conversation_id,
+                })
+            except ConversationNotFound:
+                # 古い・誤った会話IDが送られた（非ストリーミング版の 404 に当たる）
+                logger.warning("Conversation %d not found", conversation_id)
+                request_outcome.mark_error()
+                yield format_sse(EVENT_ERROR, {
+                    "detail": "Conversation not found",
+                    "status": 404,
+                    "conversation_id": conversation_id,
+                })
+            except Exception:
+                # ヘッダー送信後なので HTTPException は使えない。エラーイベントとして通知する
+                logger.exception("Service error in %s mode stream", mode_label)
+                request_outcome.mark_error()
+                yield format_sse(EVENT_ERROR, {
+                    "detail": f"Internal Server Error processing {mode_label} mode stream request",
+                    "conversation_id": conversation_id,
+                })
@@ -0,0 +1,207 @@
+# app/services/chat_turn.py
+# 4つのモード共通：1ターン分の会話履歴の読み込み、AI呼び出し、保存
+import logging
+from typing import AsyncIterator, Awaitable, Callable, List, Optional, Tuple
+
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from app.db import crud
+from app.db.models import EvaluationScore
+from app.core.logging import bind_log_context
+from app.core.metrics import (
+    STAGE_CONVERSATION_CREATE,
+    STAGE_HISTORY_LOAD,
+    STAGE_LLM_CALL,
+    STAGE_PERSISTENCE,
+    STAGE_PROMPT_BUILD,
+    observe_stage,
+)
+from app.db.read_routing import history_read_session
+from app.db.turn_writer import TURN_PERSISTENCE_MODE, turn_writer
+from app.models.chat_models import ChatMessage
+from app.services.ai_service import generate_chat_response, generate_chat_response_stream
+from app.services.history_cache import history_cache
+from app.services.history_window import apply_history_window
+
+logger = logging.getLogger(__name__)
+
+# ライトビハインドの書き込みに失敗した会話は、キャッシュの内容がDBと食い違うので破棄する
+turn_writer.add_failure_listener(history_cache.invalidate)
+
+# モードの履歴の読み込み (db, conversation_id) → AIに渡す履歴（chat_pipeline のモードごとに組み立てる）
+HistoryLoader = Callable[[AsyncSession, Optional[int]], Awaitable[List[ChatMessage]]]
+# (db, conversation_id, 質問) → 作成済みの応答（類似問題プールなど）。なければ None でAIを呼ぶ
+PreparedResponse = Callable[[AsyncSession, Optional[int], str], Awaitable[Optional[str]]]
+
+class ResponseStreamFilter:
+    """ストリーミングの断片の後処理（既定は何もしない）"""
+
+    evaluation: Optional[EvaluationScore] = None
+
+    def feed(self, text: str) -> str:
+        """断片を受け取り、利用者に送ってよい部分を返す"""
+        return text
+
+    def finish(self) -> str:
+        """ストリームの終わりに呼ぶ。保留していた本文を返す"""
+        return ""
+
+    def stored_text(self, chunks: List[str]) -> str:
+        """送った断片から、保存する応答の本文を作る"""
+        return "".join(chunks)
+
+class ResponsePostProcessor:
+    """AIの応答の後処理（既定は何もしない）。応答から構造化データを取り出すモードで差し替える"""
+
+    def split(self, text: str) -> Tuple[str, Optional[EvaluationScore]]:
+        """AIの応答を、表示・保存する本文と、一緒に保存する点数 (なければ None) に分ける"""
+        return text, None
+
+    def stream_filter(self) -> ResponseStreamFilter:
+        """ストリーミング1回分の後処理を作る"""
+        return ResponseStreamFilter()
+
+async def load_history(db: AsyncSession, conversation_id: Optional[int], mode: str) -> List[ChatMessage]:
+    """
+    AIに渡す会話履歴を取得する。
+    新しい会話 (conversation_id が None) の場合は履歴がないのでDBにアクセスしない。
+    履歴キャッシュにある会話もDBにはアクセスしない。
+    存在しない会話IDなら、AIを呼ぶ前に crud.ConversationNotFound を送出する。
+    長い会話は、モードのトークン予算に合わせて「要約 + 直近のターン」に切り詰める。
+    """
+    if conversation_id is None:
+        return []
+    with observe_stage(mode, STAGE_HISTORY_LOAD):
+        history = await load_full_history(db, conversation_id)
+    with observe_stage(mode, STAGE_PROMPT_BUILD):
+        return await apply_history_window(db, conversation_id, mode, history)
+
+async def generate_turn_response(question: str, history: List[ChatMessage], mode: str) -> str:
+    """モードのAI応答を生成する（所要時間を llm_call 段階として記録）"""
+    with observe_stage(mode, STAGE_LLM_CALL):
+        return await generate_chat_response(
+            current_message_content=question,
+            history=history,
+            mode=mode,
+        )
+
+async def stream_turn_response(question: str, history: List[ChatMessage], mode: str) -> AsyncIterator[str]:
+    """モードのAI応答をストリーミングで生成する（最後の断片までの時間を llm_call 段階として記録）"""
+    with observe_stage(mode, STAGE_LLM_CALL):
+        async for text in generate_chat_response_stream(
+            current_message_content=question,
+            history=history,
+            mode=mode,
+        ):
+            yield text
+
+async def load_full_history(db: AsyncSession, conversation_id: int) -> List[ChatMessage]:
+    """会話の全履歴（要約・切り詰め前。履歴キャッシュにあればDBにアクセスしない）"""
+    cached = history_cache.get(conversation_id)
+    if cached is not None:
+        return cached
+
+    # 読み込みの間に同じ会話のターンが保存された場合、読んだ履歴は古いかもしれないのでキャッシュしない
+    load = history_cache.begin_load(conversation_id)
+    history: Optional[List[ChatMessage]] = None
+    try:
+        # 読み取り用エンジンがあればそちらで読む（直前に書き込んだ会話は書き込み用のまま）
+        async with history_read_session(db, conversation_id) as read_db:
+            db_messages = await crud.get_conversation_history_async(read_db, conversation_id)
+            # メッセージがなければ会話の有無を確かめる（メッセージのある会話では追加のクエリは発生しない）
+            if not db_messages and not await crud.conversation_exists_async(read_db, conversation_id):
+                raise crud.ConversationNotFound(conversation_id)
+        history = crud.messages_to_chat_messages(db_messages)
+        if turn_writer.running:
+            # ライトビハインド中は、まだコミットされていないターンも履歴に含める
+            history += turn_writer.pending_messages(conversation_id)
+    finally:
+        history_cache.finish_load(load, history)
+    return history
+
+async def persist_turn(
+    db: AsyncSession,
+    conversation_id: Optional[int],
+    user_content: str,
+    assistant_content: str,
+    mode: str,
+    evaluation: Optional[EvaluationScore] = None,
+    learner_id: Optional[str] = None,
+) -> int:
+    """
+    ユーザーの質問とAIの応答を保存し、会話IDを返す。
+    evaluation (理解度評価の点数) があれば、AIの応答と一緒に保存する。
+    learner_id は新しい会話を作成する場合に、その会話の生徒として記録する。
+
+    - transaction: 会話の作成 + 2件のメッセージを1トランザクションで保存
+    - write_behind: メッセージはバックグラウンドライターに渡してまとめて保存
+      (新しい会話の場合のみ、会話IDを返すために会話行だけ先に作成する)
+
+    保存できたターンは履歴キャッシュに追記する。保存に失敗した場合はキャッシュを破棄する。
+    """
+    new_messages = [
+        ChatMessage(role="user", content=user_content),
+        ChatMessage(role="assistant", content=assistant_content),
+    ]
+
+    if TURN_PERSISTENCE_MODE == "write_behind" and turn_writer.running:
+        if conversation_id is None:
+            with observe_stage(mode, STAGE_CONVERSATION_CREATE):
+                conversation = await crud.create_conversation_async(db, learner_id)
+            conversation_id = conversation.id
+            bind_log_context(conversation_id=conversation_id)
+            logger.info("Created new conversation")
+            history_cache.put(conversation_id, [])
+        with observe_stage(mode, STAGE_PERSISTENCE):
+            await turn_writer.submit(crud.TurnRecord(conversation_id, user_content, assistant_content, evaluation))
+        history_cache.append(conversation_id, new_messages)
+        return conversation_id
+
+    is_new = conversation_id is None
+    try:
+        # transaction モードでは会話の作成も保存と同じトランザクションなので persistence に含まれる
+        with observe_stage(mode, STAGE_PERSISTENCE):
+            conversation_id = await crud.save_turn_async(db, conversation_id, user_content, assistant_content, evaluation, learner_id)
+    except BaseException:
+        # 取り消された（クライアントの切断）場合も、コミットされたかどうか分からないのでキャッシュを破棄する
+        if not is_new:
+            history_cache.invalidate(conversation_id)
+        raise
+
+    if is_new:
+        bind_log_context(conversation_id=conversation_id)
+        logger.info("Created new conversation")
+        # 新しい会話は履歴がこのターンだけと分かっているので、そのまま登録しておく
+        history_cache.put(conversation_id, new_messages)
+    else:
+        history_cache.append(conversation_id, new_messages)
+    return conversation_id
+
+async def persist_learner_turns(
+    db: AsyncSession,
+    turns: List[crud.LearnerTurnRecord],
+    mode: str,
+) -> List[int]:
+    """
+    複数の生徒のターン（一括評価など）を1トランザクションで保存し、各ターンの会話IDを返す。
+    保存できたターンは履歴キャッシュに追記する。保存に失敗した場合は既存の会話のキャッシュを破棄する。
+    """
+    try:
+        with observe_stage(mode, STAGE_PERSISTENCE):
+            conversation_ids = await crud.save_learner_turns_async(db, turns)
+    except BaseException:
+        for turn in turns:
+            if turn.conversation_id is not None:
+                history_cache.invalidate(turn.conversation_id)
+        raise
+
+    for conversation_id, turn in zip(conversation_ids, turns):
+        new_messages = [
+            ChatMessage(role="user", content=turn.user_content),
+            ChatMessage(role="assistant", content=turn.assistant_content),
+        ]
+        if turn.conversation_id is None:
+            history_cache.put(conversation_id, new_messages)
+        else:
+            history_cache.append(conversation_id, new_messages)
+    return conversation_ids
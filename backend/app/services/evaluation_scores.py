@@ -0,0 +1,222 @@
+# app/services/evaluation_scores.py
+# 理解度評価の点数の構造化データ
+# 理解度評価モードでは、表示用のレポートの後ろに、点数を JSON で書いたブロックを付けさせる。
+# ブロックは利用者には見せずに取り出し、evaluation_scores テーブルに保存する。
+# 次回以降の評価では、過去の会話全体の代わりに点数の履歴の要約をAIに渡す（前回比を出すため）。
+import json
+import logging
+import os
+from typing import Any, List, Optional, Tuple
+
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from app.db import crud
+from app.db.models import EvaluationScore, EvaluationSubjectScore
+from app.models.chat_models import ChatMessage
+from app.services.chat_turn import ResponsePostProcessor, ResponseStreamFilter
+
+logger = logging.getLogger(__name__)
+
+# 点数の履歴の要約に含める直近の評価の数
+EVALUATION_SCORE_HISTORY_LIMIT = int(os.getenv("EVALUATION_SCORE_HISTORY_LIMIT", "5"))
+# 点数の履歴がある会話で、要約と一緒にそのまま渡す直近のメッセージ数（ターンの途中から始まる分は切り捨てる。0 なら渡さない）
+EVALUATION_RECENT_MESSAGES = int(os.getenv("EVALUATION_RECENT_MESSAGES", "4"))
+
+EVALUATION_BLOCK_START = "<<<EVALUATION_JSON"
+EVALUATION_BLOCK_END = "EVALUATION_JSON>>>"
+
+# 点数ブロックの JSON Schema（AIへの指示に含める）
+EVALUATION_JSON_SCHEMA = {
+    "type": "object",
+    "properties": {
+        "understanding": {"type": "integer", "minimum": 0, "maximum": 100, "description": "理解度(%)"},
+        "scores": {
+            "type": "object",
+            "properties": {
+                "basic_understanding": {"type": "integer", "minimum": 0, "maximum": 40, "description": "基礎的な理解度"},
+                "expression": {"type": "integer", "minimum": 0, "maximum": 20, "description": "説明・表現力"},
+                "application": {"type": "integer", "minimum": 0, "maximum": 20, "description": "応用力・創造性"},
+                "attitude": {"type": "integer", "minimum": 0, "maximum": 20, "description": "学習意欲・態度"},
+            },
+        },
+        "stumbling_points": {
+            "type": "array",
+            "items": {"type": "string", "enum": ["概念理解の不足", "基礎知識の欠如", "説明力の不足", "応用力の不足"]},
+        },
+        "subjects": {
+            "type": "array",
+            "items": {
+                "type": "object",
+                "properties": {
+                    "subject": {"type": "string"},
+                    "score": {"type": "integer", "minimum": 0, "maximum": 100},
+                },
+                "required": ["subject", "score"],
+            },
+        },
+    },
+    "required": ["understanding", "scores"],
+}
+
+EVALUATION_OUTPUT_INSTRUCTION = f"""
+    【構造化データ】
+    理解度の評価を行った回答では、レスポンスフォーマットの最後に、評価の数値を次の JSON Schema に従う JSON で出力してください。
+    JSON は {EVALUATION_BLOCK_START} の行と {EVALUATION_BLOCK_END} の行ではさみ、前後に他の文字を入れないでください。
+    評価を行っていない回答（類似問題の出題や、過程の質問）では出力しないでください。
+    {json.dumps(EVALUATION_JSON_SCHEMA, ensure_ascii=False)}
+"""
+
+SCORE_SUMMARY_TEMPLATE = "【これまでの理解度評価の記録（古い順）】\n{lines}\n前回比は、この記録の最後の評価と比べて求めてください。"
+SCORE_SUMMARY_ACK_MESSAGE = "わかりました。これまでの評価の記録をふまえて評価します。"
+
+def _bounded_int(value: Any, maximum: int) -> Optional[int]:
+    if isinstance(value, bool) or not isinstance(value, (int, float)):
+        return None
+    return max(0, min(maximum, int(round(value))))
+
+def parse_evaluation_block(raw: str) -> Optional[EvaluationScore]:
+    """点数ブロックの中身を EvaluationScore（未保存）にする。解釈できなければ None"""
+    start, end = raw.find("{"), raw.rfind("}")
+    if start < 0 or end < start:
+        return None
+    try:
+        data = json.loads(raw[start:end + 1])
+    except ValueError:
+        logger.warning("Evaluation block is not valid JSON")
+        return None
+    if not isinstance(data, dict):
+        return None
+    scores = data.get("scores") if isinstance(data.get("scores"), dict) else {}
+    stumbling_points = [
+        str(point)[:50] for point in data.get("stumbling_points") or [] if isinstance(point, str)
+    ][:10]
+    subjects = [
+        EvaluationSubjectScore(subject=str(item["subject"])[:50], score=_bounded_int(item.get("score"), 100))
+        for item in data.get("subjects") or []
+        if isinstance(item, dict) and item.get("subject")
+    ][:20]
+    return EvaluationScore(
+        understanding=_bounded_int(data.get("understanding"), 100),
+        basic_understanding=_bounded_int(scores.get("basic_understanding"), 40),
+        expression=_bounded_int(scores.get("expression"), 20),
+        application=_bounded_int(scores.get("application"), 20),
+        attitude=_bounded_int(scores.get("attitude"), 20),
+        stumbling_points=stumbling_points,
+        subjects=subjects,
+    )
+
+def split_evaluation_response(text: str) -> Tuple[str, Optional[EvaluationScore]]:
+    """AIの応答を、表示用の本文と点数 (なければ None) に分ける"""
+    start = text.find(EVALUATION_BLOCK_START)
+    if start < 0:
+        return text, None
+    block = text[start + len(EVALUATION_BLOCK_START):]
+    end = block.find(EVALUATION_BLOCK_END)
+    if end >= 0:
+        block = block[:end]
+    return text[:start].rstrip(), parse_evaluation_block(block)
+
+class EvaluationStreamFilter(ResponseStreamFilter):
+    """
+    ストリーミングの断片から点数ブロックを取り除く。
+    開始の目印が断片の境目で分かれても取りこぼさないよう、目印の先頭と一致する末尾は次の断片まで保留する。
+    """
+
+    def __init__(self):
+        self._pending = ""
+        self._block: Optional[str] = None
+        self.evaluation: Optional[EvaluationScore] = None
+
+    def feed(self, text: str) -> str:
+        """断片を受け取り、利用者に送ってよい部分を返す"""
+        if self._block is not None:
+            self._block += text
+            return ""
+        self._pending += text
+        start = self._pending.find(EVALUATION_BLOCK_START)
+        if start >= 0:
+            visible = self._pending[:start]
+            self._block = self._pending[start + len(EVALUATION_BLOCK_START):]
+            self._pending = ""
+            return visible
+        held = 0
+        for length in range(min(len(EVALUATION_BLOCK_START) - 1, len(self._pending)), 0, -1):
+            if self._pending.endswith(EVALUATION_BLOCK_START[:length]):
+                held = length
+                break
+        visible = self._pending[:len(self._pending) - held]
+        self._pending = self._pending[len(self._pending) - held:]
+        return visible
+
+    def finish(self) -> str:
+        """ストリームの終わりに呼ぶ。保留していた本文を返し、点数ブロックがあれば evaluation に入れる"""
+        if self._block is not None:
+            self.evaluation = parse_evaluation_block(self._block.split(EVALUATION_BLOCK_END)[0])
+            return ""
+        visible, self._pending = self._pending, ""
+        return visible
+
+    def stored_text(self, chunks: List[str]) -> str:
+        # 点数ブロックの前の改行は本文に含めない（通常版の split_evaluation_response と揃える）
+        return "".join(chunks).rstrip()
+
+class EvaluationPostProcessor(ResponsePostProcessor):
+    """応答の最後の点数ブロックを表示せず、構造化データとして取り出す（理解度評価モード）"""
+
+    def split(self, text: str) -> Tuple[str, Optional[EvaluationScore]]:
+        return split_evaluation_response(text)
+
+    def stream_filter(self) -> EvaluationStreamFilter:
+        return EvaluationStreamFilter()
+
+def _format_score_line(index: int, score: EvaluationScore) -> str:
+    parts = [f"{index}回目"]
+    if score.created_at is not None:
+        parts[0] += f" ({score.created_at:%Y-%m-%d})"
+    if score.understanding is not None:
+        parts.append(f"理解度 {score.understanding}%")
+    categories = [
+        (label, value, maximum)
+        for label, value, maximum in (
+            ("基礎", score.basic_understanding, 40),
+            ("説明", score.expression, 20),
+            ("応用", score.application, 20),
+            ("意欲", score.attitude, 20),
+        )
+        if value is not None
+    ]
+    if categories:
+        parts.append("・".join(f"{label} {value}/{maximum}" for label, value, maximum in categories))
+    if score.subjects:
+        parts.append("教科: " + "、".join(f"{s.subject} {s.score}%" for s in score.subjects if s.score is not None))
+    if score.stumbling_points:
+        parts.append("つまずき: " + "、".join(score.stumbling_points))
+    return "- " + " / ".join(parts)
+
+def _recent_turns(history: List[ChatMessage], count: int) -> List[ChatMessage]:
+    """直近 count 件以内のメッセージを、ユーザーのメッセージから始まる（ターンの途中から始まらない）ように返す"""
+    if count <= 0:
+        return []
+    recent = history[max(0, len(history) - count):]
+    start = next((index for index, message in enumerate(recent) if message.role == "user"), len(recent))
+    return recent[start:]
+
+async def compact_history_with_scores(
+    db: AsyncSession,
+    conversation_id: Optional[int],
+    history: List[ChatMessage],
+) -> List[ChatMessage]:
+    """
+    点数の履歴がある会話は、過去の会話を送り直す代わりに「点数の要約 + 直近のメッセージ」をAIに渡す。
+    点数の履歴がなければ history をそのまま返す。
+    """
+    if conversation_id is None:
+        return history
+    scores = await crud.get_recent_evaluation_scores_async(db, conversation_id, EVALUATION_SCORE_HISTORY_LIMIT)
+    if not scores:
+        return history
+    lines = "\n".join(_format_score_line(index, score) for index, score in enumerate(scores, start=1))
+    return [
+        ChatMessage(role="user", content=SCORE_SUMMARY_TEMPLATE.format(lines=lines)),
+        ChatMessage(role="assistant", content=SCORE_SUMMARY_ACK_MESSAGE),
+    ] + _recent_turns(history, EVALUATION_RECENT_MESSAGES)
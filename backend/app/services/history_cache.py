@@ -0,0 +1,150 @@
+# app/services/history_cache.py
+# 会話履歴のプロセス内キャッシュ
+# 毎ターンDBから全履歴を読み直して ChatMessage を作り直す代わりに、
+# 会話IDごとの履歴を保持し、保存したターンをその場で追記していく。
+import os
+from typing import Callable, Dict, List, Optional
+
+from cachetools import TTLCache
+
+from app.models.chat_models import ChatMessage
+
+HISTORY_CACHE_ENABLED = os.getenv("HISTORY_CACHE_ENABLED", "true").lower() == "true"
+# キャッシュ全体で保持する本文の合計文字数の上限（メモリ使用量の目安）
+HISTORY_CACHE_MAX_CHARS = int(os.getenv("HISTORY_CACHE_MAX_CHARS", "5000000"))
+# 最後に登録・追記されてから破棄されるまでの秒数
+HISTORY_CACHE_TTL_SECONDS = int(os.getenv("HISTORY_CACHE_TTL_SECONDS", "1800"))
+
+def _history_size(messages: List[ChatMessage]) -> int:
+    """エントリのサイズ = 本文の合計文字数 (+1 で空の履歴も1件として数える)"""
+    return 1 + sum(len(message.content) for message in messages)
+
+class _EvictionCountingTTLCache(TTLCache):
+    """容量超過で追い出された件数を数える TTLCache"""
+
+    def __init__(self, *args, on_evict: Callable[[], None], **kwargs):
+        super().__init__(*args, **kwargs)
+        self._on_evict = on_evict
+
+    def popitem(self):
+        item = super().popitem()
+        self._on_evict()
+        return item
+
+class PendingLoad:
+    """DBから読み込み中の会話。読み込みの間にその会話のエントリが変わったら stale になる"""
+
+    __slots__ = ("conversation_id", "stale")
+
+    def __init__(self, conversation_id: int):
+        self.conversation_id = conversation_id
+        self.stale = False
+
+class HistoryCache:
+    """
+    会話IDをキーにした LRU + TTL の履歴キャッシュ。
+
+    - get: キャッシュにあれば履歴のコピーを返す（なければ None）
+    - put: 内容が分かっている履歴（新しい会話など）を登録する
+    - begin_load / finish_load: DBから読み込んだ履歴を登録する。
+      読み込みの間に追記・破棄・登録があった会話は、読んだ内容が古い可能性があるので登録しない
+    - append: 保存が成功したターンを既存のエントリに追記する（エントリがなければ何もしない）
+    - invalidate: DBへの保存に失敗した場合など、内容が信用できなくなったエントリを破棄する
+    """
+
+    def __init__(self, max_chars: int, ttl_seconds: int, enabled: bool = True):
+        self.enabled = enabled
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        # 会話ID → DBから読み込み中の PendingLoad
+        self._loads: Dict[int, List[PendingLoad]] = {}
+        self._cache = _EvictionCountingTTLCache(
+            maxsize=max_chars,
+            ttl=ttl_seconds,
+            getsizeof=_history_size,
+            on_evict=self._count_eviction,
+        )
+
+    def _count_eviction(self) -> None:
+        self.evictions += 1
+
+    def get(self, conversation_id: int) -> Optional[List[ChatMessage]]:
+        if not self.enabled:
+            return None
+        messages = self._cache.get(conversation_id)
+        if messages is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        # 呼び出し側がリストを加工してもキャッシュが壊れないよう、リストだけコピーして返す
+        return list(messages)
+
+    def put(self, conversation_id: int, messages: List[ChatMessage]) -> None:
+        if not self.enabled:
+            return
+        self._mark_loads_stale(conversation_id)
+        self._set(conversation_id, list(messages))
+
+    def begin_load(self, conversation_id: int) -> PendingLoad:
+        """DBからの読み込みを始める前に呼ぶ（読み込みが終わったら必ず finish_load を呼ぶ）"""
+        load = PendingLoad(conversation_id)
+        self._loads.setdefault(conversation_id, []).append(load)
+        return load
+
+    def finish_load(self, load: PendingLoad, messages: Optional[List[ChatMessage]]) -> None:
+        """
+        読み込んだ履歴を登録する（読み込みに失敗した場合は messages に None を渡す）。
+        読み込みの間にその会話への書き込みがあった場合や、すでにエントリがある場合は登録しない。
+        """
+        loads = self._loads.get(load.conversation_id, [])
+        if load in loads:
+            loads.remove(load)
+        if not loads:
+            self._loads.pop(load.conversation_id, None)
+        if not self.enabled or messages is None or load.stale or load.conversation_id in self._cache:
+            return
+        self._set(load.conversation_id, list(messages))
+
+    def append(self, conversation_id: int, messages: List[ChatMessage]) -> None:
+        if not self.enabled:
+            return
+        # 読み込み中の内容にはこのターンが含まれていないかもしれない
+        self._mark_loads_stale(conversation_id)
+        cached = self._cache.get(conversation_id)
+        if cached is None:
+            # キャッシュにない会話は、次回の読み込み時にDBから取得される
+            return
+        cached.extend(messages)
+        # 再登録してサイズ（文字数）の集計とLRUの順番を更新する
+        self._set(conversation_id, cached)
+
+    def invalidate(self, conversation_id: int) -> None:
+        self._mark_loads_stale(conversation_id)
+        self._cache.pop(conversation_id, None)
+
+    def _mark_loads_stale(self, conversation_id: int) -> None:
+        for load in self._loads.get(conversation_id, []):
+            load.stale = True
+
+    def _set(self, conversation_id: int, messages: List[ChatMessage]) -> None:
+        try:
+            self._cache[conversation_id] = messages
+        except ValueError:
+            # 1件だけで上限を超える巨大な履歴はキャッシュしない
+            self._cache.pop(conversation_id, None)
+
+    def stats(self) -> Dict[str, int]:
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "entries": len(self._cache),
+            "chars": int(self._cache.currsize),
+        }
+
+history_cache = HistoryCache(
+    max_chars=HISTORY_CACHE_MAX_CHARS,
+    ttl_seconds=HISTORY_CACHE_TTL_SECONDS,
+    enabled=HISTORY_CACHE_ENABLED,
+)
@@ -0,0 +1,166 @@
+# app/services/history_window.py
+# 会話履歴のトークン予算による切り詰めと、古いターンのローリング要約
+# 履歴を毎回すべて送るとプロンプトがターン数に比例して伸び続けるため、
+# 「要約 + 予算内に収まる直近のターン」だけをAIに渡す。
+import asyncio
+import logging
+import os
+from typing import List, Optional, Set, Tuple
+
+from cachetools import TTLCache
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from app.db import crud
+from app.db.database import AsyncSessionLocal
+from app.models.chat_models import ChatMessage
+from app.services.ai_service import generate_chat_response
+from app.services.llm.tokens import estimate_tokens
+
+logger = logging.getLogger(__name__)
+
+# モードごとの履歴のトークン予算（システム指示と今回の質問は含まない）
+DEFAULT_HISTORY_TOKEN_BUDGETS = {
+    "thinking": 4000,
+    "answer": 4000,
+    "understanding_evaluation": 8000,
+    "question": 2000,
+}
+# 予算に関わらず、直近この件数のメッセージは必ずそのまま渡す
+HISTORY_MIN_RECENT_MESSAGES = int(os.getenv("HISTORY_MIN_RECENT_MESSAGES", "4"))
+# 要約を更新するときに、最低何ターン分をまとめて畳み込むか
+# (予算からあふれた分だけを毎ターン要約すると、毎ターン要約のためのAI呼び出しが発生するため)
+SUMMARY_REFRESH_EVERY_TURNS = int(os.getenv("SUMMARY_REFRESH_EVERY_TURNS", "4"))
+
+SUMMARY_PROMPT = """
+あなたは教育アシスタントAI「ラーニー」と小学生～中学生のユーザーとの会話を記録する係です。
+以下の「これまでの要約」に「新しい会話」の内容を追記し、更新した要約だけを出力してください。
+
+【要約のルール】
+- 勉強した教科・単元・問題と、ユーザーがたどり着いた答えを残す（「今日のまとめ」に使います）
+- ユーザーがつまずいた点、まだ解決していない疑問を残す
+- 理解度の評価（理解度○○%、各評価項目の点数、教科別評価）が出ていれば、数値をそのまま日付順に残す（「前回比」に使います）
+- あいさつや雑談は省略する
+- 箇条書きで、全体で800字以内にまとめる
+
+【これまでの要約】
+{previous_summary}
+
+【新しい会話】
+{new_messages}
+"""
+
+# AIに渡すときの要約メッセージの形式
+SUMMARY_MESSAGE_TEMPLATE = "【これまでの会話の要約】\n{summary}"
+SUMMARY_ACK_MESSAGE = "わかりました。要約の内容をふまえて会話を続けます。"
+
+def history_token_budget(mode: str) -> int:
+    """モードの履歴トークン予算を返す（環境変数 HISTORY_TOKEN_BUDGET_<MODE> で上書き可能）"""
+    default = DEFAULT_HISTORY_TOKEN_BUDGETS.get(mode, 4000)
+    return int(os.getenv(f"HISTORY_TOKEN_BUDGET_{mode.upper()}", str(default)))
+
+# 要約のプロセス内キャッシュ (会話ID → (要約本文, 要約済みメッセージ数))
+_summary_cache: TTLCache = TTLCache(maxsize=10000, ttl=1800)
+# 要約を更新中の会話ID（同じ会話の要約を同時に二重で作らない）
+_refreshing: Set[int] = set()
+# 実行中のバックグラウンドタスク（GCで消えないよう参照を保持する）
+_background_tasks: Set[asyncio.Task] = set()
+
+async def _load_summary(db: AsyncSession, conversation_id: int) -> Optional[Tuple[str, int]]:
+    if conversation_id in _summary_cache:
+        return _summary_cache[conversation_id]
+    db_summary = await crud.get_conversation_summary_async(db, conversation_id)
+    entry = (db_summary.summary, db_summary.summarized_message_count) if db_summary else None
+    _summary_cache[conversation_id] = entry
+    return entry
+
+async def apply_history_window(
+    db: AsyncSession,
+    conversation_id: Optional[int],
+    mode: str,
+    history: List[ChatMessage],
+) -> List[ChatMessage]:
+    """
+    会話履歴をモードのトークン予算に収まるように切り詰める。
+
+    - 履歴全体が予算に収まる場合は、そのまま返す（要約も読まない）
+    - 収まらない場合は「要約 + 予算内の直近メッセージ」を返し、
+      予算からあふれたのにまだ要約されていないメッセージがあれば、要約の更新をバックグラウンドで開始する
+    """
+    budget = history_token_budget(mode)
+    token_counts = [estimate_tokens(message.content) for message in history]
+    if conversation_id is None or sum(token_counts) <= budget:
+        return history
+
+    summary_entry = await _load_summary(db, conversation_id)
+    summary_text, summarized_count = summary_entry if summary_entry else ("", 0)
+    summarized_count = min(summarized_count, len(history))
+
+    # 要約済みでない部分のうち、後ろから予算に収まるだけ残す
+    window_start = len(history)
+    used = 0
+    while window_start > summarized_count:
+        next_tokens = token_counts[window_start - 1]
+        kept = len(history) - window_start
+        if used + next_tokens > budget and kept >= HISTORY_MIN_RECENT_MESSAGES:
+            break
+        used += next_tokens
+        window_start -= 1
+
+    if window_start > summarized_count:
+        # 予算からあふれたメッセージは、次のターンまでに要約へ畳み込む
+        fold_until = max(window_start, summarized_count + SUMMARY_REFRESH_EVERY_TURNS * 2)
+        fold_until = min(fold_until, len(history) - HISTORY_MIN_RECENT_MESSAGES)
+        _schedule_summary_refresh(conversation_id, summary_text, history[summarized_count:fold_until], fold_until)
+
+    windowed: List[ChatMessage] = []
+    if summary_text:
+        windowed.append(ChatMessage(role="user", content=SUMMARY_MESSAGE_TEMPLATE.format(summary=summary_text)))
+        windowed.append(ChatMessage(role="assistant", content=SUMMARY_ACK_MESSAGE))
+    windowed += history[window_start:]
+    logger.debug("History windowed: %d messages -> summary(%d) + %d recent",
+                 len(history), summarized_count, len(history) - window_start)
+    return windowed
+
+def _schedule_summary_refresh(
+    conversation_id: int,
+    previous_summary: str,
+    new_messages: List[ChatMessage],
+    summarized_message_count: int,
+) -> None:
+    if not new_messages or conversation_id in _refreshing:
+        return
+    _refreshing.add(conversation_id)
+    task = asyncio.create_task(
+        _refresh_summary(conversation_id, previous_summary, new_messages, summarized_message_count)
+    )
+    _background_tasks.add(task)
+    task.add_done_callback(_background_tasks.discard)
+
+async def _refresh_summary(
+    conversation_id: int,
+    previous_summary: str,
+    new_messages: List[ChatMessage],
+    summarized_message_count: int,
+) -> None:
+    """前回の要約に新しいメッセージだけを追記する形で要約を更新する（全体の再要約はしない）"""
+    try:
+        transcript = "\n".join(
+            f"{'ユーザー' if message.role == 'user' else 'ラーニー'}: {message.content}"
+            for message in new_messages
+        )
+        prompt = SUMMARY_PROMPT.format(
+            previous_summary=previous_summary or "（なし）",
+            new_messages=transcript,
+        )
+        summary = await generate_chat_response(current_message_content=prompt, history=[])
+
+        async with AsyncSessionLocal() as db:
+            await crud.save_conversation_summary_async(db, conversation_id, summary, summarized_message_count)
+        _summary_cache[conversation_id] = (summary, summarized_message_count)
+        logger.info("Summary refreshed for conversation %s (+%d messages, total %d)",
+                    conversation_id, len(new_messages), summarized_message_count)
+    except Exception as e:
+        # 要約に失敗しても会話は続けられる（次のターンで再度試みる）
+        logger.warning("Failed to refresh summary for conversation %s: %s", conversation_id, e)
+    finally:
+        _refreshing.discard(conversation_id)
@@ -0,0 +1,3 @@
+# app/services/llm
+# LLMバックエンドの実装（Gemini / ローカルの疑似バックエンド）
+# 呼び出し側は app.services.ai_service を経由して使う
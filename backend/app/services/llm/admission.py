@@ -0,0 +1,216 @@
+# app/services/llm/admission.py
+# LLM呼び出しの流量制御（アドミッションコントロール）
+# クラス全員が一斉にログインしたときなどに、プロバイダのクォータ (RPM/TPM) を超えて
+# 全リクエストが失敗するのを防ぐ。LLMバックエンドの手前で
+#   - 同時実行数の上限
+#   - リクエスト数・トークン数のトークンバケット（プロバイダのクォータに合わせる）
+#   - 上限付きの待ち行列（待ち時間の期限付き）
+# をかけ、待ち行列が一杯なら即座に断る（API層で 429 + Retry-After を返す）。
+import asyncio
+import logging
+import math
+import os
+import time
+from collections import deque
+from contextlib import asynccontextmanager
+from typing import AsyncIterator, Deque, Dict, Optional
+
+from app.core.metrics import LLM_ADMISSION_REJECTED, LLM_ADMISSION_WAIT
+from app.services.llm.base import LLMError
+
+logger = logging.getLogger(__name__)
+
+# 同時に実行するLLM呼び出しの上限
+LLM_MAX_CONCURRENCY = int(os.getenv("LLM_MAX_CONCURRENCY", "16"))
+# プロバイダのクォータ（1分あたりのリクエスト数・トークン数）。0 なら制限しない
+LLM_REQUESTS_PER_MINUTE = int(os.getenv("LLM_REQUESTS_PER_MINUTE", "2000"))
+LLM_TOKENS_PER_MINUTE = int(os.getenv("LLM_TOKENS_PER_MINUTE", "4000000"))
+# 1回の呼び出しで見込む出力トークン数（入力の見積もりに足してトークンバケットから引く）
+LLM_EXPECTED_OUTPUT_TOKENS = int(os.getenv("LLM_EXPECTED_OUTPUT_TOKENS", "500"))
+# 空きを待てる呼び出しの数と、待てる時間の上限
+LLM_ADMISSION_QUEUE_SIZE = int(os.getenv("LLM_ADMISSION_QUEUE_SIZE", "200"))
+LLM_ADMISSION_TIMEOUT_SECONDS = float(os.getenv("LLM_ADMISSION_TIMEOUT_SECONDS", "15"))
+# 断ったときに再試行を促すまでの最短秒数 (Retry-After)
+LLM_ADMISSION_RETRY_AFTER_SECONDS = float(os.getenv("LLM_ADMISSION_RETRY_AFTER_SECONDS", "5"))
+
+REJECT_QUEUE_FULL = "queue_full"
+REJECT_TIMEOUT = "timeout"
+
+class AdmissionRejected(LLMError):
+    """混雑のためLLM呼び出しを受け付けなかったことを表す例外（retry_after 秒後の再試行を促す）"""
+
+    # API層で返すステータスコード
+    status_code = 429
+
+    def __init__(self, message: str, reason: str, retry_after: float):
+        super().__init__(message)
+        self.reason = reason
+        self.retry_after = retry_after
+
+    @property
+    def retry_after_header(self) -> str:
+        """Retry-After ヘッダーの値（整数の秒数）"""
+        return str(max(1, math.ceil(self.retry_after)))
+
+class TokenBucket:
+    """容量 capacity、毎秒 rate ずつ回復するトークンバケット"""
+
+    def __init__(self, capacity: float, rate: float):
+        self.capacity = capacity
+        self.rate = rate
+        self._level = capacity
+        self._updated = time.monotonic()
+
+    def _refill(self, now: float) -> None:
+        self._level = min(self.capacity, self._level + (now - self._updated) * self.rate)
+        self._updated = now
+
+    def delay(self, amount: float, now: float) -> float:
+        """amount を取り出せるようになるまでの秒数（今すぐ取り出せるなら 0）"""
+        self._refill(now)
+        # 容量を超える要求は容量ぶんとして扱う（永久に待たないように）
+        missing = min(amount, self.capacity) - self._level
+        return max(0.0, missing / self.rate)
+
+    def take(self, amount: float) -> None:
+        self._level -= min(amount, self.capacity)
+
+class _Waiter:
+    def __init__(self):
+        self.wakeup = asyncio.Event()
+
+class AdmissionController:
+    """
+    LLM呼び出しの受付を制御する。呼び出しは先着順 (FIFO) に受け付ける。
+    admit() の async with の間が1回の呼び出し（ストリーミングなら最後の断片まで）にあたる。
+    """
+
+    def __init__(
+        self,
+        max_concurrency: int,
+        requests_per_minute: int,
+        tokens_per_minute: int,
+        max_queue: int,
+        max_wait_seconds: float,
+        retry_after_seconds: float,
+    ):
+        self._max_concurrency = max(1, max_concurrency)
+        self._request_bucket = TokenBucket(requests_per_minute, requests_per_minute / 60) if requests_per_minute > 0 else None
+        self._token_bucket = TokenBucket(tokens_per_minute, tokens_per_minute / 60) if tokens_per_minute > 0 else None
+        self._max_queue = max_queue
+        self._max_wait_seconds = max_wait_seconds
+        self._retry_after_seconds = retry_after_seconds
+        self._in_flight = 0
+        self._waiters: Deque[_Waiter] = deque()
+        self.admitted = 0
+        self.rejected = 0
+
+    @asynccontextmanager
+    async def admit(self, tokens: int) -> AsyncIterator[None]:
+        """見積もりトークン数 tokens の呼び出しを受け付ける。混雑していれば AdmissionRejected"""
+        await self._acquire(tokens)
+        try:
+            yield
+        finally:
+            self._in_flight -= 1
+            self._wake_head()
+
+    def check_capacity(self) -> None:
+        """待ち行列が一杯なら、呼び出しを始める前に AdmissionRejected を送出する（ストリーミングの事前確認用）"""
+        if self._waiters and len(self._waiters) >= self._max_queue:
+            raise self._reject(REJECT_QUEUE_FULL)
+
+    async def _acquire(self, tokens: int) -> None:
+        if not self._waiters and self._try_admit(tokens) == 0:
+            LLM_ADMISSION_WAIT.observe(0)
+            return
+        if len(self._waiters) >= self._max_queue:
+            raise self._reject(REJECT_QUEUE_FULL)
+
+        loop = asyncio.get_running_loop()
+        started = loop.time()
+        deadline = started + self._max_wait_seconds
+        waiter = _Waiter()
+        self._waiters.append(waiter)
+        try:
+            while True:
+                delay: Optional[float] = None
+                if self._waiters[0] is waiter:
+                    delay = self._try_admit(tokens)
+                    if delay == 0:
+                        LLM_ADMISSION_WAIT.observe(loop.time() - started)
+                        return
+                remaining = deadline - loop.time()
+                if remaining <= 0:
+                    raise self._reject(REJECT_TIMEOUT)
+                # 先頭でなければ前の呼び出しが抜けるまで、同時実行数の上限なら誰かが終わるまで、
+                # レート制限ならバケットが回復するまで待つ
+                waiter.wakeup.clear()
+                try:
+                    await asyncio.wait_for(waiter.wakeup.wait(), timeout=remaining if delay is None else min(remaining, delay))
+                except asyncio.TimeoutError:
+                    pass
+        finally:
+            self._waiters.remove(waiter)
+            self._wake_head()
+
+    def _try_admit(self, tokens: int) -> Optional[float]:
+        """
+        受け付けられれば枠を確保して 0 を返す。
+        レート制限で待つ必要があればその秒数、同時実行数の上限に達していれば None を返す。
+        """
+        if self._in_flight >= self._max_concurrency:
+            return None
+        now = time.monotonic()
+        delay = 0.0
+        if self._request_bucket is not None:
+            delay = max(delay, self._request_bucket.delay(1, now))
+        if self._token_bucket is not None:
+            delay = max(delay, self._token_bucket.delay(tokens, now))
+        if delay > 0:
+            return delay
+        if self._request_bucket is not None:
+            self._request_bucket.take(1)
+        if self._token_bucket is not None:
+            self._token_bucket.take(tokens)
+        self._in_flight += 1
+        self.admitted += 1
+        return 0
+
+    def _wake_head(self) -> None:
+        if self._waiters:
+            self._waiters[0].wakeup.set()
+
+    def _reject(self, reason: str) -> AdmissionRejected:
+        self.rejected += 1
+        LLM_ADMISSION_REJECTED.labels(reason=reason).inc()
+        retry_after = self._retry_after()
+        logger.warning("LLM call rejected by admission control (%s, queued=%d, in_flight=%d)",
+                       reason, len(self._waiters), self._in_flight)
+        return AdmissionRejected(f"LLM is busy ({reason})", reason=reason, retry_after=retry_after)
+
+    def _retry_after(self) -> float:
+        """待ち行列がはけるまでのおおよその秒数（レート制限から見積もれなければ設定の最短秒数）"""
+        estimate = 0.0
+        if self._request_bucket is not None:
+            estimate = (len(self._waiters) + 1) / self._request_bucket.rate
+        return max(self._retry_after_seconds, estimate)
+
+    def has_waiters(self) -> bool:
+        """空きを待っている呼び出しがあるか（混雑中はヘッジなどの追加の呼び出しを控える）"""
+        return bool(self._waiters)
+
+    def stats(self) -> Dict[str, int]:
+        return {
+            "in_flight": self._in_flight,
+            "queued": len(self._waiters),
+        }
+
+llm_admission = AdmissionController(
+    max_concurrency=LLM_MAX_CONCURRENCY,
+    requests_per_minute=LLM_REQUESTS_PER_MINUTE,
+    tokens_per_minute=LLM_TOKENS_PER_MINUTE,
+    max_queue=LLM_ADMISSION_QUEUE_SIZE,
+    max_wait_seconds=LLM_ADMISSION_TIMEOUT_SECONDS,
+    retry_after_seconds=LLM_ADMISSION_RETRY_AFTER_SECONDS,
+)
@@ -0,0 +1,56 @@
+# app/services/llm/base.py
+# LLMバックエンドの共通インターフェース
+import asyncio
+from abc import ABC, abstractmethod
+from typing import AsyncIterator, Dict, List, Optional
+
+from app.models.chat_models import ChatMessage
+
+# 応答が得られなかった場合にユーザーへ返す文言（バックエンド共通）
+BLOCKED_BY_SAFETY_TEXT = "不適切な内容のため応答を生成できませんでした。"
+BLOCKED_UNKNOWN_TEXT = "AIによる応答生成に問題が発生しました（理由不明）。"
+EMPTY_RESPONSE_TEXT = "AIからの応答が得られませんでした。"
+NO_CANDIDATE_PARTS_TEXT = "AIから有効な応答が得られませんでした（候補パートなし）。"
+NON_TEXT_RESPONSE_TEXT = "AIからの応答がテキスト形式ではありませんでした。"
+
+class LLMError(Exception):
+    """LLMバックエンドの呼び出しに失敗したことを表す例外"""
+
+class LLMBackend(ABC):
+    """
+    チャット応答を生成するバックエンド。
+
+    system_instruction はモードごとに固定の指示で、mode はそのキャッシュキーとして使える。
+    history にシステム指示は含まれない。
+    """
+
+    name: str = "base"
+
+    def prepare(self, mode_instructions: Dict[str, str]) -> None:
+        """起動時に一度だけ呼ばれる。モードごとのモデル作成などの準備を行う（任意）"""
+
+    def is_retryable(self, error: Exception) -> bool:
+        """再試行すれば成功する見込みのある一時的なエラーか（タイムアウト、接続断、混雑など）"""
+        return isinstance(error, (asyncio.TimeoutError, ConnectionError))
+
+    @abstractmethod
+    async def generate(
+        self,
+        message: str,
+        history: List[ChatMessage],
+        mode: Optional[str],
+        system_instruction: Optional[str],
+        model: Optional[str] = None,
+    ) -> str:
+        """応答全体を生成して返す。model は使うモデル名（None ならバックエンドの既定のモデル）"""
+
+    @abstractmethod
+    def stream(
+        self,
+        message: str,
+        history: List[ChatMessage],
+        mode: Optional[str],
+        system_instruction: Optional[str],
+        model: Optional[str] = None,
+    ) -> AsyncIterator[str]:
+        """応答を生成されたそばから断片ごとに返す（model は generate と同じ）"""
@@ -0,0 +1,189 @@
+# app/services/llm/fake_backend.py
+# ネットワークを使わない疑似バックエンド（負荷試験・ベンチマーク・CI 用）
+# 応答の遅延・エラー・ブロックを設定どおりに再現し、同じシードなら同じ結果を返す。
+import asyncio
+import json
+import math
+import os
+import random
+from typing import AsyncIterator, Dict, List, Optional
+
+from app.models.chat_models import ChatMessage
+from app.services.llm.base import BLOCKED_BY_SAFETY_TEXT, LLMBackend, LLMError
+
+# 応答全体の遅延（対数正規分布）: 中央値 [ミリ秒] とばらつき (sigma)
+FAKE_LLM_LATENCY_MEDIAN_MS = float(os.getenv("FAKE_LLM_LATENCY_MEDIAN_MS", "800"))
+FAKE_LLM_LATENCY_SIGMA = float(os.getenv("FAKE_LLM_LATENCY_SIGMA", "0.4"))
+# ストリーミング時、最初の断片が届くまでにかかる割合（残りは断片ごとに均等に配分）
+FAKE_LLM_FIRST_TOKEN_RATIO = float(os.getenv("FAKE_LLM_FIRST_TOKEN_RATIO", "0.3"))
+# ストリーミング時の1断片あたりの文字数
+FAKE_LLM_STREAM_CHUNK_CHARS = int(os.getenv("FAKE_LLM_STREAM_CHUNK_CHARS", "20"))
+# 応答の作り方: echo (質問をそのまま返す) / canned (用意した定型文を返す)
+FAKE_LLM_RESPONSE_MODE = os.getenv("FAKE_LLM_RESPONSE_MODE", "canned")
+# 定型文の JSON ファイル ({"モード名": ["応答1", ...], "default": [...]})。未指定なら組み込みの定型文
+FAKE_LLM_CANNED_RESPONSES_PATH = os.getenv("FAKE_LLM_CANNED_RESPONSES_PATH")
+# 応答の長さを揃えるための繰り返し回数（評価モードの長いレポートの再現などに使う）
+FAKE_LLM_RESPONSE_REPEAT = int(os.getenv("FAKE_LLM_RESPONSE_REPEAT", "1"))
+# エラー (例外) になる確率と、セーフティでブロックされる確率
+FAKE_LLM_ERROR_RATE = float(os.getenv("FAKE_LLM_ERROR_RATE", "0"))
+FAKE_LLM_BLOCK_RATE = float(os.getenv("FAKE_LLM_BLOCK_RATE", "0"))
+# 乱数のシード（同じシードなら遅延・エラー・応答の並びが毎回同じになる）
+FAKE_LLM_SEED = int(os.getenv("FAKE_LLM_SEED", "0"))
+
+DEFAULT_CANNED_RESPONSES: Dict[str, List[str]] = {
+    "thinking": [
+        "いい質問だね！まずは問題をよく読んで、わかっていることを書き出してみよう！",
+        "こんなふうにかんがえてみて。ひとつずつ順番にたしかめていこう！",
+    ],
+    "answer": [
+        "答えは 2 です。さて、なぜその答えになるのか、あなたの考えを教えてください。",
+    ],
+    "understanding_evaluation": [
+        "===学習者向けフィードバック===\n理解度：70% [■■■■■■■□□□]\n\n【できていること】\n・式を正しく立てられている\n\n"
+        "【がんばるポイント】\n・理由を説明してみよう\n\n===保護者・教師向けレポート===\n【評価サマリー】\n・総合評価：70%",
+    ],
+    "question": [
+        "前に学習した事覚えているかな？\n【問題】\nみかんが4個あります。お友達に2個あげました。残りのみかんの数を分数で表しましょう。",
+    ],
+    "default": [
+        "わかりました。",
+    ],
+}
+
+class FakeLLMError(LLMError):
+    """疑似バックエンドが注入したエラー"""
+
+class FakeBackend(LLMBackend):
+    """
+    設定した遅延分布・エラー率・ブロック率で応答する疑似バックエンド。
+    呼び出し回数や受け取ったプロンプトの文字数を記録するので、ベンチマークの集計にも使える。
+    """
+
+    name = "fake"
+
+    def __init__(
+        self,
+        latency_median_ms: float = FAKE_LLM_LATENCY_MEDIAN_MS,
+        latency_sigma: float = FAKE_LLM_LATENCY_SIGMA,
+        first_token_ratio: float = FAKE_LLM_FIRST_TOKEN_RATIO,
+        stream_chunk_chars: int = FAKE_LLM_STREAM_CHUNK_CHARS,
+        response_mode: str = FAKE_LLM_RESPONSE_MODE,
+        canned_responses: Optional[Dict[str, List[str]]] = None,
+        response_repeat: int = FAKE_LLM_RESPONSE_REPEAT,
+        error_rate: float = FAKE_LLM_ERROR_RATE,
+        block_rate: float = FAKE_LLM_BLOCK_RATE,
+        seed: int = FAKE_LLM_SEED,
+    ):
+        self.latency_median_ms = latency_median_ms
+        self.latency_sigma = latency_sigma
+        self.first_token_ratio = first_token_ratio
+        self.stream_chunk_chars = max(1, stream_chunk_chars)
+        self.response_mode = response_mode
+        self.canned_responses = canned_responses or self._load_canned_responses()
+        self.response_repeat = max(1, response_repeat)
+        self.error_rate = error_rate
+        self.block_rate = block_rate
+        self._random = random.Random(seed)
+        self._canned_index: Dict[str, int] = {}
+        # 集計用
+        self.calls = 0
+        self.errors = 0
+        self.blocks = 0
+        self.prompt_chars = 0
+        self.model_calls: Dict[str, int] = {}
+
+    @staticmethod
+    def _load_canned_responses() -> Dict[str, List[str]]:
+        if FAKE_LLM_CANNED_RESPONSES_PATH:
+            with open(FAKE_LLM_CANNED_RESPONSES_PATH, encoding="utf-8") as f:
+                return json.load(f)
+        return DEFAULT_CANNED_RESPONSES
+
+    def is_retryable(self, error: Exception) -> bool:
+        # 注入したエラーは一時的な障害（プロバイダの 503 など）を模したもの
+        return isinstance(error, FakeLLMError) or super().is_retryable(error)
+
+    def _sample_latency(self) -> float:
+        """1回の応答にかかる時間 [秒] を対数正規分布からサンプリングする"""
+        if self.latency_median_ms <= 0:
+            return 0.0
+        return self._random.lognormvariate(math.log(self.latency_median_ms), self.latency_sigma) / 1000
+
+    def _record_prompt(self, message: str, history: List[ChatMessage], system_instruction: Optional[str]) -> None:
+        self.calls += 1
+        self.prompt_chars += len(message) + sum(len(m.content) for m in history) + len(system_instruction or "")
+
+    def _record_model(self, model: Optional[str]) -> None:
+        key = model or "default"
+        self.model_calls[key] = self.model_calls.get(key, 0) + 1
+
+    def _draw_outcome(self) -> str:
+        """この呼び出しの結果 (ok / error / blocked) を決める"""
+        roll = self._random.random()
+        if roll < self.error_rate:
+            self.errors += 1
+            return "error"
+        if roll < self.error_rate + self.block_rate:
+            self.blocks += 1
+            return "blocked"
+        return "ok"
+
+    def _response_text(self, message: str, mode: Optional[str]) -> str:
+        if self.response_mode == "echo":
+            text = f"[{mode or 'default'}] {message}"
+        else:
+            key = mode if mode in self.canned_responses else "default"
+            candidates = self.canned_responses.get(key) or DEFAULT_CANNED_RESPONSES["default"]
+            index = self._canned_index.get(key, 0)
+            self._canned_index[key] = index + 1
+            text = candidates[index % len(candidates)]
+        return "\n".join([text] * self.response_repeat)
+
+    async def generate(
+        self,
+        message: str,
+        history: List[ChatMessage],
+        mode: Optional[str],
+        system_instruction: Optional[str],
+        model: Optional[str] = None,
+    ) -> str:
+        self._record_prompt(message, history, system_instruction)
+        self._record_model(model)
+        latency = self._sample_latency()
+        outcome = self._draw_outcome()
+        text = self._response_text(message, mode)
+        await asyncio.sleep(latency)
+        if outcome == "error":
+            raise FakeLLMError("Injected error from fake LLM backend")
+        if outcome == "blocked":
+            return BLOCKED_BY_SAFETY_TEXT
+        return text
+
+    async def stream(
+        self,
+        message: str,
+        history: List[ChatMessage],
+        mode: Optional[str],
+        system_instruction: Optional[str],
+        model: Optional[str] = None,
+    ) -> AsyncIterator[str]:
+        self._record_prompt(message, history, system_instruction)
+        self._record_model(model)
+        latency = self._sample_latency()
+        outcome = self._draw_outcome()
+        text = self._response_text(message, mode)
+
+        # 最初の断片までの待ち時間
+        await asyncio.sleep(latency * self.first_token_ratio)
+        if outcome == "error":
+            raise FakeLLMError("Injected error from fake LLM backend")
+        if outcome == "blocked":
+            yield BLOCKED_BY_SAFETY_TEXT
+            return
+
+        chunks = [text[i:i + self.stream_chunk_chars] for i in range(0, len(text), self.stream_chunk_chars)]
+        interval = latency * (1 - self.first_token_ratio) / max(1, len(chunks) - 1)
+        for i, chunk in enumerate(chunks):
+            if i > 0:
+                await asyncio.sleep(interval)
+            yield chunk
@@ -0,0 +1,259 @@
+# app/services/llm/gemini_backend.py
+# Google Gemini API を使うバックエンド
+import asyncio
+import datetime
+import logging
+import os
+from typing import Any, AsyncIterator, Dict, List, Optional, Tuple
+
+import google.generativeai as genai
+from google.api_core import exceptions as google_exceptions
+import google.generativeai.types as genai_types
+from google.generativeai import caching as genai_caching
+
+from app.models.chat_models import ChatMessage
+from app.services.llm.base import (
+    BLOCKED_BY_SAFETY_TEXT,
+    BLOCKED_UNKNOWN_TEXT,
+    EMPTY_RESPONSE_TEXT,
+    NO_CANDIDATE_PARTS_TEXT,
+    NON_TEXT_RESPONSE_TEXT,
+    LLMBackend,
+)
+
+logger = logging.getLogger(__name__)
+
+# 使用するモデルを指定
+MODEL_NAME = os.getenv("GEMINI_MODEL_NAME", "gemini-2.0-flash")
+
+# プロンプトのコンテキストキャッシュ (Gemini の CachedContent) を使うかどうか
+# 有効にすると、システム指示をプロバイダ側にキャッシュし、毎ターン再送・再処理しなくてよくなる
+# ※ キャッシュできるのはバージョン付きのモデル名のみ。また、指示が最小トークン数に満たないと作成に失敗する
+#   （失敗した場合は通常の system_instruction にフォールバックする）
+PROMPT_CACHE_ENABLED = os.getenv("PROMPT_CACHE_ENABLED", "false").lower() == "true"
+PROMPT_CACHE_MODEL_NAME = os.getenv("PROMPT_CACHE_MODEL_NAME", f"models/{MODEL_NAME}-001")
+PROMPT_CACHE_TTL_MINUTES = int(os.getenv("PROMPT_CACHE_TTL_MINUTES", "60"))
+# ルーティングで既定以外のモデルが選ばれた場合も、(モード, モデル) ごとにキャッシュを作る
+# （キャッシュは作成したモデルでしか使えないため。キャッシュの保存料金は使われたモデルの数だけかかる）
+# ルール表のモデル名はそのままキャッシュの作成に使うので、キャッシュしたい場合はバージョン付きの名前を書く
+
+def _cache_model_name(model_name: str) -> str:
+    """コンテキストキャッシュを作るときのモデル名"""
+    if model_name == MODEL_NAME:
+        return PROMPT_CACHE_MODEL_NAME
+    return model_name if model_name.startswith("models/") else f"models/{model_name}"
+
+# ChatMessage の role ('user', 'assistant') を Gemini API が期待する 'user', 'model' にマッピング
+ROLE_MAPPING = {
+    "user": "user",
+    "assistant": "model", # Gemini API は 'model' ロールを使用します
+}
+
+def _to_gemini_history(history: List[ChatMessage]) -> List[Dict[str, Any]]:
+    """ChatMessage のリストを Gemini API が受け付ける辞書形式のリストに変換する"""
+    gemini_history: List[Dict[str, Any]] = []
+    for message in history:
+        role = ROLE_MAPPING.get(message.role)
+        if role:
+            gemini_history.append({
+                "role": role,
+                "parts": [{"text": message.content}] # テキストは parts リストの中の辞書に入れる形式
+            })
+        else:
+            logger.warning("Unknown role in history: %s. Skipping.", message.role)
+    return gemini_history
+
+def _log_usage(mode: Optional[str], model: Optional[str], response) -> None:
+    """入力/出力トークン数と、コンテキストキャッシュで再処理を省けたトークン数をログに出す"""
+    usage = getattr(response, "usage_metadata", None)
+    if not usage:
+        return
+    cached = getattr(usage, "cached_content_token_count", 0) or 0
+    logger.info("LLM usage", extra={
+        "llm_mode": mode,
+        "model": model or MODEL_NAME,
+        "prompt_tokens": usage.prompt_token_count,
+        "cached_tokens": cached,
+        "output_tokens": usage.candidates_token_count,
+        "uncached_input_tokens": usage.prompt_token_count - cached,
+    })
+
+def _blocked_response_text(response) -> str:
+    """テキストが得られなかった応答について、ユーザーに返す文言を決める"""
+    if response.prompt_feedback and response.prompt_feedback.block_reason:
+        block_reason = response.prompt_feedback.block_reason
+        logger.warning("AI response was blocked due to: %s", block_reason)
+        if block_reason == genai_types.BlockedReason.SAFETY:
+            return BLOCKED_BY_SAFETY_TEXT
+        return BLOCKED_UNKNOWN_TEXT
+    logger.warning("AI response is empty")
+    if logger.isEnabledFor(logging.DEBUG):
+        logger.debug("Empty AI response: %s", response)
+    return EMPTY_RESPONSE_TEXT
+
+class GeminiBackend(LLMBackend):
+    """
+    Gemini API のバックエンド。
+    (モード, モデル) ごとのモデル (system_instruction 付き) を一度だけ作り、使い回す。
+    """
+
+    name = "gemini"
+
+    def __init__(self):
+        # 環境変数からGemini APIキーを取得
+        api_key = os.getenv("GEMINI_API_KEY")
+        # APIキーが設定されているか確認（このバックエンドを使う場合のみ必須）
+        if not api_key:
+            raise ValueError("GEMINI_API_KEY environment variable not set.")
+        # Gemini API を設定
+        genai.configure(api_key=api_key)
+
+        # (モード名, モデル名) → 作成済みのモデル（ルーティングで既定以外のモデルが選ばれた場合も含む）
+        self._mode_models: Dict[Tuple[str, str], genai.GenerativeModel] = {}
+        # (モード名, モデル名) → コンテキストキャッシュ (CachedContent)
+        self._mode_caches: Dict[Tuple[str, str], Any] = {}
+        # (モード名, モデル名) → モデル作成時のシステム指示（指示が変わったら作り直す）
+        self._mode_instructions: Dict[Tuple[str, str], str] = {}
+        # モデル名 → モード指定なし (要約など) で使うモデル
+        self._plain_models: Dict[str, genai.GenerativeModel] = {MODEL_NAME: genai.GenerativeModel(MODEL_NAME)}
+
+    # 一時的なエラー（クォータ超過、過負荷、サーバー側のエラーやタイムアウト）は再試行する
+    RETRYABLE_ERRORS = (
+        google_exceptions.ResourceExhausted,
+        google_exceptions.ServiceUnavailable,
+        google_exceptions.InternalServerError,
+        google_exceptions.DeadlineExceeded,
+        google_exceptions.Aborted,
+    )
+
+    def is_retryable(self, error: Exception) -> bool:
+        return isinstance(error, self.RETRYABLE_ERRORS) or super().is_retryable(error)
+
+    def prepare(self, mode_instructions: Dict[str, str]) -> None:
+        # ルーティングで選ばれるモデルはリクエストが来るまで分からないので、既定のモデルの分だけ作っておく
+        for mode, instruction in mode_instructions.items():
+            key = (mode, MODEL_NAME)
+            if self._mode_instructions.get(key) != instruction:
+                self._mode_models[key] = self._build_mode_model(mode, MODEL_NAME, instruction)
+                self._mode_instructions[key] = instruction
+        logger.info("Gemini models ready for modes: %s", [mode for mode, _ in self._mode_models])
+
+    def _build_mode_model(self, mode: str, model_name: str, instruction: str) -> genai.GenerativeModel:
+        if PROMPT_CACHE_ENABLED:
+            try:
+                cache = genai_caching.CachedContent.create(
+                    model=_cache_model_name(model_name),
+                    display_name=f"chatbot-{mode}-instruction" if model_name == MODEL_NAME else f"chatbot-{mode}-{model_name}-instruction",
+                    system_instruction=instruction,
+                    ttl=datetime.timedelta(minutes=PROMPT_CACHE_TTL_MINUTES),
+                )
+                self._mode_caches[(mode, model_name)] = cache
+                logger.info("Created prompt cache for mode '%s' on %s (%s, tokens=%d)",
+                            mode, model_name, cache.name, cache.usage_metadata.total_token_count)
+                return genai.GenerativeModel.from_cached_content(cached_content=cache)
+            except Exception as e:
+                logger.warning("Failed to create prompt cache for mode '%s' on %s, using system_instruction instead: %s",
+                               mode, model_name, e)
+        return genai.GenerativeModel(model_name, system_instruction=instruction)
+
+    async def _refresh_prompt_cache(self, key: Tuple[str, str]) -> None:
+        """コンテキストキャッシュの期限が近ければ延長する（期限切れのキャッシュは使えないため）"""
+        cache = self._mode_caches.get(key)
+        if cache is None:
+            return
+        remaining = cache.expire_time - datetime.datetime.now(datetime.timezone.utc)
+        if remaining > datetime.timedelta(minutes=PROMPT_CACHE_TTL_MINUTES) / 4:
+            return
+        try:
+            await asyncio.to_thread(cache.update, ttl=datetime.timedelta(minutes=PROMPT_CACHE_TTL_MINUTES))
+        except Exception as e:
+            # 延長に失敗したら、次の呼び出しからキャッシュなしのモデルを使う
+            mode, model_name = key
+            logger.warning("Failed to extend prompt cache for mode '%s' on %s: %s", mode, model_name, e)
+            self._mode_caches.pop(key, None)
+            self._mode_models[key] = genai.GenerativeModel(model_name, system_instruction=self._mode_instructions[key])
+
+    async def _get_model(
+        self,
+        mode: Optional[str],
+        system_instruction: Optional[str],
+        model_name: Optional[str] = None,
+    ) -> genai.GenerativeModel:
+        model_name = model_name or MODEL_NAME
+        if mode is None or system_instruction is None:
+            if model_name not in self._plain_models:
+                self._plain_models[model_name] = genai.GenerativeModel(model_name)
+            return self._plain_models[model_name]
+        key = (mode, model_name)
+        if self._mode_instructions.get(key) != system_instruction:
+            # 起動時の prepare() 以降に登録されたモード、またはルーティングで初めて選ばれたモデル
+            self._mode_models[key] = await asyncio.to_thread(self._build_mode_model, mode, model_name, system_instruction)
+            self._mode_instructions[key] = system_instruction
+        await self._refresh_prompt_cache(key)
+        return self._mode_models[key]
+
+    async def generate(
+        self,
+        message: str,
+        history: List[ChatMessage],
+        mode: Optional[str],
+        system_instruction: Optional[str],
+        model: Optional[str] = None,
+    ) -> str:
+        # モードのモデルインスタンスを取得（既定のモデルは起動時に作成済み）
+        generative_model = await self._get_model(mode, system_instruction, model)
+
+        # チャットセッションを開始
+        # 辞書形式のリストを history として渡します。
+        chat_session = generative_model.start_chat(history=_to_gemini_history(history))
+
+        # 現在のユーザーメッセージを送信し、応答を待つ
+        response = await chat_session.send_message_async(message)
+        _log_usage(mode, model, response)
+
+        # 応答からテキスト部分を抽出して返す
+        # （候補やパートがない応答で response.text にアクセスすると ValueError になるため先に確認する）
+        if not response.candidates:
+            return _blocked_response_text(response)
+        parts = response.candidates[0].content.parts
+        if not parts:
+            return NO_CANDIDATE_PARTS_TEXT
+        if response.text:
+            return response.text
+        # text が空の場合は、最初のパートを確認する
+        logger.warning("Response.text is empty, checking candidates")
+        if isinstance(parts[0], genai_types.TextPart):
+            return parts[0].text
+        # テキストパートでない場合（画像など）の考慮
+        logger.warning("First candidate part is not text: %s", type(parts[0]))
+        return NON_TEXT_RESPONSE_TEXT
+
+    async def stream(
+        self,
+        message: str,
+        history: List[ChatMessage],
+        mode: Optional[str],
+        system_instruction: Optional[str],
+        model: Optional[str] = None,
+    ) -> AsyncIterator[str]:
+        generative_model = await self._get_model(mode, system_instruction, model)
+        chat_session = generative_model.start_chat(history=_to_gemini_history(history))
+
+        # stream=True を指定すると、生成されたそばからチャンクが届く
+        response = await chat_session.send_message_async(message, stream=True)
+
+        received_any = False
+        async for chunk in response:
+            # ブロックされたチャンクなどは text を持たない（アクセスすると ValueError）
+            if not chunk.candidates or not chunk.candidates[0].content.parts:
+                continue
+            text = chunk.text
+            if text:
+                received_any = True
+                yield text
+
+        # 使用量はストリームを最後まで読み終えた後のレスポンスに入っている
+        _log_usage(mode, model, response)
+
+        if not received_any:
+            yield _blocked_response_text(response)
@@ -0,0 +1,371 @@
+# app/services/llm/resilience.py
+# LLM呼び出しのタイムアウト・再試行・ヘッジ・サーキットブレーカー
+# たまに遅い Gemini の応答が p99 を押し上げるため、
+#   - モードごとの期限（再試行を含めた全体の制限時間）
+#   - 一時的なエラーの再試行（指数バックオフ + ジッター）
+#   - ヘッジ（最初の呼び出しが pXX のレイテンシを過ぎても返らなければ、同じ呼び出しをもう1本送り、先に返った方を使う）
+#   - サーキットブレーカー（プロバイダの障害中は呼び出さずにすぐ失敗させる）
+# をかける。設定はすべて環境変数で行う。
+import asyncio
+import logging
+import os
+import random
+import time
+from collections import deque
+from typing import AsyncIterator, Awaitable, Callable, Deque, Dict, Optional, TypeVar
+
+from app.core.metrics import (
+    LLM_ADMISSION_REJECTED,
+    LLM_ATTEMPTS,
+    LLM_CIRCUIT_TRANSITIONS,
+    LLM_DEADLINE_EXCEEDED,
+    LLM_HEDGES,
+    LLM_RETRIES,
+)
+from app.services.llm.admission import AdmissionRejected
+from app.services.llm.base import LLMError
+
+logger = logging.getLogger(__name__)
+
+T = TypeVar("T")
+
+# モードごとの期限 [秒]（再試行を含めた1回のAI呼び出し全体の制限時間）
+DEFAULT_LLM_TIMEOUTS = {
+    "thinking": 30.0,
+    "answer": 30.0,
+    "understanding_evaluation": 60.0, # レポートが長いため
+    "question": 20.0,
+}
+# モード指定なし（要約など）の期限
+LLM_TIMEOUT_SECONDS = float(os.getenv("LLM_TIMEOUT_SECONDS", "60"))
+# ストリーミングで、断片と断片の間に待てる時間の上限
+LLM_STREAM_IDLE_TIMEOUT_SECONDS = float(os.getenv("LLM_STREAM_IDLE_TIMEOUT_SECONDS", "15"))
+
+# 再試行の回数と、バックオフの基準/上限 [ミリ秒]（実際の待ち時間は 0〜基準×2^n のランダム）
+LLM_MAX_RETRIES = int(os.getenv("LLM_MAX_RETRIES", "2"))
+LLM_RETRY_BASE_DELAY_MS = float(os.getenv("LLM_RETRY_BASE_DELAY_MS", "200"))
+LLM_RETRY_MAX_DELAY_MS = float(os.getenv("LLM_RETRY_MAX_DELAY_MS", "2000"))
+
+# ヘッジ（ストリーミングでない呼び出しのみ）
+LLM_HEDGE_ENABLED = os.getenv("LLM_HEDGE_ENABLED", "false").lower() == "true"
+# 直近のレイテンシのこの分位点を過ぎたらヘッジを送る
+LLM_HEDGE_QUANTILE = float(os.getenv("LLM_HEDGE_QUANTILE", "0.95"))
+# 分位点の計算に使う直近の件数と、ヘッジを始めるのに必要な最低件数
+LLM_HEDGE_WINDOW = int(os.getenv("LLM_HEDGE_WINDOW", "200"))
+LLM_HEDGE_MIN_SAMPLES = int(os.getenv("LLM_HEDGE_MIN_SAMPLES", "50"))
+
+# サーキットブレーカー: 連続でこの回数失敗したら開き、一定時間は呼び出さずに失敗させる
+LLM_CIRCUIT_FAILURE_THRESHOLD = int(os.getenv("LLM_CIRCUIT_FAILURE_THRESHOLD", "5"))
+LLM_CIRCUIT_RESET_SECONDS = float(os.getenv("LLM_CIRCUIT_RESET_SECONDS", "30"))
+
+REJECT_CIRCUIT_OPEN = "circuit_open"
+
+CIRCUIT_CLOSED = "closed"
+CIRCUIT_OPEN = "open"
+CIRCUIT_HALF_OPEN = "half_open"
+
+class LLMTimeoutError(LLMError):
+    """モードの期限までにAIの応答が得られなかった"""
+
+class CircuitOpenError(AdmissionRejected):
+    """サーキットブレーカーが開いているため、AIを呼び出さずに失敗させた"""
+
+    status_code = 503
+
+def llm_timeout(mode: Optional[str]) -> float:
+    """モードの期限を返す（環境変数 LLM_TIMEOUT_SECONDS_<MODE> で上書き可能）"""
+    if mode is None:
+        return LLM_TIMEOUT_SECONDS
+    default = DEFAULT_LLM_TIMEOUTS.get(mode, LLM_TIMEOUT_SECONDS)
+    return float(os.getenv(f"LLM_TIMEOUT_SECONDS_{mode.upper()}", str(default)))
+
+class CircuitBreaker:
+    """
+    連続失敗回数で開閉するサーキットブレーカー。
+    開いてから reset_seconds 経つと半開きになり、1回だけ試しに呼び出す。成功すれば閉じ、失敗すればまた開く。
+    """
+
+    def __init__(self, failure_threshold: int, reset_seconds: float):
+        self._failure_threshold = max(1, failure_threshold)
+        self._reset_seconds = reset_seconds
+        self.state = CIRCUIT_CLOSED
+        self.consecutive_failures = 0
+        self._opened_at = 0.0
+        self._probe_in_flight = False
+
+    def check(self) -> None:
+        """開いていれば CircuitOpenError（呼び出しの枠は確保しない。ストリーミング開始前の確認用）"""
+        if self.state == CIRCUIT_OPEN:
+            remaining = self._opened_at + self._reset_seconds - time.monotonic()
+            if remaining > 0:
+                raise self._reject(remaining)
+
+    def before_call(self) -> None:
+        """呼び出してよければ何もしない。開いていれば CircuitOpenError"""
+        if self.state == CIRCUIT_CLOSED:
+            return
+        if self.state == CIRCUIT_OPEN:
+            remaining = self._opened_at + self._reset_seconds - time.monotonic()
+            if remaining > 0:
+                raise self._reject(remaining)
+            self._transition(CIRCUIT_HALF_OPEN)
+        # 半開き: 試しの呼び出しは1本だけ
+        if self._probe_in_flight:
+            raise self._reject(self._reset_seconds)
+        self._probe_in_flight = True
+
+    def record_success(self) -> None:
+        self.consecutive_failures = 0
+        self._probe_in_flight = False
+        if self.state != CIRCUIT_CLOSED:
+            self._transition(CIRCUIT_CLOSED)
+
+    def record_failure(self) -> None:
+        self.consecutive_failures += 1
+        self._probe_in_flight = False
+        if self.state == CIRCUIT_HALF_OPEN or (
+            self.state == CIRCUIT_CLOSED and self.consecutive_failures >= self._failure_threshold
+        ):
+            self._opened_at = time.monotonic()
+            self._transition(CIRCUIT_OPEN)
+
+    def release(self) -> None:
+        """プロバイダの状態と関係なく終わった呼び出し（再試行しないエラーやキャンセル）の後始末"""
+        self._probe_in_flight = False
+
+    def _transition(self, state: str) -> None:
+        logger.warning("LLM circuit breaker: %s -> %s (consecutive failures: %d)",
+                       self.state, state, self.consecutive_failures)
+        self.state = state
+        LLM_CIRCUIT_TRANSITIONS.labels(state=state).inc()
+
+    def _reject(self, retry_after: float) -> CircuitOpenError:
+        LLM_ADMISSION_REJECTED.labels(reason=REJECT_CIRCUIT_OPEN).inc()
+        return CircuitOpenError("LLM provider is unavailable (circuit open)", reason=REJECT_CIRCUIT_OPEN, retry_after=retry_after)
+
+    def stats(self) -> Dict[str, int]:
+        return {
+            "open": int(self.state != CIRCUIT_CLOSED),
+            "consecutive_failures": self.consecutive_failures,
+        }
+
+class LatencyTracker:
+    """モードごとの直近の成功したレイテンシから分位点を求める（ヘッジの待ち時間に使う）"""
+
+    def __init__(self, window: int, min_samples: int):
+        self._window = window
+        self._min_samples = min_samples
+        self._samples: Dict[str, Deque[float]] = {}
+
+    def observe(self, mode: Optional[str], seconds: float) -> None:
+        key = mode or "none"
+        if key not in self._samples:
+            self._samples[key] = deque(maxlen=self._window)
+        self._samples[key].append(seconds)
+
+    def quantile(self, mode: Optional[str], q: float) -> Optional[float]:
+        samples = self._samples.get(mode or "none")
+        if not samples or len(samples) < self._min_samples:
+            return None
+        ordered = sorted(samples)
+        return ordered[min(len(ordered) - 1, int(q * len(ordered)))]
+
+class ResilientCaller:
+    """
+    1回のAI呼び出し (attempt) を、期限・再試行・ヘッジ・サーキットブレーカー付きで実行する。
+    attempt は呼び出しのたびに新しく作るコルーチン（またはストリーム）のファクトリ。
+    """
+
+    def __init__(
+        self,
+        max_retries: int,
+        retry_base_delay: float,
+        retry_max_delay: float,
+        hedge_enabled: bool,
+        hedge_quantile: float,
+        breaker: CircuitBreaker,
+        latencies: LatencyTracker,
+        stream_idle_timeout: float,
+    ):
+        self._max_retries = max_retries
+        self._retry_base_delay = retry_base_delay
+        self._retry_max_delay = retry_max_delay
+        self._hedge_enabled = hedge_enabled
+        self._hedge_quantile = hedge_quantile
+        self._stream_idle_timeout = stream_idle_timeout
+        self.breaker = breaker
+        self.latencies = latencies
+
+    async def call(
+        self,
+        mode: Optional[str],
+        attempt: Callable[[], Awaitable[T]],
+        is_retryable: Callable[[Exception], bool],
+        allow_hedge: Callable[[], bool] = lambda: True,
+    ) -> T:
+        """attempt() を期限内に成功するまで（再試行回数の範囲で）実行して結果を返す"""
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + llm_timeout(mode)
+        retries = 0
+        while True:
+            self.breaker.before_call()
+            try:
+                result = await self._call_with_hedge(mode, attempt, deadline, allow_hedge)
+            except Exception as e:
+                delay = self._handle_failure(mode, e, is_retryable, retries, deadline)
+                retries += 1
+                await asyncio.sleep(delay)
+                continue
+            except BaseException:
+                self.breaker.release()
+                raise
+            self.breaker.record_success()
+            return result
+
+    async def stream(
+        self,
+        mode: Optional[str],
+        open_stream: Callable[[], AsyncIterator[str]],
+        is_retryable: Callable[[Exception], bool],
+    ) -> AsyncIterator[str]:
+        """
+        open_stream() のストリームを順に返す。再試行できるのは最初の断片が届くまで
+        （ユーザーに返し始めた後でやり直すと、応答が重複してしまうため）。
+        最初の断片はモードの期限まで、以降は断片ごとに stream_idle_timeout まで待つ。
+        """
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + llm_timeout(mode)
+        retries = 0
+        while True:
+            self.breaker.before_call()
+            stream = open_stream()
+            try:
+                first = await asyncio.wait_for(stream.__anext__(), timeout=max(0.0, deadline - loop.time()))
+            except StopAsyncIteration:
+                self.breaker.record_success()
+                return
+            except Exception as e:
+                await stream.aclose()
+                delay = self._handle_failure(mode, e, is_retryable, retries, deadline)
+                retries += 1
+                await asyncio.sleep(delay)
+                continue
+            except BaseException:
+                self.breaker.release()
+                await stream.aclose()
+                raise
+            break
+
+        self.breaker.record_success()
+        LLM_ATTEMPTS.labels(mode=mode or "none", outcome="success").inc()
+        try:
+            yield first
+            while True:
+                try:
+                    chunk = await asyncio.wait_for(stream.__anext__(), timeout=self._stream_idle_timeout)
+                except StopAsyncIteration:
+                    return
+                except asyncio.TimeoutError:
+                    LLM_DEADLINE_EXCEEDED.labels(mode=mode or "none").inc()
+                    raise LLMTimeoutError(f"AIの応答が {self._stream_idle_timeout:.0f} 秒以上途切れました")
+                yield chunk
+        finally:
+            await stream.aclose()
+
+    def _handle_failure(
+        self,
+        mode: Optional[str],
+        error: Exception,
+        is_retryable: Callable[[Exception], bool],
+        retries: int,
+        deadline: float,
+    ) -> float:
+        """
+        失敗した試行を記録し、再試行するならその前の待ち時間を返す。再試行しないなら例外を送出する。
+        """
+        mode_label = mode or "none"
+        if isinstance(error, AdmissionRejected):
+            # 混雑で受け付けられなかった呼び出しはプロバイダの障害ではない。再試行もしない（呼び出し元で 429 にする）
+            self.breaker.release()
+            raise error
+        timed_out = isinstance(error, asyncio.TimeoutError)
+        retryable = timed_out or is_retryable(error)
+        LLM_ATTEMPTS.labels(mode=mode_label, outcome="timeout" if timed_out else "retryable_error" if retryable else "error").inc()
+        if retryable:
+            self.breaker.record_failure()
+        else:
+            self.breaker.release()
+            raise error
+
+        remaining = deadline - asyncio.get_running_loop().time()
+        # 全ジッター: 0〜min(上限, 基準×2^n) の一様乱数
+        delay = random.uniform(0, min(self._retry_max_delay, self._retry_base_delay * (2 ** retries)))
+        if remaining <= delay:
+            LLM_DEADLINE_EXCEEDED.labels(mode=mode_label).inc()
+            raise LLMTimeoutError(f"AIの応答が期限 ({llm_timeout(mode):.0f} 秒) までに得られませんでした") from error
+        if retries >= self._max_retries:
+            if timed_out:
+                raise LLMTimeoutError("AIの応答が時間内に得られませんでした") from error
+            raise error
+        LLM_RETRIES.labels(mode=mode_label).inc()
+        logger.warning("Retrying LLM call in %.2fs after %s (retry %d/%d)",
+                       delay, type(error).__name__, retries + 1, self._max_retries)
+        return delay
+
+    async def _call_with_hedge(
+        self,
+        mode: Optional[str],
+        attempt: Callable[[], Awaitable[T]],
+        deadline: float,
+        allow_hedge: Callable[[], bool],
+    ) -> T:
+        loop = asyncio.get_running_loop()
+        hedge_delay = self.latencies.quantile(mode, self._hedge_quantile) if self._hedge_enabled else None
+        if hedge_delay is None or hedge_delay >= deadline - loop.time():
+            return await asyncio.wait_for(self._timed(mode, attempt), timeout=max(0.0, deadline - loop.time()))
+
+        primary = asyncio.ensure_future(self._timed(mode, attempt))
+        tasks = {primary}
+        try:
+            done, _ = await asyncio.wait(tasks, timeout=hedge_delay)
+            if not done and allow_hedge():
+                LLM_HEDGES.labels(mode=mode or "none", result="fired").inc()
+                tasks.add(asyncio.ensure_future(self._timed(mode, attempt)))
+            error: Optional[BaseException] = None
+            while tasks:
+                done, tasks = await asyncio.wait(tasks, timeout=max(0.0, deadline - loop.time()), return_when=asyncio.FIRST_COMPLETED)
+                if not done:
+                    raise asyncio.TimeoutError()
+                for task in done:
+                    if task.exception() is None:
+                        if task is not primary:
+                            LLM_HEDGES.labels(mode=mode or "none", result="won").inc()
+                        return task.result()
+                    error = task.exception()
+            raise error
+        finally:
+            for task in tasks:
+                task.cancel()
+
+    async def _timed(self, mode: Optional[str], attempt: Callable[[], Awaitable[T]]) -> T:
+        started = time.perf_counter()
+        result = await attempt()
+        self.latencies.observe(mode, time.perf_counter() - started)
+        LLM_ATTEMPTS.labels(mode=mode or "none", outcome="success").inc()
+        return result
+
+llm_circuit_breaker = CircuitBreaker(
+    failure_threshold=LLM_CIRCUIT_FAILURE_THRESHOLD,
+    reset_seconds=LLM_CIRCUIT_RESET_SECONDS,
+)
+
+llm_resilience = ResilientCaller(
+    max_retries=LLM_MAX_RETRIES,
+    retry_base_delay=LLM_RETRY_BASE_DELAY_MS / 1000,
+    retry_max_delay=LLM_RETRY_MAX_DELAY_MS / 1000,
+    hedge_enabled=LLM_HEDGE_ENABLED,
+    hedge_quantile=LLM_HEDGE_QUANTILE,
+    breaker=llm_circuit_breaker,
+    latencies=LatencyTracker(window=LLM_HEDGE_WINDOW, min_samples=LLM_HEDGE_MIN_SAMPLES),
+    stream_idle_timeout=LLM_STREAM_IDLE_TIMEOUT_SECONDS,
+)
@@ -0,0 +1,150 @@
+# app/services/llm/routing.py
+# リクエストごとのモデル選択（ルーティング）
+# 考え方モードの短い算数のヒントと、理解度評価モードの長いレポートでは、求められる速さと品質が大きく違う。
+# モード・プロンプトの長さ・履歴の長さ・手元の簡易分類（古文か、簡単な算数か など）から、
+# 設定したルール表に従ってモデルを選ぶ。エラーやタイムアウトの場合に使う別のモデル (fallback) も指定できる。
+import json
+import logging
+import os
+import re
+import unicodedata
+from dataclasses import dataclass
+from typing import Any, Dict, List, Optional
+
+from app.core.metrics import LLM_ROUTES
+from app.models.chat_models import ChatMessage
+from app.services.llm.tokens import estimate_tokens
+
+logger = logging.getLogger(__name__)
+
+# ルール表 (JSON) のファイルパス。未指定なら DEFAULT_ROUTING_RULES を使う
+LLM_ROUTING_TABLE_PATH = os.getenv("LLM_ROUTING_TABLE_PATH")
+
+# 簡易分類のカテゴリ
+CATEGORY_CLASSICAL_JAPANESE = "classical_japanese" # 古文・漢文
+CATEGORY_SIMPLE_ARITHMETIC = "simple_arithmetic"   # 四則演算だけの簡単な算数
+CATEGORY_MATH = "math"                             # それ以外の算数・数学
+CATEGORY_GENERAL = "general"
+
+# 上から順に照合し、最初に一致したルールのモデルを使う。
+# 条件 (modes / categories / min_・max_prompt_tokens / min_・max_history_messages) は省略すると「何でもよい」。
+# model / fallback が null ならバックエンドの既定のモデル (GEMINI_MODEL_NAME)。
+# timeout_seconds を指定すると、最初のモデルがその時間内に応答しなければ fallback に切り替える。
+# ルール表の例 (LLM_ROUTING_TABLE_PATH に指定する JSON):
+#   [
+#     {"name": "simple_arithmetic_hint", "modes": ["thinking", "answer"], "categories": ["simple_arithmetic"],
+#      "max_prompt_tokens": 200, "max_history_messages": 10,
+#      "model": "gemini-2.0-flash-lite", "fallback": "gemini-2.0-flash", "timeout_seconds": 8},
+#     {"name": "classical_japanese", "categories": ["classical_japanese"], "model": "gemini-2.5-flash"},
+#     {"name": "default", "model": null, "fallback": null}
+#   ]
+
+# ルール表を指定しない場合は、すべて既定のモデルで処理する（モデルの切り替えはルール表を指定したときだけ）
+DEFAULT_ROUTING_RULES: List[Dict[str, Any]] = [
+    {"name": "default", "model": None, "fallback": None},
+]
+
+# 古文・漢文によく出る語と、歴史的仮名遣いにしか出ない文字
+_CLASSICAL_KEYWORDS = ("古文", "漢文", "古典", "現代語訳", "係り結び", "歴史的仮名遣い", "返り点", "書き下し", "枕草子", "徒然草", "源氏物語", "竹取物語", "平家物語")
+_CLASSICAL_CHARS = re.compile(r"[ゐゑヰヱ]")
+_CLASSICAL_ENDINGS = re.compile(r"(けり|たり|なり|べし|けむ|らむ|ざりけり|なりけり)[。、」\s]")
+# 数式 (例: 12+34, 3×4=) と、四則演算の語
+_ARITHMETIC_EXPRESSION = re.compile(r"\d+(\.\d+)?\s*[+\-*/×÷]\s*\d+")
+_ARITHMETIC_KEYWORDS = ("たし算", "足し算", "ひき算", "引き算", "かけ算", "掛け算", "わり算", "割り算", "計算", "いくつ", "何個", "なんこ")
+_MATH_KEYWORDS = ("方程式", "関数", "比例", "反比例", "図形", "面積", "体積", "角度", "証明", "分数", "小数", "割合", "確率", "平方根", "一次", "二次", "グラフ")
+
+def classify_request(text: str) -> str:
+    """質問文を大まかなカテゴリに分類する（正規表現とキーワードだけの軽い判定）"""
+    normalized = unicodedata.normalize("NFKC", text)
+    if (any(keyword in normalized for keyword in _CLASSICAL_KEYWORDS)
+            or _CLASSICAL_CHARS.search(normalized)
+            or len(_CLASSICAL_ENDINGS.findall(normalized)) >= 2):
+        return CATEGORY_CLASSICAL_JAPANESE
+    if any(keyword in normalized for keyword in _MATH_KEYWORDS):
+        return CATEGORY_MATH
+    if _ARITHMETIC_EXPRESSION.search(normalized) or any(keyword in normalized for keyword in _ARITHMETIC_KEYWORDS):
+        return CATEGORY_SIMPLE_ARITHMETIC
+    return CATEGORY_GENERAL
+
+@dataclass(frozen=True)
+class RoutingDecision:
+    route: str                      # 一致したルールの名前
+    model: Optional[str]            # 最初に使うモデル (None はバックエンドの既定)
+    fallback: Optional[str]         # エラー・タイムアウト時に使うモデル
+    timeout_seconds: Optional[float] # 最初のモデルを待つ時間の上限
+    category: str
+    prompt_tokens: int
+    history_messages: int
+
+    def model_for_attempt(self, attempt: int) -> Optional[str]:
+        """attempt 回目 (0始まり) の呼び出しに使うモデル。2回目以降は fallback があればそちら"""
+        if attempt > 0 and self.fallback:
+            return self.fallback
+        return self.model
+
+    def timeout_for_attempt(self, attempt: int) -> Optional[float]:
+        """最初の呼び出しだけ timeout_seconds で打ち切り、fallback に切り替えられるようにする"""
+        if attempt == 0 and self.fallback is not None:
+            return self.timeout_seconds
+        return None
+
+class ModelRouter:
+    """ルール表に従ってリクエストごとのモデルを選ぶ"""
+
+    def __init__(self, rules: List[Dict[str, Any]]):
+        self._rules = rules
+
+    @classmethod
+    def from_config(cls) -> "ModelRouter":
+        if LLM_ROUTING_TABLE_PATH:
+            with open(LLM_ROUTING_TABLE_PATH, encoding="utf-8") as f:
+                return cls(json.load(f))
+        return cls(DEFAULT_ROUTING_RULES)
+
+    def pin_mode(self, mode: str, model: Optional[str], fallback: Optional[str] = None) -> None:
+        """モードで使うモデルを固定する（ルール表の先頭に、そのモードだけに一致するルールを加える）"""
+        rule: Dict[str, Any] = {"name": f"mode_{mode}", "modes": [mode], "model": model, "fallback": fallback}
+        self._rules = [rule] + [existing for existing in self._rules if existing.get("name") != rule["name"]]
+
+    def route(self, mode: Optional[str], message: str, history: List[ChatMessage]) -> RoutingDecision:
+        category = classify_request(message)
+        prompt_tokens = estimate_tokens(message)
+        history_messages = len(history)
+        rule = next(
+            (rule for rule in self._rules if self._matches(rule, mode, category, prompt_tokens, history_messages)),
+            {"name": "none"},
+        )
+        decision = RoutingDecision(
+            route=rule["name"],
+            model=rule.get("model"),
+            fallback=rule.get("fallback"),
+            timeout_seconds=rule.get("timeout_seconds"),
+            category=category,
+            prompt_tokens=prompt_tokens,
+            history_messages=history_messages,
+        )
+        LLM_ROUTES.labels(mode=mode or "none", route=decision.route, model=decision.model or "default").inc()
+        # ルール表の調整に使えるよう、判断の材料と結果をログに残す
+        logger.info("Routed LLM call", extra={
+            "route": decision.route,
+            "model": decision.model or "default",
+            "fallback": decision.fallback,
+            "category": category,
+            "prompt_tokens": prompt_tokens,
+            "history_messages": history_messages,
+        })
+        return decision
+
+    @staticmethod
+    def _matches(rule: Dict[str, Any], mode: Optional[str], category: str, prompt_tokens: int, history_messages: int) -> bool:
+        if "modes" in rule and mode not in rule["modes"]:
+            return False
+        if "categories" in rule and category not in rule["categories"]:
+            return False
+        if prompt_tokens < rule.get("min_prompt_tokens", 0) or prompt_tokens > rule.get("max_prompt_tokens", float("inf")):
+            return False
+        if history_messages < rule.get("min_history_messages", 0) or history_messages > rule.get("max_history_messages", float("inf")):
+            return False
+        return True
+
+model_router = ModelRouter.from_config()
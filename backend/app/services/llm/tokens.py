@@ -0,0 +1,10 @@
+# app/services/llm/tokens.py
+# トークン数の見積もり（履歴の切り詰めとLLM呼び出しのレート制限で共通に使う）
+
+def estimate_tokens(text: str) -> int:
+    """
+    トークン数の簡易見積もり（APIを呼ばずに手元で計算する）。
+    日本語は1文字≒1トークン、英数字は4文字≒1トークンとして数える。
+    """
+    ascii_chars = sum(1 for ch in text if ch.isascii())
+    return (len(text) - ascii_chars) + ascii_chars // 4 + 1
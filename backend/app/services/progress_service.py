@@ -0,0 +1,48 @@
+# app/services/progress_service.py
+# 生徒の学習の進み具合（保護者・教師向けの長期的傾向）を返すサービス
+# 評価のたびに更新している集計行 (app/db/progress.py) を読むだけなので、会話や評価の履歴は読み直さない。
+import logging
+from typing import Optional
+
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from app.db import crud
+from app.models.progress_models import LearnerProgressResponse, RecentScore, SubjectProgress
+
+logger = logging.getLogger(__name__)
+
+def _mean(total: int, count: int) -> Optional[float]:
+    return round(total / count, 2) if count else None
+
+async def get_learner_progress(db: AsyncSession, learner_id: str) -> Optional[LearnerProgressResponse]:
+    """生徒の集計を返す。まだ評価がなければ None"""
+    progress, subjects = await crud.get_learner_progress_async(db, learner_id)
+    if progress is None:
+        return None
+    return LearnerProgressResponse(
+        learner_id=progress.learner_id,
+        evaluation_count=progress.evaluation_count,
+        average_understanding=_mean(progress.understanding_total, progress.understanding_count),
+        rolling_understanding=progress.rolling_understanding,
+        best_understanding=progress.best_understanding,
+        last_understanding=progress.last_understanding,
+        improvement_streak=progress.improvement_streak,
+        recent_scores=[RecentScore(**entry) for entry in progress.recent_scores or []],
+        stumbling_counts=progress.stumbling_counts or {},
+        first_evaluated_at=progress.first_evaluated_at,
+        last_evaluated_at=progress.last_evaluated_at,
+        subjects=[
+            SubjectProgress(
+                subject=subject.subject,
+                evaluation_count=subject.evaluation_count,
+                average_score=_mean(subject.score_total, subject.evaluation_count),
+                rolling_score=subject.rolling_score,
+                best_score=subject.best_score,
+                last_score=subject.last_score,
+                improvement_streak=subject.improvement_streak,
+                recent_scores=subject.recent_scores or [],
+                last_evaluated_at=subject.last_evaluated_at,
+            )
+            for subject in subjects
+        ],
+    )
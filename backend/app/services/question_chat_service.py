@@ -1,11 +1,5 @@
 # app/services/answer_chat_service.py
-from sqlalchemy.orm import Session 
-
-from app.db import crud
-from app.db.models import Message
-from app.models.chat_models import ChatRequest, ChatResponse, ChatMessage
-from app.services.ai_service import generate_chat_response
-from typing import List
+from app.services.chat_pipeline import PREPARED_QUESTION_POOL, ChatMode, register_mode
 
 # このサービスが担当するAIへのシステム指示を定義
 QUESTION_SYSTEM_INSTRUCTION = (
@@ -63,55 +57,11 @@ QUESTION_SYSTEM_INSTRUCTION = (
      """
 )
 
-async def process_question_request(db: Session, request: ChatRequest) -> ChatResponse:
-    """
-    '理解度チェック'での出題
-    """
-    print("Service: Processing question request...")
-
-    try:
-        conversation_id = request.conversation_id
-        current_question_text = request.question
-
-        # 1. 会話の特定または新規作成
-        if conversation_id is None:
-            # 新しい会話の場合、DBに会話エントリを作成
-            conversation = crud.create_conversation(db)
-            conversation_id = conversation.id
-            print(f"Service: Created new conversation with ID: {conversation_id}")
-        else:
-             # 既存の会話の場合、IDが存在するか確認するなど堅牢化も必要
-             print(f"Service: Using existing conversation with ID: {conversation_id}")
-             # ここで、そのconversation_idが本当に存在するかDBで確認する処理を入れるのが望ましい
-
-        # 2. DBから会話履歴を取得
-        db_messages = crud.get_conversation_history(db, conversation_id)
-
-        # DBから取得した履歴を、AIサービスが期待する ChatMessage のリスト形式に変換
-        history_for_ai: List[ChatMessage] = crud.messages_to_chat_messages(db_messages)
-
-        # システム指示をAIに渡す履歴リストの先頭に追加
-        history_for_ai_with_instruction: List[ChatMessage] = [
-            ChatMessage(role="user", content=QUESTION_SYSTEM_INSTRUCTION)
-        ] + history_for_ai
-
-        # 3. AIサービスを呼び出し
-        # 現在のユーザー質問と、システム指示+DB履歴を含む会話履歴リストを渡す
-        ai_response_text = await generate_chat_response(
-            current_message_content=current_question_text,
-            history=history_for_ai_with_instruction # システム指示+DB履歴を渡す
-        )
-
-        # 4. ユーザーの質問とAIの応答をDBに保存
-        crud.create_message(db, conversation_id, "user", current_question_text)
-        crud.create_message(db, conversation_id, "assistant", ai_response_text) # AIのロールは 'assistant' で保存
-
-        # 5. レスポンスモデルに格納して返す
-        return ChatResponse(
-            response=ai_response_text,
-            conversation_id=conversation_id # 新規作成/既存問わず会話IDを返す
-        )
-
-    except Exception as e:
-        print(f"Service Error in question request: {e}")
-        raise # API層でキャッチさせるため再Raise
\ No newline at end of file
+# モードを登録（システム指示とモデルはモードごとに起動時に一度だけ作られる。処理の流れは chat_pipeline で共通）
+QUESTION_MODE = ChatMode(
+    name="question",
+    system_instruction=QUESTION_SYSTEM_INSTRUCTION,
+    # 作り置きの類似問題があればそれを出題する（この会話で既に出題した問題は除外。プールの補充はバックグラウンドで行われる）
+    prepared_response=PREPARED_QUESTION_POOL,
+)
+question_pipeline = register_mode(QUESTION_MODE)
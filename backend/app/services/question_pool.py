@@ -0,0 +1,154 @@
+# app/services/question_pool.py
+# 理解度チェックの類似問題プール
+# 同じ宿題の問題について出題リクエストが集中するため、元の問題ごとに類似問題を
+# バックグラウンドで作り置きしておき、リクエストにはプールから即座に出題する。
+import asyncio
+import logging
+import os
+import re
+import unicodedata
+from collections import OrderedDict, deque
+from dataclasses import dataclass
+from typing import Deque, Dict, Iterable, Optional, Set
+
+from app.services.ai_service import generate_chat_response
+
+logger = logging.getLogger(__name__)
+
+QUESTION_POOL_ENABLED = os.getenv("QUESTION_POOL_ENABLED", "true").lower() == "true"
+# プールに保持する元の問題の数（超えたら最近使われていないものから捨てる）
+QUESTION_POOL_MAX_PROBLEMS = int(os.getenv("QUESTION_POOL_MAX_PROBLEMS", "500"))
+# 元の問題1つあたりに作り置きしておく類似問題の数
+QUESTION_POOL_VARIANTS_PER_PROBLEM = int(os.getenv("QUESTION_POOL_VARIANTS_PER_PROBLEM", "4"))
+# 補充のために同時に実行するAI呼び出しの最大数（対話中のリクエストの邪魔をしないように）
+QUESTION_POOL_REFILL_CONCURRENCY = int(os.getenv("QUESTION_POOL_REFILL_CONCURRENCY", "4"))
+
+# 出題の種類 (QUESTION_SYSTEM_INSTRUCTION の「4. 出題の種類」と対応)
+QUESTION_KINDS = {
+    "数値変更型": "同じ形式で数値を変更",
+    "文脈変更型": "同じ概念で場面を変更",
+    "条件変更型": "同じ概念で条件を変更",
+    "逆問題型": "同じ概念で問い方を逆に",
+}
+
+REFILL_REQUEST_TEMPLATE = "{source}\n\n（出題の種類は「{kind}」（{description}）にしてください）"
+
+@dataclass(frozen=True)
+class PooledQuestion:
+    kind: str # 出題の種類
+    text: str # AIが生成した出題文
+
+def normalize_problem(text: str) -> str:
+    """元の問題の表記ゆれ（全角/半角、空白、大文字/小文字）を吸収したキーを作る"""
+    normalized = unicodedata.normalize("NFKC", text)
+    normalized = re.sub(r"\s+", " ", normalized).strip()
+    return normalized.lower()
+
+class QuestionPool:
+    """
+    元の問題（正規化済み）→ 作り置きの類似問題 の LRU プール。
+
+    serve() で出題するたびに、減った分の補充をバックグラウンドで開始する。
+    補充は出題の種類を順番に切り替えて行うため、4種類の問題がまんべんなく溜まる。
+    """
+
+    def __init__(self, max_problems: int, variants_per_problem: int, refill_concurrency: int, enabled: bool = True):
+        self.enabled = enabled
+        self.hits = 0
+        self.misses = 0
+        self._max_problems = max_problems
+        self._variants_per_problem = variants_per_problem
+        self._pool: "OrderedDict[str, Deque[PooledQuestion]]" = OrderedDict()
+        # 次に補充する出題の種類の位置（元の問題ごと）
+        self._next_kind: Dict[str, int] = {}
+        # 補充中の元の問題（同じ問題の補充を二重に走らせない）
+        self._refilling: Set[str] = set()
+        self._refill_semaphore = asyncio.Semaphore(refill_concurrency)
+        self._background_tasks: Set[asyncio.Task] = set()
+
+    def serve(self, source_problem: str, exclude: Iterable[str] = ()) -> Optional[str]:
+        """
+        プールから類似問題を1つ取り出して返す。出せるものがなければ None。
+        exclude には同じ会話で既に出題した文章を渡す（同じ会話で同じ問題を繰り返さない）。
+        いずれの場合も、プールの補充をバックグラウンドで開始する。
+        """
+        if not self.enabled:
+            return None
+        key = normalize_problem(source_problem)
+        variants = self._pool.get(key)
+        served: Optional[PooledQuestion] = None
+        if variants is not None:
+            self._pool.move_to_end(key)
+            excluded = set(exclude)
+            for candidate in list(variants):
+                if candidate.text not in excluded:
+                    variants.remove(candidate)
+                    served = candidate
+                    break
+        else:
+            self._add_problem(key)
+
+        if served is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+            logger.debug("Served pooled question (%s)", served.kind)
+        self._schedule_refill(key, source_problem)
+        return served.text if served else None
+
+    def _add_problem(self, key: str) -> None:
+        self._pool[key] = deque()
+        self._next_kind[key] = 0
+        while len(self._pool) > self._max_problems:
+            evicted, _ = self._pool.popitem(last=False)
+            self._next_kind.pop(evicted, None)
+
+    def _schedule_refill(self, key: str, source_problem: str) -> None:
+        if key in self._refilling or key not in self._pool:
+            return
+        if len(self._pool[key]) >= self._variants_per_problem:
+            return
+        self._refilling.add(key)
+        task = asyncio.create_task(self._refill(key, source_problem))
+        self._background_tasks.add(task)
+        task.add_done_callback(self._background_tasks.discard)
+
+    async def _refill(self, key: str, source_problem: str) -> None:
+        kinds = list(QUESTION_KINDS)
+        try:
+            while key in self._pool and len(self._pool[key]) < self._variants_per_problem:
+                kind = kinds[self._next_kind[key] % len(kinds)]
+                self._next_kind[key] += 1
+                async with self._refill_semaphore:
+                    text = await generate_chat_response(
+                        current_message_content=REFILL_REQUEST_TEMPLATE.format(
+                            source=source_problem, kind=kind, description=QUESTION_KINDS[kind]
+                        ),
+                        history=[],
+                        mode="question",
+                    )
+                variants = self._pool.get(key)
+                if variants is None:
+                    break # 補充中にLRUで追い出された
+                if all(existing.text != text for existing in variants):
+                    variants.append(PooledQuestion(kind=kind, text=text))
+        except Exception as e:
+            # 補充に失敗しても、出題はその場でAIを呼ぶ従来の処理で続けられる
+            logger.warning("Failed to refill question pool: %s", e)
+        finally:
+            self._refilling.discard(key)
+
+    def stats(self) -> Dict[str, int]:
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "problems": len(self._pool),
+            "variants": sum(len(variants) for variants in self._pool.values()),
+        }
+
+question_pool = QuestionPool(
+    max_problems=QUESTION_POOL_MAX_PROBLEMS,
+    variants_per_problem=QUESTION_POOL_VARIANTS_PER_PROBLEM,
+    refill_concurrency=QUESTION_POOL_REFILL_CONCURRENCY,
+    enabled=QUESTION_POOL_ENABLED,
+)
@@ -0,0 +1,212 @@
+# app/services/single_flight.py
+# 同じチャットリクエストの重複実行を防ぐ（シングルフライト + 直後のリプレイ）
+# フロントエンドの二重送信や、学校の不安定な Wi-Fi による再送で同じリクエストが届くと、
+# LLM を2回呼び、同じ会話に同じターンを2回保存してしまう。
+# 同じキーのリクエストが処理中ならその処理の結果を待ち合わせ、終わった直後ならその結果をそのまま返す。
+#
+# キーはクライアントが Idempotency-Key ヘッダーで指定したもの。なければ
+# (モード, conversation_id, 質問, クライアントの履歴の件数) から作る。
+# 新しい会話 (conversation_id なし) は、別の生徒の同じ質問をまとめてしまわないよう、
+# ヘッダーか learner_id がある場合だけ対象にする。
+# 待ち合わせはワーカープロセスごと（マルチワーカーではディスパッチャーが同じ会話・同じキーを同じワーカーに送る）。
+import asyncio
+import hashlib
+import logging
+import os
+from typing import AsyncIterator, Awaitable, Callable, Dict, List, Optional, TypeVar
+
+from cachetools import TTLCache
+
+from app.core.metrics import CHAT_DEDUPLICATED
+from app.models.chat_models import BatchEvaluationRequest, ChatRequest
+
+logger = logging.getLogger(__name__)
+
+CHAT_IDEMPOTENCY_ENABLED = os.getenv("CHAT_IDEMPOTENCY_ENABLED", "true").lower() == "true"
+# 完了した結果をリプレイする秒数（同じ質問を本当に繰り返した場合と区別できるよう短くする）
+CHAT_IDEMPOTENCY_REPLAY_SECONDS = float(os.getenv("CHAT_IDEMPOTENCY_REPLAY_SECONDS", "15"))
+# リプレイ用に保持する結果の件数の上限
+CHAT_IDEMPOTENCY_MAX_ENTRIES = int(os.getenv("CHAT_IDEMPOTENCY_MAX_ENTRIES", "10000"))
+
+IDEMPOTENCY_KEY_HEADER = "Idempotency-Key"
+
+# メトリクスのラベル
+DEDUP_JOINED = "joined"     # 処理中のリクエストに待ち合わせた
+DEDUP_REPLAYED = "replayed" # 完了した結果をリプレイした
+
+T = TypeVar("T")
+
+def _digest(*parts: str) -> str:
+    return hashlib.sha256("\0".join(parts).encode("utf-8")).hexdigest()
+
+def chat_request_key(mode: str, request: ChatRequest, idempotency_key: Optional[str], stream: bool = False) -> Optional[str]:
+    """チャットリクエストの重複判定のキー。対象にしない場合は None"""
+    if not CHAT_IDEMPOTENCY_ENABLED:
+        return None
+    kind = "stream" if stream else "json"
+    if idempotency_key:
+        return _digest("key", mode, kind, idempotency_key)
+    # 履歴の件数を含めるので、回答を受け取った後に同じ質問をし直した場合は別のリクエストになる
+    if request.conversation_id is not None:
+        return _digest("conversation", mode, kind, str(request.conversation_id), str(len(request.history)), request.question)
+    if request.learner_id:
+        return _digest("learner", mode, kind, request.learner_id, str(len(request.history)), request.question)
+    return None
+
+def batch_request_key(mode: str, request: BatchEvaluationRequest, idempotency_key: Optional[str]) -> Optional[str]:
+    """一括評価リクエストの重複判定のキー（各件に learner_id があるので内容のハッシュを使える）"""
+    if not CHAT_IDEMPOTENCY_ENABLED:
+        return None
+    if idempotency_key:
+        return _digest("key", mode, "batch", idempotency_key)
+    return _digest("batch", mode, request.model_dump_json())
+
+class _Flight:
+    """処理中の1件（結果を返す処理）"""
+
+    def __init__(self, task: asyncio.Task):
+        self.task = task
+        self.waiters = 0
+
+class _StreamFlight:
+    """処理中の1件（ストリーム）。届いたイベントを溜めておき、途中から加わったリクエストにも最初から送る"""
+
+    def __init__(self):
+        self.events: List[str] = []
+        self.done = False
+        self.followers = 0
+        self.task: Optional[asyncio.Task] = None
+        self.changed = asyncio.Event()
+
+    def publish(self, event: str) -> None:
+        self.events.append(event)
+        self.notify()
+
+    def notify(self) -> None:
+        changed, self.changed = self.changed, asyncio.Event()
+        changed.set()
+
+class SingleFlight:
+    """
+    キーごとに処理を1回だけ実行し、同時に届いた同じキーのリクエストには同じ結果を返す。
+
+    - run: 結果を返す処理 (通常のエンドポイント)
+    - stream: 文字列を順に返す処理 (SSE / NDJSON のエンドポイント)
+
+    成功した結果は replay_seconds の間保持し、その間に届いた同じキーのリクエストにはそのまま返す。
+    待っているリクエストがすべて取り消されたら（クライアントの切断など）、処理も取り消す。
+    """
+
+    def __init__(self, replay_seconds: float, max_entries: int):
+        self._completed = TTLCache(maxsize=max_entries, ttl=replay_seconds)
+        self._in_flight: Dict[str, _Flight] = {}
+        self._streams: Dict[str, _StreamFlight] = {}
+
+    def _count(self, mode: str, kind: str) -> None:
+        CHAT_DEDUPLICATED.labels(mode=mode, kind=kind).inc()
+        logger.info("Deduplicated %s request (%s)", mode, kind)
+
+    async def run(self, key: Optional[str], mode: str, factory: Callable[[], Awaitable[T]]) -> T:
+        if key is None:
+            return await factory()
+        if key in self._completed:
+            self._count(mode, DEDUP_REPLAYED)
+            return self._completed[key]
+        flight = self._in_flight.get(key)
+        if flight is None:
+            flight = _Flight(asyncio.ensure_future(self._execute(key, factory)))
+            self._in_flight[key] = flight
+        else:
+            self._count(mode, DEDUP_JOINED)
+
+        flight.waiters += 1
+        try:
+            # 待っている側が取り消されても、他に待っている側がいれば処理は続ける
+            return await asyncio.shield(flight.task)
+        except asyncio.CancelledError:
+            if flight.waiters == 1 and not flight.task.done():
+                flight.task.cancel()
+            raise
+        finally:
+            flight.waiters -= 1
+
+    async def _execute(self, key: str, factory: Callable[[], Awaitable[T]]) -> T:
+        try:
+            result = await factory()
+            self._completed[key] = result
+            return result
+        finally:
+            self._in_flight.pop(key, None)
+
+    async def stream(
+        self,
+        key: Optional[str],
+        mode: str,
+        factory: Callable[[], AsyncIterator[str]],
+        replayable: Callable[[List[str]], bool],
+    ) -> AsyncIterator[str]:
+        """
+        factory() のストリームを同じキーのリクエストで共有する。
+        replayable(events) が True を返した（最後まで成功した）ストリームだけをリプレイの対象にする。
+        """
+        if key is None:
+            async for event in factory():
+                yield event
+            return
+        replay = self._completed.get(key)
+        if replay is not None:
+            self._count(mode, DEDUP_REPLAYED)
+            for event in replay:
+                yield event
+            return
+        flight = self._streams.get(key)
+        if flight is None:
+            flight = _StreamFlight()
+            flight.task = asyncio.ensure_future(self._produce(key, flight, factory, replayable))
+            self._streams[key] = flight
+        else:
+            self._count(mode, DEDUP_JOINED)
+
+        flight.followers += 1
+        index = 0
+        try:
+            while True:
+                changed = flight.changed
+                while index < len(flight.events):
+                    yield flight.events[index]
+                    index += 1
+                if flight.done:
+                    return
+                await changed.wait()
+        finally:
+            flight.followers -= 1
+            if flight.followers == 0 and not flight.done:
+                flight.task.cancel()
+
+    async def _produce(
+        self,
+        key: str,
+        flight: _StreamFlight,
+        factory: Callable[[], AsyncIterator[str]],
+        replayable: Callable[[List[str]], bool],
+    ) -> None:
+        try:
+            async for event in factory():
+                flight.publish(event)
+            if replayable(flight.events):
+                self._completed[key] = tuple(flight.events)
+        except Exception:
+            logger.exception("Shared %s stream failed", key[:12])
+        finally:
+            flight.done = True
+            flight.notify()
+            self._streams.pop(key, None)
+
+    def stats(self) -> Dict[str, int]:
+        return {
+            "in_flight": len(self._in_flight) + len(self._streams),
+            "replayable": len(self._completed),
+        }
+
+# アプリ全体で共有するインスタンス
+chat_flights = SingleFlight(CHAT_IDEMPOTENCY_REPLAY_SECONDS, CHAT_IDEMPOTENCY_MAX_ENTRIES)
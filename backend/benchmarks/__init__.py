@@ -0,0 +1,2 @@
+# benchmarks
+# ベンチマーク用スクリプト (backend ディレクトリで python -m benchmarks.<name> として実行)
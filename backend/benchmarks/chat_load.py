@@ -0,0 +1,318 @@
+# benchmarks/chat_load.py
+# チャットAPIの負荷・レイテンシのベンチマーク
+#
+# 複数の生徒が並行して会話を続ける状況を再現し、スループット・レイテンシ・
+# 1ターンあたりのSQL実行数/コミット数・履歴が伸びるにつれてのプロンプトサイズを計測する。
+#
+# 実行例 (backend ディレクトリで):
+#   # アプリをプロセス内で起動し、疑似LLMバックエンドで計測（DBは一時ファイルの SQLite）
+#   python -m benchmarks.chat_load --students 40 --turns 12 --output bench.json
+#   # ストリーミング版のエンドポイントで最初のトークンまでの時間も計測
+#   python -m benchmarks.chat_load --stream
+#   # 起動済みのサーバー (uvicorn) に対して計測（サーバー側の集計値は取得できない）
+#   python -m benchmarks.chat_load --url http://localhost:8000
+#
+# 結果は JSON で出力されるので、変更前後の実行結果を比較できる。
+import argparse
+import asyncio
+import contextvars
+import json
+import math
+import os
+import random
+import statistics
+import sys
+import tempfile
+import time
+from collections import defaultdict
+from typing import Any, Dict, List, Optional
+
+import httpx
+
+ALL_MODES = ["thinking", "answer", "understanding_evaluation", "question"]
+
+# 生徒が送る質問の例（モードごと。順番に使い回す）
+SAMPLE_QUESTIONS = {
+    "thinking": [
+        "3-1は？",
+        "奥山に 紅葉踏みわけ 鳴く鹿の 声きく時ぞ 秋は悲しき この歌の意味は？",
+        "I have a friend who lives in America.のwhoは関係代名詞で合ってる？",
+        "わかった！答えは2だと思う",
+        "じゃあ次は何を考えればいい？",
+    ],
+    "answer": [
+        "1/2 + 1/3 は？",
+        "通分して分母をそろえたからだと思う",
+        "光合成で作られるものは？",
+    ],
+    "understanding_evaluation": [
+        "りんごが3個あります。お友達に1個あげました。残りのりんごの数を分数で表しましょう。",
+        "答えは2/3です",
+        "3個のうち2個が残ったから、3分の2だと思いました",
+    ],
+    "question": [
+        "りんごが3個あります。お友達に1個あげました。残りのりんごの数を分数で表しましょう。",
+        "ある長方形の面積が24cm²で、縦の長さが6cmです。横の長さを分数で表しましょう。",
+    ],
+}
+
+# 疑似バックエンドが「どのターンのメイン呼び出しか」を知るためのコンテキスト
+# (要約の更新や類似問題の補充などの付随的な呼び出しと区別する)
+_current_turn: contextvars.ContextVar[Optional[int]] = contextvars.ContextVar("current_turn", default=None)
+_current_question: contextvars.ContextVar[Optional[str]] = contextvars.ContextVar("current_question", default=None)
+
+def percentile(values: List[float], p: float) -> Optional[float]:
+    """最近傍順位法によるパーセンタイル"""
+    if not values:
+        return None
+    ordered = sorted(values)
+    rank = max(0, min(len(ordered) - 1, math.ceil(p / 100 * len(ordered)) - 1))
+    return ordered[rank]
+
+def latency_summary(values_ms: List[float]) -> Dict[str, Any]:
+    return {
+        "count": len(values_ms),
+        "mean_ms": round(statistics.fmean(values_ms), 2) if values_ms else None,
+        "p50_ms": _round(percentile(values_ms, 50)),
+        "p95_ms": _round(percentile(values_ms, 95)),
+        "p99_ms": _round(percentile(values_ms, 99)),
+        "max_ms": _round(max(values_ms) if values_ms else None),
+    }
+
+def _round(value: Optional[float]) -> Optional[float]:
+    return round(value, 2) if value is not None else None
+
+class Recorder:
+    """クライアント側で計測した結果を集める"""
+
+    def __init__(self):
+        self.latencies_ms: Dict[str, List[float]] = defaultdict(list)
+        self.first_token_ms: Dict[str, List[float]] = defaultdict(list)
+        self.errors: Dict[str, int] = defaultdict(int)
+        self.turns_ok = 0
+
+    def ok(self, mode: str, latency_ms: float, first_token_ms: Optional[float] = None) -> None:
+        self.turns_ok += 1
+        self.latencies_ms[mode].append(latency_ms)
+        if first_token_ms is not None:
+            self.first_token_ms[mode].append(first_token_ms)
+
+    def error(self, mode: str, kind: str) -> None:
+        self.errors[f"{mode}:{kind}"] += 1
+
+async def _send_turn(client: httpx.AsyncClient, mode: str, question: str, conversation_id: Optional[int],
+                     stream: bool, recorder: Recorder) -> Optional[int]:
+    """1ターン分のリクエストを送り、次のターンで使う conversation_id を返す"""
+    body = {"question": question, "history": [], "conversation_id": conversation_id}
+    started = time.perf_counter()
+    if not stream:
+        response = await client.post(f"/chat/{mode}", json=body)
+        elapsed_ms = (time.perf_counter() - started) * 1000
+        if response.status_code != 200:
+            recorder.error(mode, f"http_{response.status_code}")
+            return conversation_id
+        recorder.ok(mode, elapsed_ms)
+        return response.json()["conversation_id"]
+
+    first_token_ms = None
+    event = None
+    async with client.stream("POST", f"/chat/{mode}/stream", json=body) as response:
+        if response.status_code != 200:
+            recorder.error(mode, f"http_{response.status_code}")
+            return conversation_id
+        async for line in response.aiter_lines():
+            if line.startswith("event: "):
+                event = line[len("event: "):]
+            elif line.startswith("data: "):
+                data = json.loads(line[len("data: "):])
+                if event == "token" and first_token_ms is None:
+                    first_token_ms = (time.perf_counter() - started) * 1000
+                elif event == "done":
+                    conversation_id = data["conversation_id"]
+                elif event == "error":
+                    recorder.error(mode, "stream_error")
+                    return data.get("conversation_id") or conversation_id
+    recorder.ok(mode, (time.perf_counter() - started) * 1000, first_token_ms)
+    return conversation_id
+
+async def _simulate_student(index: int, client: httpx.AsyncClient, modes: List[str], turns: int,
+                            think_time_ms: float, stream: bool, recorder: Recorder, rng: random.Random) -> None:
+    """1人の生徒: 1つのモードで turns 回の会話を続ける"""
+    mode = modes[index % len(modes)]
+    questions = SAMPLE_QUESTIONS[mode]
+    conversation_id = None
+    for turn in range(turns):
+        question = questions[turn % len(questions)]
+        _current_turn.set(turn)
+        _current_question.set(question)
+        try:
+            conversation_id = await _send_turn(client, mode, question, conversation_id, stream, recorder)
+        except httpx.HTTPError as e:
+            recorder.error(mode, type(e).__name__)
+        if think_time_ms > 0:
+            await asyncio.sleep(rng.uniform(0.5, 1.5) * think_time_ms / 1000)
+
+async def _run_students(client: httpx.AsyncClient, args, recorder: Recorder) -> float:
+    rng = random.Random(args.seed)
+    started = time.perf_counter()
+    await asyncio.gather(*[
+        _simulate_student(i, client, args.modes, args.turns, args.think_time_ms, args.stream, recorder, rng)
+        for i in range(args.students)
+    ])
+    return time.perf_counter() - started
+
+def _configure_in_process_environment(args) -> str:
+    """アプリを import する前に、疑似LLMと一時DBを使う設定を環境変数に入れる"""
+    if args.database_url:
+        os.environ["DATABASE_URL"] = args.database_url
+    else:
+        db_dir = tempfile.mkdtemp(prefix="chat-bench-")
+        os.environ["DATABASE_URL"] = f"sqlite:///{os.path.join(db_dir, 'bench.db')}"
+    os.environ.pop("ASYNC_DATABASE_URL", None)
+    os.environ["LLM_BACKEND"] = "fake"
+    os.environ["FAKE_LLM_LATENCY_MEDIAN_MS"] = str(args.llm_median_ms)
+    os.environ["FAKE_LLM_LATENCY_SIGMA"] = str(args.llm_sigma)
+    os.environ["FAKE_LLM_RESPONSE_REPEAT"] = str(args.response_repeat)
+    os.environ["FAKE_LLM_ERROR_RATE"] = str(args.llm_error_rate)
+    os.environ["FAKE_LLM_SEED"] = str(args.seed)
+    return os.environ["DATABASE_URL"]
+
+async def run_in_process(args) -> Dict[str, Any]:
+    database_url = _configure_in_process_environment(args)
+
+    from sqlalchemy import event
+
+    from app.db.database import Base, async_engine, engine
+    from app.db import models  # noqa: F401  テーブル定義を読み込む
+    from app.main import app
+    from app.services import ai_service
+    from app.services.history_cache import history_cache
+    from app.services.llm.fake_backend import FakeBackend
+    from app.services.question_pool import question_pool
+
+    Base.metadata.create_all(bind=engine)
+
+    # --- サーバー側の集計 ---
+    db_counts = {"statements": 0, "commits": 0}
+
+    @event.listens_for(async_engine.sync_engine, "before_cursor_execute")
+    def _count_statement(*_):
+        db_counts["statements"] += 1
+
+    @event.listens_for(async_engine.sync_engine, "commit")
+    def _count_commit(*_):
+        db_counts["commits"] += 1
+
+    # ターン番号ごとのプロンプトサイズ (メインの呼び出しのみ)
+    prompt_bytes_by_turn: Dict[int, List[int]] = defaultdict(list)
+    auxiliary_calls = {"count": 0}
+
+    class RecordingFakeBackend(FakeBackend):
+        def _record_prompt(self, message, history, system_instruction):
+            super()._record_prompt(message, history, system_instruction)
+            turn = _current_turn.get()
+            if turn is None or message != _current_question.get():
+                auxiliary_calls["count"] += 1
+                return
+            size = len(message.encode()) + sum(len(m.content.encode()) for m in history)
+            size += len((system_instruction or "").encode())
+            prompt_bytes_by_turn[turn].append(size)
+
+    backend = RecordingFakeBackend()
+    ai_service.set_backend(backend)
+
+    recorder = Recorder()
+    transport = httpx.ASGITransport(app=app)
+    async with app.router.lifespan_context(app):
+        async with httpx.AsyncClient(transport=transport, base_url="http://bench", timeout=None) as client:
+            elapsed = await _run_students(client, args, recorder)
+        # バックグラウンドの要約更新などが終わるのを少し待つ
+        await asyncio.sleep(0.1)
+
+    turns = max(1, recorder.turns_ok)
+    result = _client_results(args, recorder, elapsed)
+    result["server"] = {
+        "database_url": database_url,
+        "db_statements_total": db_counts["statements"],
+        "db_commits_total": db_counts["commits"],
+        "db_statements_per_turn": round(db_counts["statements"] / turns, 3),
+        "db_commits_per_turn": round(db_counts["commits"] / turns, 3),
+        "prompt_bytes_by_turn": {
+            str(turn): round(statistics.fmean(sizes), 1)
+            for turn, sizes in sorted(prompt_bytes_by_turn.items())
+        },
+        "llm_calls": backend.calls,
+        "llm_auxiliary_calls": auxiliary_calls["count"],
+        "llm_injected_errors": backend.errors,
+        "history_cache": history_cache.stats(),
+        "question_pool": question_pool.stats(),
+    }
+    return result
+
+async def run_remote(args) -> Dict[str, Any]:
+    recorder = Recorder()
+    async with httpx.AsyncClient(base_url=args.url, timeout=None) as client:
+        elapsed = await _run_students(client, args, recorder)
+    result = _client_results(args, recorder, elapsed)
+    result["server"] = None # 別プロセスのサーバーの内部集計は取得できない
+    return result
+
+def _client_results(args, recorder: Recorder, elapsed: float) -> Dict[str, Any]:
+    all_latencies = [value for values in recorder.latencies_ms.values() for value in values]
+    all_first_tokens = [value for values in recorder.first_token_ms.values() for value in values]
+    return {
+        "config": {
+            "target": args.url or "in-process",
+            "students": args.students,
+            "turns": args.turns,
+            "modes": args.modes,
+            "stream": args.stream,
+            "think_time_ms": args.think_time_ms,
+            "llm_median_ms": args.llm_median_ms,
+            "llm_sigma": args.llm_sigma,
+            "llm_error_rate": args.llm_error_rate,
+            "response_repeat": args.response_repeat,
+            "seed": args.seed,
+        },
+        "elapsed_seconds": round(elapsed, 3),
+        "turns_ok": recorder.turns_ok,
+        "throughput_turns_per_second": round(recorder.turns_ok / elapsed, 3) if elapsed > 0 else None,
+        "errors": dict(recorder.errors),
+        "latency": latency_summary(all_latencies),
+        "latency_by_mode": {mode: latency_summary(values) for mode, values in recorder.latencies_ms.items()},
+        "first_token_latency": latency_summary(all_first_tokens) if args.stream else None,
+    }
+
+def parse_args(argv: Optional[List[str]] = None):
+    parser = argparse.ArgumentParser(description="チャットAPIの負荷・レイテンシのベンチマーク")
+    parser.add_argument("--url", help="計測対象のサーバーURL（省略時はアプリをプロセス内で起動）")
+    parser.add_argument("--database-url", help="プロセス内で起動する場合のDB URL（省略時は一時ファイルの SQLite）")
+    parser.add_argument("--students", type=int, default=20, help="同時に会話する生徒の数")
+    parser.add_argument("--turns", type=int, default=8, help="1人あたりの会話のターン数")
+    parser.add_argument("--modes", type=lambda s: s.split(","), default=ALL_MODES,
+                        help="対象モード（カンマ区切り）。生徒ごとに順番に割り当てる")
+    parser.add_argument("--stream", action="store_true", help="ストリーミング版のエンドポイントを使う")
+    parser.add_argument("--think-time-ms", type=float, default=0, help="ターン間の生徒の考える時間（平均）")
+    parser.add_argument("--llm-median-ms", type=float, default=800, help="疑似LLMの応答時間の中央値")
+    parser.add_argument("--llm-sigma", type=float, default=0.4, help="疑似LLMの応答時間のばらつき（対数正規分布）")
+    parser.add_argument("--llm-error-rate", type=float, default=0.0, help="疑似LLMのエラー率")
+    parser.add_argument("--response-repeat", type=int, default=1, help="疑似LLMの応答を長くする繰り返し回数")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", help="結果の JSON を書き出すファイル（省略時は標準出力のみ）")
+    args = parser.parse_args(argv)
+    unknown = [mode for mode in args.modes if mode not in ALL_MODES]
+    if unknown:
+        parser.error(f"unknown modes: {unknown}")
+    return args
+
+def main(argv: Optional[List[str]] = None) -> None:
+    args = parse_args(argv)
+    result = asyncio.run(run_remote(args) if args.url else run_in_process(args))
+    text = json.dumps(result, ensure_ascii=False, indent=2)
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            f.write(text)
+    print(text, file=sys.stdout)
+
+if __name__ == "__main__":
+    main()
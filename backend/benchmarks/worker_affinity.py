@@ -0,0 +1,144 @@
+# benchmarks/worker_affinity.py
+# マルチワーカー起動 (app/server.py) のワーカーごとの履歴キャッシュのヒット率
+#
+# 疑似LLMバックエンドと一時ファイルの SQLite でマルチワーカーのサーバーを起動し、
+# chat_load.py と同じ生徒のシナリオを流したあと、各ワーカーの /metrics から
+# 履歴キャッシュのヒット・ミス数を集計する。振り分け方 (affinity / round_robin) ごとに比較できる。
+#
+# 実行例 (backend ディレクトリで):
+#   python -m benchmarks.worker_affinity --workers 4 --students 40 --turns 10
+#   python -m benchmarks.worker_affinity --dispatch affinity --output affinity.json
+import argparse
+import asyncio
+import json
+import os
+import re
+import socket
+import subprocess
+import sys
+import time
+from typing import Any, Dict, List, Optional
+
+import httpx
+
+from benchmarks.chat_load import ALL_MODES, Recorder, _client_results, _configure_in_process_environment, _run_students
+
+DISPATCH_MODES = ["affinity", "round_robin"]
+
+_CACHE_METRIC = re.compile(r"^history_cache_(hits|misses)_total (\S+)$", re.MULTILINE)
+
+def _free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+async def _wait_until_ready(client: httpx.AsyncClient, workers: int, process: subprocess.Popen, timeout: float) -> None:
+    deadline = time.monotonic() + timeout
+    while True:
+        if process.poll() is not None:
+            raise RuntimeError(f"server exited with code {process.returncode}")
+        try:
+            responses = [await client.get("/metrics", headers={"X-Worker": str(i)}) for i in range(workers)]
+            if all(response.status_code == 200 for response in responses):
+                return
+        except httpx.TransportError:
+            pass
+        if time.monotonic() > deadline:
+            raise RuntimeError("server did not become ready in time")
+        await asyncio.sleep(0.2)
+
+async def _worker_cache_stats(client: httpx.AsyncClient, workers: int) -> List[Dict[str, Any]]:
+    stats = []
+    for index in range(workers):
+        response = await client.get("/metrics", headers={"X-Worker": str(index)})
+        values = {key: float(value) for key, value in _CACHE_METRIC.findall(response.text)}
+        hits, misses = int(values.get("hits", 0)), int(values.get("misses", 0))
+        stats.append({
+            "worker": index,
+            "hits": hits,
+            "misses": misses,
+            "hit_rate": round(hits / (hits + misses), 4) if hits + misses else None,
+        })
+    return stats
+
+async def run_dispatch_mode(args, dispatch: str) -> Dict[str, Any]:
+    port = _free_port()
+    base_url = f"http://127.0.0.1:{port}"
+    process = subprocess.Popen(
+        [sys.executable, "-m", "app.server", "--workers", str(args.workers), "--port", str(port), "--dispatch", dispatch],
+        env=os.environ.copy(),
+        stdout=subprocess.DEVNULL if not args.server_logs else None,
+    )
+    try:
+        async with httpx.AsyncClient(base_url=base_url, timeout=None) as client:
+            await _wait_until_ready(client, args.workers, process, timeout=60)
+            recorder = Recorder()
+            args.url = base_url
+            elapsed = await _run_students(client, args, recorder)
+            result = _client_results(args, recorder, elapsed)
+            workers = await _worker_cache_stats(client, args.workers)
+    finally:
+        process.terminate()
+        process.wait(timeout=60)
+
+    hits = sum(worker["hits"] for worker in workers)
+    misses = sum(worker["misses"] for worker in workers)
+    result["dispatch"] = dispatch
+    result["history_cache"] = {
+        "hits": hits,
+        "misses": misses,
+        "hit_rate": round(hits / (hits + misses), 4) if hits + misses else None,
+        "workers": workers,
+    }
+    return result
+
+async def run(args) -> Dict[str, Any]:
+    database_url = _configure_in_process_environment(args)
+
+    from app.db.database import Base, engine
+    from app.db import models  # noqa: F401  テーブル定義を読み込む
+
+    Base.metadata.create_all(bind=engine)
+    results = {dispatch: await run_dispatch_mode(args, dispatch) for dispatch in args.dispatch}
+    return {"database_url": database_url, "workers": args.workers, "results": results}
+
+def parse_args(argv: Optional[List[str]] = None):
+    parser = argparse.ArgumentParser(description="マルチワーカー起動のワーカーごとの履歴キャッシュのヒット率")
+    parser.add_argument("--workers", type=int, default=4, help="ワーカー数")
+    parser.add_argument("--dispatch", type=lambda s: s.split(","), default=DISPATCH_MODES,
+                        help="比較する振り分け方（カンマ区切り）: affinity, round_robin")
+    parser.add_argument("--database-url", help="DB URL（省略時は一時ファイルの SQLite）")
+    parser.add_argument("--students", type=int, default=20, help="同時に会話する生徒の数")
+    parser.add_argument("--turns", type=int, default=8, help="1人あたりの会話のターン数")
+    parser.add_argument("--modes", type=lambda s: s.split(","), default=ALL_MODES,
+                        help="対象モード（カンマ区切り）。生徒ごとに順番に割り当てる")
+    parser.add_argument("--stream", action="store_true", help="ストリーミング版のエンドポイントを使う")
+    parser.add_argument("--think-time-ms", type=float, default=0, help="ターン間の生徒の考える時間（平均）")
+    parser.add_argument("--llm-median-ms", type=float, default=200, help="疑似LLMの応答時間の中央値")
+    parser.add_argument("--llm-sigma", type=float, default=0.4, help="疑似LLMの応答時間のばらつき（対数正規分布）")
+    parser.add_argument("--llm-error-rate", type=float, default=0.0, help="疑似LLMのエラー率")
+    parser.add_argument("--response-repeat", type=int, default=1, help="疑似LLMの応答を長くする繰り返し回数")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--server-logs", action="store_true", help="サーバーのログを表示する")
+    parser.add_argument("--output", help="結果の JSON を書き出すファイル（省略時は標準出力のみ）")
+    args = parser.parse_args(argv)
+    args.url = None
+    unknown = [mode for mode in args.modes if mode not in ALL_MODES]
+    if unknown:
+        parser.error(f"unknown modes: {unknown}")
+    unknown = [dispatch for dispatch in args.dispatch if dispatch not in DISPATCH_MODES]
+    if unknown:
+        parser.error(f"unknown dispatch modes: {unknown}")
+    return args
+
+def main(argv: Optional[List[str]] = None) -> None:
+    args = parse_args(argv)
+    result = asyncio.run(run(args))
+    text = json.dumps(result, ensure_ascii=False, indent=2)
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            f.write(text)
+    print(text, file=sys.stdout)
+
+if __name__ == "__main__":
+    main()
@@ -1,10 +1,8 @@
 # create_tables.py
-import os
-import sys
-from app.db.database import Base, engine
-from app.db import models 
+# DBのテーブルを作成し、スキーマを最新のマイグレーションまで更新する（何度実行してもよい）
+from app.db.migrate import upgrade_database
 
 
-print("Creating database tables...")
-Base.metadata.create_all(bind=engine)
-print("Tables created.")
\ No newline at end of file
+print("Migrating database schema...")
+upgrade_database()
+print("Database schema is up to date.")
@@ -0,0 +1,47 @@
+# migrations/env.py
+# Alembic の実行環境。接続先とモデル定義 (Base.metadata) はアプリと同じものを使う
+from logging.config import fileConfig
+
+from alembic import context
+from sqlalchemy import create_engine
+
+from app.db.database import Base, SQLALCHEMY_DATABASE_URL, connect_args
+from app.db import models  # noqa: F401  モデルを Base.metadata に登録するため
+
+config = context.config
+
+# 呼び出し元 (create_tables.py など) で作成済みのロガーは無効にしない
+if config.config_file_name is not None:
+    fileConfig(config.config_file_name, disable_existing_loggers=False)
+
+target_metadata = Base.metadata
+
+# SQLite は ALTER TABLE でできることが少ないため、テーブルを作り直す batch モードで変更する
+render_as_batch = SQLALCHEMY_DATABASE_URL.startswith("sqlite")
+
+def run_migrations_offline() -> None:
+    """DBに接続せず、実行する SQL を出力する (alembic upgrade head --sql)"""
+    context.configure(
+        url=SQLALCHEMY_DATABASE_URL,
+        target_metadata=target_metadata,
+        literal_binds=True,
+        render_as_batch=render_as_batch,
+    )
+    with context.begin_transaction():
+        context.run_migrations()
+
+def run_migrations_online() -> None:
+    connectable = create_engine(SQLALCHEMY_DATABASE_URL, connect_args=connect_args)
+    with connectable.connect() as connection:
+        context.configure(
+            connection=connection,
+            target_metadata=target_metadata,
+            render_as_batch=render_as_batch,
+        )
+        with context.begin_transaction():
+            context.run_migrations()
+
+if context.is_offline_mode():
+    run_migrations_offline()
+else:
+    run_migrations_online()
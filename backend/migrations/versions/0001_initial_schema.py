@@ -0,0 +1,44 @@
+"""initial schema (create_tables.py の create_all で作っていたテーブル)
+
+Revision ID: 0001
+Revises:
+Create Date: 2026-10-17
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+revision = "0001"
+down_revision = None
+branch_labels = None
+depends_on = None
+
+
+def upgrade() -> None:
+    op.create_table(
+        "conversations",
+        sa.Column("id", sa.Integer(), primary_key=True),
+        sa.Column("created_at", sa.DateTime(timezone=True), server_default=sa.func.now()),
+    )
+    op.create_index("ix_conversations_id", "conversations", ["id"])
+
+    op.create_table(
+        "messages",
+        sa.Column("id", sa.Integer(), primary_key=True),
+        sa.Column("conversation_id", sa.Integer(), sa.ForeignKey("conversations.id")),
+        sa.Column("role", sa.String()),
+        sa.Column("content", sa.Text()),
+        sa.Column("created_at", sa.DateTime(timezone=True), server_default=sa.func.now()),
+    )
+    op.create_index("ix_messages_id", "messages", ["id"])
+    op.create_index("ix_messages_conversation_id", "messages", ["conversation_id"])
+    op.create_index("ix_messages_role", "messages", ["role"])
+
+
+def downgrade() -> None:
+    op.drop_index("ix_messages_role", table_name="messages")
+    op.drop_index("ix_messages_conversation_id", table_name="messages")
+    op.drop_index("ix_messages_id", table_name="messages")
+    op.drop_table("messages")
+    op.drop_index("ix_conversations_id", table_name="conversations")
+    op.drop_table("conversations")
@@ -0,0 +1,69 @@
+"""messages.seq と (conversation_id, seq) の索引、conversations の集計列
+
+- messages.seq: 会話内の通し番号。created_at は SQLite では秒単位のため、同じターンの2行の順序が決まらなかった
+- 索引: conversation_id 単独と role (値の種類が少なく使われない) の索引を、(conversation_id, seq) の複合索引に置き換える
+- conversations.message_count / last_message_at: メッセージを数えずに済むよう非正規化して持つ
+
+Revision ID: 0002
+Revises: 0001
+Create Date: 2026-10-17
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+revision = "0002"
+down_revision = "0001"
+branch_labels = None
+depends_on = None
+
+
+def upgrade() -> None:
+    with op.batch_alter_table("conversations") as batch_op:
+        batch_op.add_column(sa.Column("message_count", sa.Integer(), nullable=False, server_default="0"))
+        batch_op.add_column(sa.Column("last_message_at", sa.DateTime(timezone=True), nullable=True))
+
+    with op.batch_alter_table("messages") as batch_op:
+        batch_op.add_column(sa.Column("seq", sa.Integer(), nullable=True))
+
+    # どの会話にも属さないメッセージは履歴として読まれることがないので削除する
+    op.execute("DELETE FROM messages WHERE conversation_id IS NULL")
+
+    # 既存のメッセージには、これまでの並び順 (created_at, id) で 1 から番号を振る
+    op.execute(
+        """
+        UPDATE messages SET seq = numbered.seq
+        FROM (
+            SELECT id, ROW_NUMBER() OVER (PARTITION BY conversation_id ORDER BY created_at, id) AS seq
+            FROM messages
+        ) AS numbered
+        WHERE messages.id = numbered.id
+        """
+    )
+    op.execute(
+        """
+        UPDATE conversations SET
+            message_count = (SELECT COUNT(*) FROM messages WHERE messages.conversation_id = conversations.id),
+            last_message_at = (SELECT MAX(created_at) FROM messages WHERE messages.conversation_id = conversations.id)
+        """
+    )
+
+    with op.batch_alter_table("messages") as batch_op:
+        batch_op.alter_column("seq", existing_type=sa.Integer(), nullable=False)
+        batch_op.alter_column("conversation_id", existing_type=sa.Integer(), nullable=False)
+        batch_op.drop_index("ix_messages_conversation_id")
+        batch_op.drop_index("ix_messages_role")
+        batch_op.create_index("ix_messages_conversation_id_seq", ["conversation_id", "seq"], unique=True)
+
+
+def downgrade() -> None:
+    with op.batch_alter_table("messages") as batch_op:
+        batch_op.drop_index("ix_messages_conversation_id_seq")
+        batch_op.create_index("ix_messages_role", ["role"])
+        batch_op.create_index("ix_messages_conversation_id", ["conversation_id"])
+        batch_op.alter_column("conversation_id", existing_type=sa.Integer(), nullable=True)
+        batch_op.drop_column("seq")
+
+    with op.batch_alter_table("conversations") as batch_op:
+        batch_op.drop_column("last_message_at")
+        batch_op.drop_column("message_count")
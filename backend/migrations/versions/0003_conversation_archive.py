@@ -0,0 +1,38 @@
+"""archived_conversations テーブルと conversations.archived_at
+
+やりとりのなくなった会話のメッセージを圧縮して1行にまとめる (app/db/archive.py)
+
+Revision ID: 0003
+Revises: 0002
+Create Date: 2026-10-17
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+revision = "0003"
+down_revision = "0002"
+branch_labels = None
+depends_on = None
+
+
+def upgrade() -> None:
+    op.create_table(
+        "archived_conversations",
+        sa.Column("conversation_id", sa.Integer(), sa.ForeignKey("conversations.id"), primary_key=True),
+        sa.Column("codec", sa.String(), nullable=False),
+        sa.Column("payload", sa.LargeBinary(), nullable=False),
+        sa.Column("message_count", sa.Integer(), nullable=False),
+        sa.Column("original_bytes", sa.Integer(), nullable=False),
+        sa.Column("compressed_bytes", sa.Integer(), nullable=False),
+        sa.Column("archived_at", sa.DateTime(timezone=True), server_default=sa.func.now()),
+    )
+    with op.batch_alter_table("conversations") as batch_op:
+        batch_op.add_column(sa.Column("archived_at", sa.DateTime(timezone=True), nullable=True))
+
+
+def downgrade() -> None:
+    # アーカイブ済みのメッセージは失われるので、先に HISTORY_ARCHIVE_REWARM などで戻しておくこと
+    with op.batch_alter_table("conversations") as batch_op:
+        batch_op.drop_column("archived_at")
+    op.drop_table("archived_conversations")
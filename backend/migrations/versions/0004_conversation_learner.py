@@ -0,0 +1,28 @@
+"""conversations.learner_id
+
+一括評価などで、会話がどの生徒のものかを記録する
+
+Revision ID: 0004
+Revises: 0003
+Create Date: 2026-10-17
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+revision = "0004"
+down_revision = "0003"
+branch_labels = None
+depends_on = None
+
+
+def upgrade() -> None:
+    with op.batch_alter_table("conversations") as batch_op:
+        batch_op.add_column(sa.Column("learner_id", sa.String(), nullable=True))
+        batch_op.create_index("ix_conversations_learner_id", ["learner_id"])
+
+
+def downgrade() -> None:
+    with op.batch_alter_table("conversations") as batch_op:
+        batch_op.drop_index("ix_conversations_learner_id")
+        batch_op.drop_column("learner_id")
@@ -0,0 +1,52 @@
+"""evaluation_scores / evaluation_subject_scores
+
+理解度評価の応答から取り出した点数を保存する (app/services/evaluation_scores.py)
+
+Revision ID: 0005
+Revises: 0004
+Create Date: 2026-10-17
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+revision = "0005"
+down_revision = "0004"
+branch_labels = None
+depends_on = None
+
+
+def upgrade() -> None:
+    op.create_table(
+        "evaluation_scores",
+        sa.Column("id", sa.Integer(), primary_key=True),
+        sa.Column("conversation_id", sa.Integer(), sa.ForeignKey("conversations.id"), nullable=False),
+        sa.Column("message_id", sa.Integer(), sa.ForeignKey("messages.id", ondelete="SET NULL"), nullable=True, unique=True),
+        sa.Column("message_seq", sa.Integer(), nullable=False),
+        sa.Column("understanding", sa.Integer(), nullable=True),
+        sa.Column("basic_understanding", sa.Integer(), nullable=True),
+        sa.Column("expression", sa.Integer(), nullable=True),
+        sa.Column("application", sa.Integer(), nullable=True),
+        sa.Column("attitude", sa.Integer(), nullable=True),
+        sa.Column("stumbling_points", sa.JSON(), nullable=True),
+        sa.Column("created_at", sa.DateTime(timezone=True), server_default=sa.func.now()),
+    )
+    op.create_index("ix_evaluation_scores_conversation_id_id", "evaluation_scores", ["conversation_id", "id"])
+
+    op.create_table(
+        "evaluation_subject_scores",
+        sa.Column("id", sa.Integer(), primary_key=True),
+        sa.Column("evaluation_id", sa.Integer(), sa.ForeignKey("evaluation_scores.id", ondelete="CASCADE"), nullable=False),
+        sa.Column("subject", sa.String(), nullable=False),
+        sa.Column("score", sa.Integer(), nullable=True),
+    )
+    op.create_index("ix_evaluation_subject_scores_evaluation_id", "evaluation_subject_scores", ["evaluation_id"])
+    op.create_index("ix_evaluation_subject_scores_subject", "evaluation_subject_scores", ["subject"])
+
+
+def downgrade() -> None:
+    op.drop_index("ix_evaluation_subject_scores_subject", table_name="evaluation_subject_scores")
+    op.drop_index("ix_evaluation_subject_scores_evaluation_id", table_name="evaluation_subject_scores")
+    op.drop_table("evaluation_subject_scores")
+    op.drop_index("ix_evaluation_scores_conversation_id_id", table_name="evaluation_scores")
+    op.drop_table("evaluation_scores")
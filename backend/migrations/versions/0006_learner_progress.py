@@ -0,0 +1,54 @@
+"""learner_progress / learner_subject_progress
+
+理解度評価の点数の、生徒ごと・教科ごとの集計 (app/db/progress.py)。
+既存の評価から集計を作るには python -m app.jobs.rebuild_progress を実行する。
+
+Revision ID: 0006
+Revises: 0005
+Create Date: 2026-10-17
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+revision = "0006"
+down_revision = "0005"
+branch_labels = None
+depends_on = None
+
+
+def upgrade() -> None:
+    op.create_table(
+        "learner_progress",
+        sa.Column("learner_id", sa.String(), primary_key=True),
+        sa.Column("evaluation_count", sa.Integer(), nullable=False),
+        sa.Column("understanding_count", sa.Integer(), nullable=False),
+        sa.Column("understanding_total", sa.Integer(), nullable=False),
+        sa.Column("rolling_understanding", sa.Float(), nullable=True),
+        sa.Column("best_understanding", sa.Integer(), nullable=True),
+        sa.Column("last_understanding", sa.Integer(), nullable=True),
+        sa.Column("improvement_streak", sa.Integer(), nullable=False),
+        sa.Column("recent_scores", sa.JSON(), nullable=False),
+        sa.Column("stumbling_counts", sa.JSON(), nullable=False),
+        sa.Column("first_evaluated_at", sa.DateTime(timezone=True), nullable=True),
+        sa.Column("last_evaluated_at", sa.DateTime(timezone=True), nullable=True),
+        sa.Column("last_evaluation_id", sa.Integer(), nullable=True),
+    )
+    op.create_table(
+        "learner_subject_progress",
+        sa.Column("learner_id", sa.String(), primary_key=True),
+        sa.Column("subject", sa.String(), primary_key=True),
+        sa.Column("evaluation_count", sa.Integer(), nullable=False),
+        sa.Column("score_total", sa.Integer(), nullable=False),
+        sa.Column("rolling_score", sa.Float(), nullable=True),
+        sa.Column("best_score", sa.Integer(), nullable=True),
+        sa.Column("last_score", sa.Integer(), nullable=True),
+        sa.Column("improvement_streak", sa.Integer(), nullable=False),
+        sa.Column("recent_scores", sa.JSON(), nullable=False),
+        sa.Column("last_evaluated_at", sa.DateTime(timezone=True), nullable=True),
+    )
+
+
+def downgrade() -> None:
+    op.drop_table("learner_subject_progress")
+    op.drop_table("learner_progress")
@@ -0,0 +1,33 @@
+"""conversation_summaries (履歴の古いターンの要約)
+
+0001 は create_all で作っていた頃の conversations / messages だけを表す（migrate.py がそこまでを適用済みとして記録する）。
+要約テーブルは create_all の時期に作られたDBにもすでにある場合があるので、なければ作る。
+
+Revision ID: 0007
+Revises: 0006
+Create Date: 2026-10-17
+"""
+from alembic import context, op
+import sqlalchemy as sa
+
+
+revision = "0007"
+down_revision = "0006"
+branch_labels = None
+depends_on = None
+
+
+def upgrade() -> None:
+    if not context.is_offline_mode() and sa.inspect(op.get_bind()).has_table("conversation_summaries"):
+        return
+    op.create_table(
+        "conversation_summaries",
+        sa.Column("conversation_id", sa.Integer(), sa.ForeignKey("conversations.id"), primary_key=True),
+        sa.Column("summary", sa.Text(), nullable=False),
+        sa.Column("summarized_message_count", sa.Integer(), nullable=False),
+        sa.Column("updated_at", sa.DateTime(timezone=True), server_default=sa.func.now()),
+    )
+
+
+def downgrade() -> None:
+    op.drop_table("conversation_summaries")